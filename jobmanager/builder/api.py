@@ -6,43 +6,73 @@
 Python Job Manager Server API
 :author: Ronan Delacroix
 """
-from flask import Flask, request, Response, render_template, url_for, redirect, flash, jsonify
-from werkzeug.utils import secure_filename
+import eventlet
+
+eventlet.monkey_patch()  # before other imports, so that module level locks are green locks
+
+from flask import Flask, Request, request, Response, render_template, url_for, redirect, flash, jsonify, abort, send_file
+from werkzeug.wsgi import wrap_file
 from functools import wraps
 import os
 import sys
+import json
 import tbx
 import tbx.text
 import tbx.code
 import logging
-import tempfile
 import traceback
 import datetime
-from functools import reduce
-import operator
 import shutil
 from . import lib
+from . import builds
+from . import upload
+from . import catalog
+from . import buildlog
+from . import metrics
+from . import sources
+from . import chunked
+from . import housekeeping
+from .models import BuildRequest, DockerImageInfo, SourceTree, UploadSession
 from flask_socketio import SocketIO, send, emit, join_room, leave_room
-import eventlet
 from jobmanager.common.docker import DockerImage
 
-eventlet.monkey_patch()
-
 
-ARCHIVE_EXTENSIONS = reduce(operator.concat, [f[1] for f in shutil.get_unpack_formats()])
+ARCHIVE_EXTENSIONS = upload.TAR_EXTENSIONS + upload.ZIP_EXTENSIONS
 
 ALLOWED_EXTENSIONS = ['.py'] + ARCHIVE_EXTENSIONS
 
 APP_NAME = "Job Manager"
 
+BUILD_WORKERS = 2
+
+BATCH_MAX_IMAGES = 20
+
+class BuilderRequest(Request):
+    """
+    Request streaming uploaded files to upload receivers, which check limits and extract archives as data arrives.
+    """
+    def __init__(self, *args, **kwargs):
+        super(BuilderRequest, self).__init__(*args, **kwargs)
+        self.upload_receivers = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        receiver = upload.UploadReceiver(filename)
+        self.upload_receivers.append(receiver)
+        return receiver
+
+
 # Flask
 app = Flask("jobmanager-builder", static_folder='jobmanager/builder/static', static_url_path='/static', template_folder='jobmanager/builder/templates')
 app.secret_key = "jobmanager-builder-secret-key-01"
+app.request_class = BuilderRequest
 app.jinja_env.lstrip_blocks = True
 app.jinja_env.trim_blocks = True
 log = logging.getLogger('werkzeug')
 logging.getLogger('docker').setLevel(logging.INFO)
 socketio = SocketIO(app)
+build_queue = None
+event_relay = None
+garbage_collector = None
 
 
 @socketio.on('connect')
@@ -50,6 +80,14 @@ def on_connect():
     logging.info(request.sid + ' Connected to websocket')
     socketio.emit('progress message', {'message': request.sid + ' Connected to websocket'}, room=request.sid)
 
+
+@socketio.on('join build')
+def on_join_build(data):
+    """
+    Subscribe to progress messages of a build, using its build ID.
+    """
+    join_room(data.get('build'))
+
 def serialize_response(result):
     mimetype = request.accept_mimetypes.best_match(tbx.text.mime_rendering_dict.keys(), default='application/json')
     if request.args.get('format') and request.args.get('format') in tbx.text.mime_shortcuts.keys():
@@ -70,20 +108,55 @@ def serialize(func):
 
 
 def save_uploaded_file(package_file, allowed_extension=ALLOWED_EXTENSIONS):
-    package_folder = tempfile.mkdtemp()
-
-    if not package_file or not package_file.filename or not os.path.splitext(package_file.filename)[1] in allowed_extension:
+    """
+    Wait for the end of the uploaded package extraction.
+    :return: tuple (upload receiver, filename)
+    """
+    if not package_file or not package_file.filename or not any(package_file.filename.endswith(ext) for ext in allowed_extension):
         raise Exception('No uploaded file or invalid one %s' % package_file)
 
-    filename = secure_filename(package_file.filename)
-    filepath = os.path.join(package_folder, filename)
-    package_file.save(filepath)
-
-    if os.path.splitext(filename)[1] in ARCHIVE_EXTENSIONS:
-        package_folder = tempfile.mkdtemp()
-        shutil.unpack_archive(filepath, package_folder)
-
-    return package_folder, filename
+    receiver = package_file.stream
+    receiver.finish()
+    return receiver, receiver.filename
+
+
+def get_uploaded_package(allowed_extension=ALLOWED_EXTENSIONS):
+    """
+    Get the package of a build request : the uploaded package file, or the chunked upload given by its ID in the
+    upload field.
+    :return: tuple (upload receiver, filename)
+    """
+    if not request.values.get('upload'):
+        return save_uploaded_file(request.files.get('package'), allowed_extension)
+    session = chunked.get_session(request.values.get('upload'))
+    if not any(session.filename.endswith(ext) for ext in allowed_extension):
+        raise Exception('Invalid uploaded file %s' % session.filename)
+    receiver = chunked.assemble(session.uuid)
+    request.upload_receivers.append(receiver)
+    return receiver, receiver.filename
+
+
+def clean_upload_receivers(keep=None):
+    """
+    Remove the upload folders of the files received by the request, except the one of the package kept by the build.
+    """
+    for receiver in request.upload_receivers:
+        if receiver is not keep:
+            receiver.clean()
+
+
+def discard_build_requests(build_requests):
+    """
+    Remove build requests which could not be queued, and their upload stored in the database.
+    """
+    try:
+        for build_request in build_requests:
+            if build_request.upload:
+                build_request.upload.delete()
+            if build_request.pk:
+                build_request.delete()
+    except Exception:
+        log.exception("Error while removing build requests which could not be queued")
 
 
 @app.route('/')
@@ -106,48 +179,467 @@ def howto():
     return render_template('howto.html', title="%s - Docker image Builder" % APP_NAME, app_name=APP_NAME)
 
 
+def int_arg(name, default):
+    """
+    Integer query parameter, or default if it is missing or invalid.
+    """
+    try:
+        return int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def image_filters():
+    return dict((key, request.args.get(key)) for key in ('name', 'tag', 'job', 'fingerprint') if request.args.get(key))
+
+
 @app.route('/list')
 def listimage():
-    # TODO: refresh tags and name (latest might not be latest anymore)
-    image_list = DockerImage.objects().to_safe_dict()
-    return render_template('list.html', title="%s - Docker image Builder" % APP_NAME, image_list=image_list, app_name=APP_NAME)
+    filters = image_filters()
+    image_list, next_cursor = catalog.list_images(cursor=request.args.get('cursor'),
+                                                  limit=int_arg('limit', 50), **filters)
+    next_url = url_for('listimage', cursor=next_cursor, **filters) if next_cursor else None
+    return render_template('list.html', title="%s - Docker image Builder" % APP_NAME, image_list=image_list,
+                           filters=filters, next_url=next_url, app_name=APP_NAME)
+
+
+@app.route('/images')
+@serialize
+def image_list():
+    """
+    Images, most recent first, filtered by name prefix, tag, job type or fingerprint, and paginated with cursors.
+    """
+    filters = image_filters()
+    images, next_cursor = catalog.list_images(cursor=request.args.get('cursor'),
+                                              limit=int_arg('limit', 50), **filters)
+    return {
+        'images': images,
+        'next': url_for('image_list', cursor=next_cursor, **filters) if next_cursor else None
+    }
+
+
+@app.route('/images/<image_uuid>')
+@serialize
+def image_detail(image_uuid):
+    image = catalog.get_image(image_uuid)
+    if not image:
+        abort(404)
+    return image
+
+
+@app.route('/images/<image_uuid>/manifest')
+@serialize
+def image_manifest(image_uuid):
+    """
+    Source tree manifest of an image : path, sha256, size and mode of each uploaded file (target of symbolic links).
+    Builds can then upload only changed files, with the image uuid as base and the list of deleted paths.
+    """
+    entries = sources.get_manifest(image_uuid)
+    if entries is None:
+        abort(404)
+    return {'image': image_uuid, 'files': entries}
+
+
+@app.route('/images/<image_uuid>/dockerfile')
+def image_dockerfile(image_uuid):
+    image = DockerImage.objects(uuid=image_uuid).only('dockerfile').first()
+    if not image:
+        abort(404)
+    return Response(image.dockerfile or '', mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=Dockerfile'})
 
 
 @app.route('/build', methods=('POST',))
 @serialize
 def build():
     log.info("Build request received")
-    if 'package' not in request.files:
-        flash('No file part')
-        return redirect(request.url)
-
-    ws_sid = request.values.get('sid', '').strip()
-
-    package_file = request.files.get('package')
-    image_name = request.values.get('name').strip()
-    imports = list(filter(None, request.values.get('imports', '').split(' ')))
-    requirements = list(filter(None, request.values.get('pip', '').split(' ')))
-    apt_packages = list(filter(None, request.values.get('apt', '').split(' ')))
-    tags = list(filter(None, request.values.get('tags', '').split(' ')))
-    full_log = []
-
-    def on_log_debug(msg):
-        full_log.append(msg)
-        if ws_sid:
-            socketio.emit('debug message', {'message': msg}, room=ws_sid)
-
-    def on_log_progress(msg):
-        full_log.append(msg)
-        if ws_sid:
-            socketio.emit('progress message', {'message': msg}, room=ws_sid)
+    build_requests = []
+    try:
+        if 'package' not in request.files and not request.values.get('upload'):
+            clean_upload_receivers()
+            flash('No file part')
+            return redirect(request.url)
+        base_image = request.values.get('base', '').strip() or None
+        deleted = sources.parse_deleted(request.values.get('deleted'))
+        receiver, filename = get_uploaded_package(ARCHIVE_EXTENSIONS if base_image else ALLOWED_EXTENSIONS)
+        if base_image and not SourceTree.objects(uuid=base_image).count():
+            raise Exception("No source tree stored for image %s, a full upload is needed." % base_image)
+        build_request = BuildRequest(
+            name=request.values.get('name').strip(),
+            filename=filename,
+            base_image=base_image,
+            deleted=deleted,
+            upload_node=builds.NODE_NAME,
+            upload_folder=receiver.folder,
+            package_folder=receiver.package_folder,
+            archive=None if base_image else receiver.archive,
+            imports=value_list(request.values.get('imports')),
+            requirements=value_list(request.values.get('pip')),
+            apt_packages=value_list(request.values.get('apt')),
+            tags=value_list(request.values.get('tags')),
+            sid=request.values.get('sid', '').strip()
+        )
+        build_requests.append(build_request)
+        if builds.SHARED_UPLOADS:
+            with open(receiver.path, 'rb') as f:
+                build_request.upload.put(f, filename=filename, build=build_request.uuid)
+            build_request.upload_shared = True
+        build_request.save()
+    except Exception as e:
+        log.exception("Error while saving uploaded file...")
+        clean_upload_receivers()
+        discard_build_requests(build_requests)
+        return {
+            'result': "error",
+            'message': str(e),
+            'details': ''.join(traceback.format_exception(*sys.exc_info()))
+        }
+    clean_upload_receivers(keep=receiver)
+    log.info("File %s saved. Queuing build..." % filename)
+
+    build_queue.put(build_request.uuid)
+
+    return {
+        'build': build_request.uuid,
+        'status': build_request.status,
+        'file': filename,
+        'result': "queued",
+        'message': "Build %s queued." % build_request.uuid,
+        'url': url_for('build_status', build_uuid=build_request.uuid)
+    }
+
+
+def value_list(value):
+    """
+    List of values from a space separated form field, or from a JSON list.
+    """
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return list(filter(None, (value or '').split(' ')))
+
 
+def parse_image_specs(value):
+    """
+    Parse the images of a batch build : a JSON list of {name, imports, tags, pip, apt} objects.
+    """
     try:
-        package_folder, filename = save_uploaded_file(package_file)
+        specs = json.loads(value or '')
+    except ValueError as e:
+        raise Exception("Invalid images list, JSON expected : %s" % e)
+    if not isinstance(specs, list) or not specs:
+        raise Exception("Invalid images list, a non empty JSON list is expected.")
+    if len(specs) > BATCH_MAX_IMAGES:
+        raise Exception("Too many images in batch : %d, maximum is %d." % (len(specs), BATCH_MAX_IMAGES))
+    names = set()
+    for spec in specs:
+        if not isinstance(spec, dict) or not str(spec.get('name') or '').strip():
+            raise Exception("Invalid images list, each image needs a name.")
+        name = str(spec['name']).strip()
+        if not value_list(spec.get('imports')):
+            raise Exception("Image %s has no imports." % name)
+        if name in names:
+            raise Exception("Image %s is listed twice." % name)
+        names.add(name)
+    return specs
+
+
+@app.route('/build/batch', methods=('POST',))
+@serialize
+def build_batch():
+    """
+    Build several images from one uploaded package, listed in the images field.
+    The package is uploaded and extracted once, and one build sharing it is queued for each image.
+    pip and apt fields are added to the requirements of all images.
+    """
+    log.info("Batch build request received")
+    batch = tbx.text.random_short_slug()
+    build_requests = []
+    try:
+        specs = parse_image_specs(request.values.get('images'))
+        receiver, filename = get_uploaded_package()
+        build_requests = [BuildRequest(
+            name=str(spec['name']).strip(),
+            filename=filename,
+            batch=batch,
+            upload_node=builds.NODE_NAME,
+            upload_folder=receiver.folder,
+            package_folder=receiver.package_folder,
+            archive=receiver.archive,
+            imports=value_list(spec.get('imports')),
+            requirements=value_list(request.values.get('pip')) + value_list(spec.get('pip')),
+            apt_packages=value_list(request.values.get('apt')) + value_list(spec.get('apt')),
+            tags=value_list(spec.get('tags')),
+            sid=request.values.get('sid', '').strip()
+        ) for spec in specs]
+        if builds.SHARED_UPLOADS:
+            with open(receiver.path, 'rb') as f:
+                build_requests[0].upload.put(f, filename=filename, batch=batch)
+            for build_request in build_requests:
+                build_request.upload = build_requests[0].upload
+                build_request.upload_shared = True
+        for build_request in build_requests:
+            build_request.save()
+    except Exception as e:
+        log.exception("Error while saving uploaded file...")
+        clean_upload_receivers()
+        discard_build_requests(build_requests)
+        return {
+            'result': "error",
+            'message': str(e),
+            'details': ''.join(traceback.format_exception(*sys.exc_info()))
+        }
+    clean_upload_receivers(keep=receiver)
+    log.info("File %s saved. Queuing %d builds of batch %s..." % (filename, len(build_requests), batch))
+
+    build_queue.put(batch)
+
+    return {
+        'batch': batch,
+        'file': filename,
+        'result': "queued",
+        'message': "Batch %s queued, %d images." % (batch, len(build_requests)),
+        'builds': [{
+            'build': build_request.uuid,
+            'name': build_request.name,
+            'url': url_for('build_status', build_uuid=build_request.uuid)
+        } for build_request in build_requests],
+        'url': url_for('batch_status', batch=batch)
+    }
+
+
+@app.route('/build/batch/<batch>')
+@serialize
+def batch_status(batch):
+    """
+    Status of a batch build, with the status and result of each image build.
+    """
+    build_requests = list(BuildRequest.objects(batch=batch).exclude('upload', 'log').order_by('created'))
+    if not build_requests:
+        abort(404)
+    statuses = [build_request.status for build_request in build_requests]
+    if all(status in builds.FINISHED_STATUSES for status in statuses):
+        status = 'error' if 'error' in statuses else 'success'
+    else:
+        status = 'running' if any(status != 'queued' for status in statuses) else 'queued'
+    results = []
+    for build_request in build_requests:
+        result = build_request.to_safe_dict()
+        result.pop('upload', None)
+        result.pop('log', None)
+        results.append(result)
+    return {
+        'batch': batch,
+        'status': status,
+        'counts': dict((s, statuses.count(s)) for s in set(statuses)),
+        'builds': results
+    }
+
+
+@app.route('/uploads', methods=('POST',))
+@serialize
+def upload_create():
+    """
+    Create a chunked upload of a package, given its filename, size, and optionally chunk_size and sha256.
+    Chunks are then sent with PUT /uploads/<upload ID>/<chunk index> (X-Chunk-Sha256 header optional), in any order,
+    and the upload ID is given as upload field to /build or /build/batch instead of the package file.
+    """
+    try:
+        session = chunked.create_session(request.values.get('filename'), request.values.get('size'),
+                                         chunk_size=request.values.get('chunk_size'), sha256=request.values.get('sha256'))
+    except Exception as e:
+        return {'result': "error", 'message': str(e)}
+    return dict(chunked.session_status(session), result="created", url=url_for('upload_status', upload_uuid=session.uuid))
+
+
+@app.route('/uploads/<upload_uuid>', methods=('GET', 'DELETE'))
+@serialize
+def upload_status(upload_uuid):
+    """
+    Status of a chunked upload : committed and missing chunks, so that an interrupted upload can be resumed.
+    """
+    session = UploadSession.objects(uuid=upload_uuid).first()
+    if not session:
+        abort(404)
+    if request.method == 'DELETE':
+        chunked.delete_session(upload_uuid)
+        return {'upload': upload_uuid, 'result': "deleted"}
+    return chunked.session_status(session)
+
+
+@app.route('/uploads/<upload_uuid>/<int:index>', methods=('PUT',))
+@serialize
+def upload_chunk(upload_uuid, index):
+    try:
+        session = chunked.put_chunk(upload_uuid, index, request.get_data(cache=False), request.headers.get('X-Chunk-Sha256'))
+    except Exception as e:
+        return {'result': "error", 'message': str(e)}
+    return {'upload': upload_uuid, 'chunk': index, 'result': "committed", 'committed': len(set(session.committed))}
+
+
+@app.route('/build/<build_uuid>')
+@serialize
+def build_status(build_uuid):
+    build_request = BuildRequest.objects(uuid=build_uuid).first()
+    if not build_request:
+        abort(404)
+    result = build_request.to_safe_dict()
+    result.pop('upload', None)
+    result.pop('log', None)
+    if build_request.status == 'queued':
+        result['queue_position'] = BuildRequest.objects(status='queued', created__lt=build_request.created).count()
+    return result
+
 
-        log.info("File %s saved. Validating package, testing imports, requirements, etc..." % filename)
+@app.route('/build/<build_uuid>/log')
+def build_log_file(build_uuid):
+    """
+    Full log of a build, as plain text. HTTP Range requests are supported, and ?tail=N returns the last N lines.
+    Logs of finished builds are served from the database, logs of running builds only by the node running them.
+    """
+    build_request = BuildRequest.objects(uuid=build_uuid).only('log_file', 'log').first()
+    if not build_request:
+        abort(404)
+    if build_request.log:
+        stored = build_request.log.get()
+        if request.args.get('tail'):
+            return Response(buildlog.read_tail(stored, int_arg('tail', 100)), mimetype='text/plain')
+        response = Response(wrap_file(request.environ, stored), mimetype='text/plain', direct_passthrough=True)
+        response.content_length = stored.length
+        response.last_modified = stored.upload_date
+        response.set_etag(str(stored._id))
+        return response.make_conditional(request, accept_ranges=True, complete_length=stored.length)
+    if not build_request.log_file or not os.path.isfile(build_request.log_file):
+        abort(404)
+    if request.args.get('tail'):
+        with open(build_request.log_file, 'rb') as f:
+            return Response(buildlog.read_tail(f, int_arg('tail', 100)), mimetype='text/plain')
+    return send_file(build_request.log_file, mimetype='text/plain', conditional=True)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/gc')
+@serialize
+def gc_report():
+    """
+    Report of the last garbage collection of this builder node : disk usage, removed items and reclaimed bytes.
+    """
+    if not garbage_collector:
+        return {'result': "error", 'message': "Garbage collection is disabled."}
+    return garbage_collector.last_report or {'result': "pending", 'message': "No garbage collection ran yet."}
 
-        docker_builder = lib.DockerBuilder(package_folder, image_name, tags, imports, requirements, apt_packages,
-                                           logger=log, on_log_debug=on_log_debug, on_log_progress=on_log_progress)
+
+@app.route('/builds')
+@serialize
+def build_list():
+    limit = int_arg('limit', 50)
+    return BuildRequest.objects().exclude('result', 'upload', 'log').order_by('-created').limit(limit).to_safe_dict()
+
+
+def emit_to_rooms(rooms, event, data):
+    """
+    Emit an event to rooms of build events : the session of the client which requested the build, if any, then the
+    build room. The requesting client can also join the build room, so it is skipped there to get each event once.
+    """
+    for i, room in enumerate(rooms):
+        socketio.emit(event, data, room=room, skip_sid=rooms[0] if i else None)
+
+
+def emit_build_event(build_request, event, data):
+    """
+    Send a build event to websocket clients connected to this node, and publish it for the other builder nodes.
+    """
+    rooms = list(filter(None, (build_request.sid, build_request.uuid)))
+    data = dict(data, build=build_request.uuid)
+    emit_to_rooms(rooms, event, data)
+    try:
+        builds.publish_event(build_request.uuid, rooms, event, data)
+    except Exception:
+        log.exception("Error while publishing build event")
+
+
+def find_image_by_fingerprint(fingerprint):
+    """
+    Get the last DockerImage built from a package with this fingerprint.
+    """
+    info = DockerImageInfo.objects(fingerprint=fingerprint).order_by('-updated').first()
+    if not info:
+        return None
+    return DockerImage.objects(uuid=info.uuid).first()
+
+
+def get_package(build_request):
+    """
+    Get the uploaded package of a build request on this node : the upload folder if it was received here, or else
+    the upload stored in the database, extracted again.
+    :return: tuple (upload folder, package folder, archive)
+    """
+    if build_request.upload_node in (None, builds.NODE_NAME) and build_request.package_folder and os.path.isdir(build_request.package_folder):
+        return build_request.upload_folder, build_request.package_folder, build_request.archive
+    if not build_request.upload_shared:
+        raise Exception("Uploaded package of build %s is only available on node %s." % (build_request.uuid, build_request.upload_node))
+    receiver = upload.UploadReceiver(build_request.filename)
+    try:
+        stored = build_request.upload.get()
+        while True:
+            chunk = stored.read(1024 * 1024)
+            if not chunk:
+                break
+            receiver.write(chunk)
+        receiver.finish()
+    except Exception:
+        receiver.clean()
+        raise
+    return receiver.folder, receiver.package_folder, receiver.archive
+
+
+def store_build_log(build_request):
+    """
+    Store the log file of a finished build in the database, so that every builder node serves it.
+    :return: True if it was stored
+    """
+    try:
+        with open(build_request.log_file, 'rb') as f:
+            build_request.log.put(f, filename=os.path.basename(build_request.log_file), content_type='text/plain',
+                                  build=build_request.uuid)
+        return True
+    except Exception:
+        log.exception("Error while storing log of build %s" % build_request.uuid)
+        return False
+
+
+def process_build(build_request):
+    """
+    Validate, build and push the image of a build request. Called by build queue workers, once the build is claimed.
+    """
+    build_uuid = build_request.uuid
+    build_request.modify(log_file=buildlog.get_log_path(build_uuid))
+    metrics.observe('jobmanager_builder_queue_wait_seconds', (build_request.started - build_request.created).total_seconds())
+
+    image_name = build_request.name
+    build_log = buildlog.BuildLog(build_request.log_file, lambda event, data: emit_build_event(build_request, event, data))
+    on_log_debug = build_log.debug
+    on_log_progress = build_log.progress
+    on_log_progress("Build %s started on node %s (attempt %d)." % (build_uuid, builds.NODE_NAME, build_request.attempts))
+
+    upload_folder = None
+    try:
+        upload_folder, package_folder, archive = get_package(build_request)
+        if build_request.base_image:
+            stats = sources.apply_delta(build_request.base_image, package_folder, build_request.deleted)
+            on_log_progress("Delta upload applied on source tree of image %s : %d files reused, %d replaced, %d paths deleted." % (
+                build_request.base_image, stats['added'], stats['replaced'], stats['deleted']))
+        log.info("Build %s - Validating package, testing imports, requirements, etc..." % build_uuid)
+
+        docker_builder = lib.DockerBuilder(package_folder, image_name, build_request.tags,
+                                           build_request.imports, build_request.requirements,
+                                           build_request.apt_packages, logger=log,
+                                           on_log_debug=on_log_debug, on_log_progress=on_log_progress,
+                                           image_lookup=find_image_by_fingerprint, archive=archive,
+                                           dependency_images=True if build_request.batch else None)
         docker_image = docker_builder.build()
 
         log.info("Saving image to database...")
@@ -166,32 +658,104 @@ def build():
             updated=datetime.datetime.utcnow()
         )
 
+        image_info = {
+            'fingerprint': docker_builder.fingerprint,
+            'image_size': docker_builder.image_size,
+            'timings': docker_builder.timings,
+            'push_timings': [{'tag': t, 'seconds': d} for t, d in sorted(docker_builder.push_timings.items())],
+            'builder_version': lib.get_builder_version()
+        }
+        if docker_builder.context_size is not None:
+            image_info.update(context_size=docker_builder.context_size, context_files=docker_builder.context_files)
+        DockerImageInfo.objects(uuid=img.uuid).modify(upsert=True, updated=datetime.datetime.utcnow(), **image_info)
+
         log.info("Success! Image %s saved to database! ID=%s" % (image_name, img.uuid))
 
+        if sources.STORE_SOURCE_TREES:
+            try:
+                stats = sources.save_tree(img.uuid, package_folder)
+                log.info("Source tree of image %s saved : %d files, %d new blobs (%.1f MB)." % (
+                    img.uuid, stats['files'], stats['stored_blobs'], stats['stored_size'] / 1048576.0))
+            except Exception:
+                log.exception("Error while saving source tree of image %s" % img.uuid)
+
         # removing previously tagged images :
         log.info("Removing tags set to this image from other images.")
-        DockerImage.objects(uuid__ne=img.uuid).update(pull_all__tags=docker_image.tags)
-        DockerImage.objects(name__in=docker_image.tags, uuid__ne=img.uuid).update(name="")
+        catalog.reassign_tags(img.uuid, docker_image.tags)
 
         result = img.to_safe_dict()
         result.update({
-            'file': filename,
+            'build': build_uuid,
+            'file': build_request.filename,
+            'fingerprint': docker_builder.fingerprint,
+            'context_size': docker_builder.context_size,
+            'context_files': docker_builder.context_files,
+            'timings': docker_builder.timings,
             'result': "success",
             'message': "Success! Image build OK!",
-            'details': '\n'.join(full_log)
+            'details': '\n'.join(build_log.tail()),
+            'log': '/build/%s/log' % build_uuid
         })
     except Exception as e:
         log.info("\nERROR %s\n" % str(e))
         result = {
+            'build': build_uuid,
             'result': "error",
             'message': str(e),
-            'details': ('\n'.join(full_log)) + ''.join(traceback.format_exception(*sys.exc_info()))
+            'details': ('\n'.join(build_log.tail())) + ''.join(traceback.format_exception(*sys.exc_info())),
+            'log': '/build/%s/log' % build_uuid
         }
         log.exception("Error while building image...")
     finally:
-        shutil.rmtree(package_folder, ignore_errors=True)
-
-    return result
+        if upload_folder and not (build_request.batch and upload_folder == build_request.upload_folder):
+            shutil.rmtree(upload_folder, ignore_errors=True)  # uploads shared by a batch are removed by the build queue
+        build_log.close()
+
+    metrics.inc('jobmanager_builder_builds_total', {'result': result['result']})
+    metrics.observe('jobmanager_builder_build_seconds', (datetime.datetime.utcnow() - build_request.started).total_seconds())
+    log_stored = store_build_log(build_request)
+    if not build_request.modify(
+        query=build_queue.owned(build_request),
+        status=result['result'],
+        message=result['message'],
+        image_uuid=result.get('uuid'),
+        result=result,
+        finished=datetime.datetime.utcnow(),
+        updated=datetime.datetime.utcnow()
+    ):
+        log.warning("Build %s lease was lost while building, result discarded." % build_uuid)
+        if log_stored:
+            build_request.log.delete()
+        return
+    if log_stored:
+        BuildRequest._get_collection().update_one({'_id': build_request.pk}, {'$set': {'log': build_request.log.grid_id}})
+        try:
+            os.remove(build_request.log_file)
+        except OSError:
+            pass
+    emit_build_event(build_request, 'build finished', {'result': result['result'], 'message': result['message']})
+
+
+def start_build_queue():
+    """
+    Start build workers, sharing the build queue with other builder nodes, and relay their build events.
+    Builds this node was running before a restart are queued again.
+    """
+    global build_queue, event_relay
+    build_queue = builds.BuildQueue(process_build, workers=BUILD_WORKERS, logger=log)
+    build_queue.start()
+    event_relay = builds.EventRelay(emit_to_rooms, logger=log)
+    event_relay.start()
+
+
+def start_garbage_collector():
+    """
+    Start periodic garbage collection of images, build caches and temporary folders of this node.
+    """
+    global garbage_collector
+    if housekeeping.GC_INTERVAL:
+        garbage_collector = housekeeping.GarbageCollector(logger=log)
+        garbage_collector.start()
 
 
 ###
@@ -234,6 +798,13 @@ def page_not_found(e):
 def run_api(host='0.0.0.0', port=5001, debug=False):
 
     app.add_url_rule('/favicon.ico', endpoint='favicon', redirect_to='/static/favicon.ico')
+    app.config['MAX_CONTENT_LENGTH'] = upload.UPLOAD_MAX_SIZE + 1024 * 1024  # form fields margin
+
+    catalog.ensure_indexes()
+    metrics.set_function('jobmanager_builder_queued_builds', lambda: build_queue.size())
+    metrics.set_function('jobmanager_builder_venv_cache_bytes', lambda: sum(e[1] for e in lib.get_venv_cache().entries()))
+    start_build_queue()
+    start_garbage_collector()
 
     socketio.run(app, host=host, port=port, debug=debug)
     logging.info('Flask App exited gracefully, exiting...')
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Build logs
+:author: Ronan Delacroix
+"""
+import os
+import tempfile
+import threading
+import collections
+
+BUILD_LOG_FOLDER = os.path.join(tempfile.gettempdir(), "jobmanager-builder", "logs")  # logs of running builds
+FLUSH_INTERVAL = 0.25  # seconds debug lines are held before being emitted
+BATCH_MAX_LINES = 500
+BATCH_MAX_SIZE = 64 * 1024  # bytes
+RING_SIZE = 2000  # last lines kept in memory
+
+
+def get_log_path(build_uuid):
+    return os.path.join(BUILD_LOG_FOLDER, "%s.log" % build_uuid)
+
+
+class BuildLog:
+    """
+    Log of a build : every line is written to a log file and the last ones are kept in a ring buffer.
+    Debug lines are sent by batch, when FLUSH_INTERVAL is elapsed or the batch is full, with emit(event, data).
+    Progress lines are sent right away, after pending debug lines so that order is kept.
+    """
+    def __init__(self, path, emit):
+        self.path = path
+        self.emit = emit
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8', errors='replace')
+        self.ring = collections.deque(maxlen=RING_SIZE)
+        self.pending = []
+        self.pending_size = 0
+        self.lines = 0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="build-log", daemon=True)
+        self.thread.start()
+
+    def write(self, msg):
+        self.file.write(msg + '\n')
+        self.ring.append(msg)
+        self.lines += 1
+
+    def debug(self, msg):
+        with self.lock:
+            self.write(msg)
+            self.pending.append(msg)
+            self.pending_size += len(msg)
+            if len(self.pending) >= BATCH_MAX_LINES or self.pending_size >= BATCH_MAX_SIZE:
+                self.send_pending()
+
+    def progress(self, msg):
+        with self.lock:
+            self.write(msg)
+            self.send_pending()
+            self.emit('progress message', {'message': msg})
+
+    def send_pending(self):
+        if self.pending:
+            self.emit('debug message', {'message': '\n'.join(self.pending), 'lines': len(self.pending)})
+            self.pending = []
+            self.pending_size = 0
+        self.file.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self.send_pending()
+
+    def run(self):
+        while not self.closed.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def tail(self):
+        """
+        Last lines of the log, at most RING_SIZE.
+        """
+        with self.lock:
+            lines = list(self.ring)
+            if self.lines > len(lines):
+                lines.insert(0, "[%d earlier lines in full build log]" % (self.lines - len(lines)))
+            return lines
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        with self.lock:
+            self.send_pending()
+            self.file.close()
+
+
+def read_tail(f, lines):
+    """
+    Read the last lines of a log, from a seekable binary file object, without reading the whole log.
+    """
+    block_size = 64 * 1024
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    data = b''
+    while position > 0 and data.count(b'\n') <= lines:
+        size = min(block_size, position)
+        position -= size
+        f.seek(position)
+        data = f.read(size) + data
+    return b'\n'.join(data.rstrip(b'\n').split(b'\n')[-lines:]).decode('utf-8', errors='replace') if lines > 0 else ''
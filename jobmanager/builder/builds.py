@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Build queue, shared by builder nodes through the database
+:author: Ronan Delacroix
+"""
+import time
+import shutil
+import socket
+import logging
+import datetime
+import threading
+import pymongo
+from mongoengine.queryset.visitor import Q
+from .models import BuildRequest, BuildEvent
+
+NODE_NAME = socket.gethostname()  # must be unique among builder nodes sharing a database
+LEASE_DURATION = 60  # seconds a claimed build stays owned by a node without heartbeat
+HEARTBEAT_INTERVAL = 15  # seconds between lease renewals, expired leases reclaim and upload cleanup
+POLL_INTERVAL = 2  # seconds idle workers wait before looking for queued builds again
+MAX_ATTEMPTS = 3  # times a build is started before being set in error when its lease keeps expiring
+SHARED_UPLOADS = False  # store uploads in the database so that builds can be processed by any node
+
+FINISHED_STATUSES = ('success', 'error')
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+class BuildQueue:
+    """
+    Build queue stored in the database and shared by builder nodes.
+    Queued build requests are claimed in submission order by the worker threads of any node, with a lease renewed by
+    heartbeats. Builds whose lease expired (node stopped or unreachable) are queued again, up to MAX_ATTEMPTS times.
+    Claimed build requests are given to process_function.
+    """
+    def __init__(self, process_function, workers=2, logger=None):
+        assert callable(process_function)
+        self.process_function = process_function
+        self.workers = workers
+        self.logger = logger or logging.getLogger()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.running = {}  # build uuid -> attempt
+        self.threads = []
+
+    def start(self):
+        self.recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="build-worker-%d" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self.maintain, name="build-heartbeat", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        self.logger.info("Build queue started with %d workers on node %s." % (self.workers, NODE_NAME))
+
+    def stop(self):
+        """
+        Stop workers once their current build is done.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def put(self, build_uuid):
+        """
+        Wake up idle workers of this node : a build request was just queued.
+        """
+        self.wakeup.set()
+
+    def size(self):
+        return BuildRequest.objects(status='queued').count()
+
+    def claim(self):
+        """
+        Atomically take the oldest queued build request this node can process.
+        :return: claimed BuildRequest or None
+        """
+        now = utcnow()
+        available = Q(upload_shared=True) | Q(upload_node=None) | Q(upload_node=NODE_NAME)
+        return BuildRequest.objects(Q(status='queued') & available).order_by('created').modify(
+            new=True,
+            status='running',
+            node=NODE_NAME,
+            started=now,
+            lease_expires=now + datetime.timedelta(seconds=LEASE_DURATION),
+            inc__attempts=1
+        )
+
+    def owned(self, build_request):
+        """
+        Query of a build request, matching only while this node still holds the lease of its current attempt.
+        """
+        return {'node': NODE_NAME, 'attempts': build_request.attempts, 'status': 'running'}
+
+    def work(self):
+        while not self.stopped.is_set():
+            try:
+                build_request = self.claim()
+            except Exception:
+                self.logger.exception("Error while claiming a queued build")
+                build_request = None
+            if not build_request:
+                self.wakeup.wait(POLL_INTERVAL)
+                self.wakeup.clear()
+                continue
+            with self.lock:
+                self.running[build_request.uuid] = build_request.attempts
+            try:
+                self.process_function(build_request)
+            except Exception:
+                self.logger.exception("Unexpected error while processing build %s" % build_request.uuid)
+            finally:
+                with self.lock:
+                    self.running.pop(build_request.uuid, None)
+
+    def maintain(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            for task in (self.heartbeat, self.reclaim, self.clean_uploads):
+                try:
+                    task()
+                except Exception:
+                    self.logger.exception("Error during build queue %s" % task.__name__)
+
+    def heartbeat(self):
+        """
+        Renew leases of builds running on this node.
+        """
+        with self.lock:
+            running = dict(self.running)
+        lease_expires = utcnow() + datetime.timedelta(seconds=LEASE_DURATION)
+        for build_uuid, attempts in running.items():
+            if not BuildRequest.objects(uuid=build_uuid, node=NODE_NAME, attempts=attempts, status='running').update(lease_expires=lease_expires):
+                self.logger.warning("Build %s lease lost, it may be processed again by another node." % build_uuid)
+
+    def reclaim(self):
+        """
+        Queue again running builds whose lease expired, or set them in error after MAX_ATTEMPTS attempts.
+        """
+        now = utcnow()
+        expired = Q(status='running') & (Q(lease_expires__lt=now) | Q(lease_expires=None))
+        retried = BuildRequest.objects(expired & Q(attempts__lt=MAX_ATTEMPTS)).update(
+            status='queued', unset__node=True, unset__lease_expires=True, updated=now)
+        message = "Build lease expired %d times, builder nodes stopped while building it." % MAX_ATTEMPTS
+        failed = BuildRequest.objects(expired).update(
+            status='error', message=message, result={'result': "error", 'message': message, 'details': ''},
+            finished=now, updated=now)
+        if retried or failed:
+            self.logger.warning("Expired build leases : %d builds queued again, %d set in error." % (retried, failed))
+            self.wakeup.set()
+
+    def recover(self):
+        """
+        Builds left running by a previous run of this node are reclaimed right away.
+        """
+        BuildRequest.objects(status='running', node=NODE_NAME).update(lease_expires=utcnow())
+        self.reclaim()
+
+    def clean_uploads(self):
+        """
+        Remove uploads of finished builds : local upload folders of this node, and uploads stored in the database.
+        Uploads of a batch are removed once all its builds are finished.
+        """
+        for build_request in BuildRequest.objects(status__in=FINISHED_STATUSES, upload_node=NODE_NAME,
+                                                  upload_folder__ne=None).only('uuid', 'batch', 'upload_folder'):
+            if build_request.batch and BuildRequest.objects(batch=build_request.batch, upload_folder=build_request.upload_folder,
+                                                            status__nin=FINISHED_STATUSES).count():
+                continue
+            shutil.rmtree(build_request.upload_folder, ignore_errors=True)
+            build_request.modify(upload_folder=None)
+        for build_request in BuildRequest.objects(status__in=FINISHED_STATUSES, upload_shared=True).only('uuid', 'batch'):
+            if build_request.batch and BuildRequest.objects(batch=build_request.batch, status__nin=FINISHED_STATUSES).count():
+                continue
+            stored = BuildRequest.objects(uuid=build_request.uuid, upload_shared=True).only('upload').modify(upload_shared=False)
+            if stored and stored.upload and not (build_request.batch and BuildRequest.objects(batch=build_request.batch, upload_shared=True).count()):
+                stored.upload.delete()
+
+
+def publish_event(build_uuid, rooms, event, data):
+    """
+    Store a build progress event, for the websocket clients connected to other builder nodes.
+    """
+    BuildEvent._get_collection().insert_one({
+        'build': build_uuid,
+        'rooms': rooms,
+        'event': event,
+        'data': data,
+        'node': NODE_NAME
+    })
+
+
+class EventRelay:
+    """
+    Follow build progress events published by other builder nodes, and give them to emit(rooms, event, data).
+    """
+    def __init__(self, emit, logger=None):
+        assert callable(emit)
+        self.emit = emit
+        self.logger = logger or logging.getLogger()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="build-events", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        collection = BuildEvent._get_collection()
+        last = collection.find_one(sort=[('$natural', -1)], projection=['_id'])
+        last_id = last['_id'] if last else None
+        while True:
+            try:
+                query = {'node': {'$ne': NODE_NAME}}
+                if last_id:
+                    query['_id'] = {'$gt': last_id}
+                cursor = collection.find(query, cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        last_id = event['_id']
+                        self.emit(event['rooms'], event['event'], event['data'])
+            except Exception:
+                self.logger.exception("Error while following build events")
+            time.sleep(POLL_INTERVAL)  # tailable cursors die right away on empty collections
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Build caches
+:author: Ronan Delacroix
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+VENV_MARKER = ".jobmanager-venv"
+
+
+PIP_VALUE_OPTIONS = ['-i', '--index-url', '--extra-index-url', '-f', '--find-links', '-r', '--requirement',
+                     '-c', '--constraint', '-e', '--editable', '--trusted-host', '--no-binary', '--only-binary',
+                     '--platform', '--python-version', '--implementation', '--abi', '--src', '--progress-bar']
+
+
+def normalize_requirements(requirements):
+    """
+    Normalize a pip requirement list : strip spaces, normalize project names (PEP 503), remove duplicates and sort.
+    Options (-i URL, -r FILE...) are kept first with their values, in their order. Urls and paths are kept as they are.
+    """
+    options = []
+    normalized = set()
+    value_expected = False
+    for req in requirements:
+        req = req.strip()
+        if not req:
+            continue
+        if value_expected or req.startswith('-'):
+            options.append(req)
+            value_expected = not value_expected and req in PIP_VALUE_OPTIONS
+            continue
+        match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$', req)
+        if match and '://' not in req and '/' not in req and not re.search(r'\.(whl|zip|tar\.gz|tgz|txt)$', req):
+            req = re.sub(r'[-_.]+', '-', match.group(1)).lower() + match.group(2).replace(' ', '')
+        normalized.add(req)
+    return options + sorted(normalized)
+
+
+def folder_size(folder):
+    """
+    Total size in bytes of files contained in folder (symlinks are not followed).
+    """
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class VirtualEnvCache:
+    """
+    Persistent cache of validation virtual envs.
+    Virtual envs are keyed by a hash of the normalized requirement list and the python version.
+    Least recently used virtual envs are evicted when the cache grows over max_size (in bytes).
+    If given, on_evict(path) is called before a virtual env is removed.
+    """
+    def __init__(self, folder, max_size, on_evict=None):
+        self.folder = folder
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.in_use = {}
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_key(self, requirements):
+        h = hashlib.sha256()
+        h.update(("%s %s" % (sys.implementation.cache_tag, sys.version)).encode('utf-8'))
+        for req in normalize_requirements(requirements):
+            h.update(b'\n' + req.encode('utf-8'))
+        return h.hexdigest()[:32]
+
+    def get_path(self, key):
+        return os.path.join(self.folder, key)
+
+    def is_complete(self, path):
+        return os.path.isfile(os.path.join(path, VENV_MARKER))
+
+    def acquire(self, requirements, create_function):
+        """
+        Get a ready to use virtual env for these requirements.
+        On cache miss, create_function(path) is called to create the virtual env in a temporary folder which is then
+        moved in the cache.
+        The virtual env is protected from eviction until released.
+        :return: tuple (virtual env path, cache hit boolean)
+        """
+        key = self.get_key(requirements)
+        path = self.get_path(key)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+        try:
+            with key_lock:
+                if self.is_complete(path):
+                    os.utime(os.path.join(path, VENV_MARKER))
+                    return path, True
+
+                shutil.rmtree(path, ignore_errors=True)
+                tmp_path = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.folder)
+                try:
+                    create_function(tmp_path)
+                    with open(os.path.join(tmp_path, VENV_MARKER), 'w') as f:
+                        json.dump({
+                            'requirements': normalize_requirements(requirements),
+                            'python': sys.version,
+                            'size': folder_size(tmp_path),
+                            'created': time.time()
+                        }, f)
+                    os.rename(tmp_path, path)
+                except OSError:
+                    if not self.is_complete(path):
+                        raise
+                    # Another builder process created it first.
+                finally:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+        except Exception:
+            self.release(path)
+            raise
+        self.evict()
+        return path, False
+
+    def release(self, path):
+        key = os.path.basename(path)
+        with self.lock:
+            count = self.in_use.get(key, 0) - 1
+            if count > 0:
+                self.in_use[key] = count
+            else:
+                self.in_use.pop(key, None)
+
+    def entries(self):
+        """
+        List cached virtual envs as tuples (last used timestamp, size, key), least recently used first.
+        """
+        entries = []
+        for key in os.listdir(self.folder):
+            marker = os.path.join(self.get_path(key), VENV_MARKER)
+            try:
+                with open(marker) as f:
+                    size = json.load(f).get('size', 0)
+                entries.append((os.stat(marker).st_mtime, size, key))
+            except (OSError, ValueError):
+                continue
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Remove least recently used virtual envs until the cache fits in max_size.
+        Virtual envs in use are never removed.
+        :return: amount of bytes reclaimed
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        reclaimed = 0
+        for last_used, size, key in entries:
+            if total <= self.max_size:
+                break
+            with self.lock:
+                if self.in_use.get(key):
+                    continue
+                if self.on_evict:
+                    self.on_evict(self.get_path(key))
+                shutil.rmtree(self.get_path(key), ignore_errors=True)
+            total -= size
+            reclaimed += size
+        return reclaimed
+
+
+def add_to_wheelhouse(wheel_folder, wheelhouse_folder):
+    """
+    Copy wheels built for a build into the shared wheelhouse. Existing wheels are kept.
+    Wheels are copied to a temporary name first so that concurrent builds never read a partial wheel.
+    :return: list of wheel file names added to the wheelhouse
+    """
+    os.makedirs(wheelhouse_folder, exist_ok=True)
+    added = []
+    for name in os.listdir(wheel_folder):
+        if not name.endswith('.whl') or os.path.exists(os.path.join(wheelhouse_folder, name)):
+            continue
+        tmp_path = os.path.join(wheelhouse_folder, '.%s.tmp' % name)
+        shutil.copyfile(os.path.join(wheel_folder, name), tmp_path)
+        os.replace(tmp_path, os.path.join(wheelhouse_folder, name))
+        added.append(name)
+    return added
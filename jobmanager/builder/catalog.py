@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Docker image catalog
+:author: Ronan Delacroix
+"""
+import json
+import base64
+import datetime
+import pymongo
+import mongoengine
+from bson import ObjectId
+from jobmanager.common import public_dict
+from jobmanager.common.docker import DockerImage
+from .models import DockerImageInfo
+
+# Fields returned by image lists, heavy ones (dockerfile, requirements...) are only returned by get_image
+LIST_FIELDS = ('uuid', 'image_id', 'name', 'tags', 'jobs', 'tasks', 'url', 'created', 'updated')
+LIST_MAX_LIMIT = 500
+
+
+def ensure_indexes():
+    """
+    Create the indexes used by the catalog. DockerImage schema is shared with other Job Manager components, so
+    indexes it does not declare are created here.
+    """
+    collection = DockerImage._get_collection()
+    collection.create_index('name', background=True)  # name prefix filters and tag reassignment
+    collection.create_index('tags', background=True)
+    collection.create_index('jobs', background=True)
+    collection.create_index([('created', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)], background=True)
+    DockerImageInfo.ensure_indexes()
+
+
+def encode_cursor(image):
+    data = json.dumps([image['created'].isoformat(), str(image['_id'])])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        created, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S.%f' if '.' in created else '%Y-%m-%dT%H:%M:%S'), ObjectId(object_id)
+    except Exception:
+        raise ValueError("Invalid cursor %s" % cursor)
+
+
+def list_images(name=None, tag=None, job=None, fingerprint=None, cursor=None, limit=50):
+    """
+    List images, most recent first, with LIST_FIELDS only.
+    :param name: image name prefix
+    :param tag: tag the image must have
+    :param job: job type the image must contain
+    :param fingerprint: package fingerprint the image was built from
+    :param cursor: next cursor returned by a previous call, to get the following page
+    :return: tuple (list of image dicts, next cursor or None on last page)
+    """
+    query = mongoengine.Q()
+    if name:
+        query &= mongoengine.Q(name__startswith=name)
+    if tag:
+        query &= mongoengine.Q(tags=tag)
+    if job:
+        query &= mongoengine.Q(jobs=job)
+    if fingerprint:
+        uuids = DockerImageInfo.objects(fingerprint=fingerprint).scalar('uuid')
+        query &= mongoengine.Q(uuid__in=list(uuids))
+    if cursor:
+        created, object_id = decode_cursor(cursor)
+        query &= mongoengine.Q(created__lt=created) | mongoengine.Q(created=created, id__lt=object_id)
+
+    limit = max(1, min(int(limit), LIST_MAX_LIMIT))
+    images = list(DockerImage.objects(query).only(*LIST_FIELDS).order_by('-created', '-id').limit(limit + 1).as_pymongo())
+    next_cursor = encode_cursor(images[limit - 1]) if len(images) > limit else None
+    return [public_dict(image) for image in images[:limit]], next_cursor
+
+
+def get_image(uuid):
+    """
+    Get all fields of an image, with its builder information, or None.
+    """
+    image = DockerImage.objects(uuid=uuid).first()
+    if not image:
+        return None
+    result = image.to_safe_dict()
+    info = DockerImageInfo.objects(uuid=uuid).exclude('id', 'uuid').first()
+    if info:
+        result['info'] = info.to_safe_dict()
+    return result
+
+
+def reassign_tags(image_uuid, tags):
+    """
+    Take tags away from images other than image_uuid, in a single bulk write.
+    Images named after one of these tags lose their name too.
+    """
+    if not tags:
+        return 0
+    result = DockerImage._get_collection().bulk_write([
+        pymongo.UpdateMany({'tags': {'$in': tags}, 'uuid': {'$ne': image_uuid}}, {'$pullAll': {'tags': tags}}),
+        pymongo.UpdateMany({'name': {'$in': tags}, 'uuid': {'$ne': image_uuid}}, {'$set': {'name': ''}}),
+    ], ordered=False)
+    return result.modified_count
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Import checker servers
+:author: Ronan Delacroix
+"""
+import os
+import json
+import logging
+import threading
+import subprocess
+from collections import OrderedDict
+
+PACKAGE_TESTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "package_tester.py")
+
+
+class ImportChecker:
+    """
+    Long lived package_tester server running in a virtual env.
+    jobmanager.common is imported once by the server, and each check runs in a forked child of it, so a check only
+    costs the import of the user modules.
+    """
+    def __init__(self, venv_folder, logger=None):
+        self.venv_folder = venv_folder
+        self.logger = logger or logging.getLogger()
+        self.process = None
+        self.lock = threading.RLock()  # a check in progress is never interrupted by stop
+
+    def start(self):
+        # -I : isolated mode, the package_tester folder (builder modules) must not be importable by user code
+        self.process = subprocess.Popen(
+            [os.path.join(self.venv_folder, "bin/python"), "-I", PACKAGE_TESTER, "--serve"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.venv_folder
+        )
+        ready = self.read_response()
+        if ready.get('result') != "ready":
+            raise Exception("Import checker of %s failed to start : %s" % (self.venv_folder, ready.get('error')))
+        self.logger.debug("Import checker started for %s (pid %s)" % (self.venv_folder, ready.get('pid')))
+
+    def read_response(self):
+        line = self.process.stdout.readline()
+        if not line:
+            self.stop()
+            return {"result": "error", "error": "Import checker process exited unexpectedly."}
+        return json.loads(line.decode('utf-8'))
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def check(self, root, handlers, timeout):
+        """
+        Import handler modules of package root folder.
+        :return: package_tester result dict
+        """
+        request = json.dumps({'root': root, 'handlers': handlers, 'timeout': timeout}) + '\n'
+        with self.lock:
+            for attempt in range(2):
+                if not self.is_running():
+                    self.start()
+                try:
+                    self.process.stdin.write(request.encode('utf-8'))
+                    self.process.stdin.flush()
+                except (BrokenPipeError, OSError):
+                    self.stop()
+                    continue  # server died since last check, start a new one
+                return self.read_response()
+        raise Exception("Import checker of %s is not working." % self.venv_folder)
+
+    def stop(self):
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+
+class ImportCheckerPool:
+    """
+    Import checkers by virtual env folder. Above max_size, least recently used checkers are stopped.
+    """
+    def __init__(self, max_size, logger=None):
+        self.max_size = max_size
+        self.logger = logger or logging.getLogger()
+        self.checkers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, venv_folder):
+        stopped = []
+        with self.lock:
+            checker = self.checkers.pop(venv_folder, None) or ImportChecker(venv_folder, logger=self.logger)
+            self.checkers[venv_folder] = checker
+            while len(self.checkers) > self.max_size:
+                stopped.append(self.checkers.popitem(last=False)[1])
+        for old in stopped:
+            old.stop()
+        return checker
+
+    def discard(self, venv_folder):
+        """
+        Stop the checker of a virtual env, called when it is removed from the virtual env cache.
+        """
+        with self.lock:
+            checker = self.checkers.pop(venv_folder, None)
+        if checker:
+            checker.stop()
+
+    def stop(self):
+        with self.lock:
+            checkers, self.checkers = list(self.checkers.values()), OrderedDict()
+        for checker in checkers:
+            checker.stop()
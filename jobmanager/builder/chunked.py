@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Chunked and resumable package uploads
+:author: Ronan Delacroix
+"""
+import hashlib
+import datetime
+from bson.binary import Binary
+from werkzeug.utils import secure_filename
+from . import upload
+from .models import UploadSession, UploadChunk
+
+CHUNK_SIZE = 4 * 1024 * 1024  # bytes, default chunk size
+CHUNK_MIN_SIZE = 64 * 1024  # bytes
+CHUNK_MAX_SIZE = 8 * 1024 * 1024  # bytes, chunks are stored as database documents
+SESSION_TTL = 24 * 3600  # seconds an upload session can be resumed
+
+
+def create_session(filename, size, chunk_size=None, sha256=None):
+    """
+    Create an upload session for a package of the given size, sent in chunks of chunk_size bytes (last one excepted).
+    """
+    size = int(size)
+    if size < 0:
+        raise Exception("Invalid upload size %d." % size)
+    if size > upload.UPLOAD_MAX_SIZE:
+        raise upload.UploadLimitError("Upload is bigger than %d MB." % (upload.UPLOAD_MAX_SIZE // (1024 * 1024)))
+    chunk_size = min(max(int(chunk_size or CHUNK_SIZE), CHUNK_MIN_SIZE), CHUNK_MAX_SIZE)
+    session = UploadSession(
+        filename=secure_filename(filename or ''),
+        size=size,
+        chunk_size=chunk_size,
+        chunks=max(1, (size + chunk_size - 1) // chunk_size),
+        sha256=sha256.lower() if sha256 else None,
+        expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=SESSION_TTL)
+    )
+    session.save()
+    return session
+
+
+def get_session(session_uuid):
+    session = UploadSession.objects(uuid=session_uuid).first()
+    if not session:
+        raise Exception("Unknown or expired upload %s." % session_uuid)
+    return session
+
+
+def chunk_length(session, index):
+    return min(session.chunk_size, session.size - index * session.chunk_size)
+
+
+def put_chunk(session_uuid, index, data, sha256=None):
+    """
+    Commit a chunk of an upload session, after checking its size and checksum. Chunks can be sent again.
+    """
+    session = get_session(session_uuid)
+    if index < 0 or index >= session.chunks:
+        raise Exception("Invalid chunk index %d, upload %s has %d chunks." % (index, session_uuid, session.chunks))
+    if len(data) != chunk_length(session, index):
+        raise Exception("Invalid chunk %d size : %d bytes received, %d expected." % (index, len(data), chunk_length(session, index)))
+    digest = hashlib.sha256(data).hexdigest()
+    if sha256 and digest != sha256.lower():
+        raise Exception("Invalid chunk %d checksum : %s received, %s expected." % (index, digest, sha256.lower()))
+    UploadChunk._get_collection().replace_one({'_id': "%s:%d" % (session_uuid, index)}, {
+        'session': session_uuid,
+        'index': index,
+        'data': Binary(data),
+        'sha256': digest,
+        'expires': session.expires
+    }, upsert=True)
+    session.modify(add_to_set__committed=index)
+    return session
+
+
+def session_status(session):
+    committed = sorted(set(session.committed))
+    return {
+        'upload': session.uuid,
+        'filename': session.filename,
+        'size': session.size,
+        'chunk_size': session.chunk_size,
+        'chunks': session.chunks,
+        'committed': committed,
+        'missing': sorted(set(range(session.chunks)) - set(committed)),
+        'complete': len(committed) == session.chunks,
+        'expires': session.expires
+    }
+
+
+def assemble(session_uuid):
+    """
+    Feed the chunks of a complete upload session, in order, to an upload receiver, which extracts archives as usual.
+    The session is removed once the upload is received.
+    :return: upload receiver
+    """
+    session = get_session(session_uuid)
+    missing = session.chunks - len(set(session.committed))
+    if missing:
+        raise Exception("Upload %s is incomplete : %d chunks missing." % (session_uuid, missing))
+    collection = UploadChunk._get_collection()
+    receiver = upload.UploadReceiver(session.filename)
+    h = hashlib.sha256()
+    try:
+        for index in range(session.chunks):
+            chunk = collection.find_one({'_id': "%s:%d" % (session_uuid, index)})
+            if not chunk:
+                raise Exception("Upload %s chunk %d is missing." % (session_uuid, index))
+            data = bytes(chunk['data'])
+            h.update(data)
+            receiver.write(data)
+        receiver.finish()
+        if session.sha256 and h.hexdigest() != session.sha256:
+            raise Exception("Invalid upload checksum : %s received, %s expected." % (h.hexdigest(), session.sha256))
+    except Exception:
+        receiver.clean()
+        raise
+    delete_session(session_uuid)
+    return receiver
+
+
+def delete_session(session_uuid):
+    UploadChunk._get_collection().delete_many({'session': session_uuid})
+    UploadSession.objects(uuid=session_uuid).delete()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Command line client, uploading packages in parallel chunks
+:author: Ronan Delacroix
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import concurrent.futures
+import urllib.error
+import urllib.parse
+import urllib.request
+
+STATE_FOLDER = os.path.join(tempfile.gettempdir(), "jobmanager-builder", "uploads")  # sessions of interrupted uploads
+RETRIES = 5
+TIMEOUT = 300  # seconds
+
+
+def request_json(method, url, data=None, headers=None):
+    """
+    Send a request to the builder API and decode its JSON response. Dict data is sent form encoded.
+    """
+    headers = dict(headers or {}, Accept='application/json')
+    if isinstance(data, dict):
+        data = urllib.parse.urlencode(data, doseq=True).encode('utf-8')
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    req = urllib.request.Request(url, data=data, method=method, headers=headers)
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ChunkedUpload:
+    """
+    Upload of a package file in chunks sent in parallel, each one retried on network errors.
+    An interrupted upload of the same file to the same builder is resumed : only missing chunks are sent.
+    """
+    def __init__(self, url, path, chunk_size=None, parallel=4, retries=RETRIES, progress=None):
+        self.url = url.rstrip('/')
+        self.path = os.path.abspath(path)
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.parallel = parallel
+        self.retries = retries
+        self.progress = progress  # callable(sent bytes, total bytes)
+        self.sha256 = None
+        self.status = None
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    @property
+    def upload_id(self):
+        return self.status['upload'] if self.status else None
+
+    def state_path(self):
+        key = "%s|%s|%s" % (self.url, self.path, self.sha256)
+        return os.path.join(STATE_FOLDER, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def resume(self):
+        """
+        Get the status of the previous upload session of this file, if it can still be resumed.
+        """
+        try:
+            with open(self.state_path()) as f:
+                upload_id = json.load(f)['upload']
+            status = request_json('GET', "%s/uploads/%s" % (self.url, upload_id))
+        except (OSError, ValueError, KeyError, urllib.error.URLError):
+            return None
+        if status.get('size') != self.size:
+            return None
+        return status
+
+    def start(self):
+        self.sha256 = file_sha256(self.path)
+        self.status = self.resume()
+        if not self.status:
+            self.status = request_json('POST', "%s/uploads" % self.url, {
+                'filename': os.path.basename(self.path),
+                'size': self.size,
+                'chunk_size': self.chunk_size or '',
+                'sha256': self.sha256
+            })
+            if self.status.get('result') == 'error':
+                raise Exception(self.status.get('message'))
+            os.makedirs(STATE_FOLDER, exist_ok=True)
+            with open(self.state_path(), 'w') as f:
+                json.dump({'upload': self.upload_id, 'path': self.path}, f)
+        self.sent = self.size - sum(self.chunk_length(i) for i in self.status['missing'])
+
+    def chunk_length(self, index):
+        return min(self.status['chunk_size'], self.size - index * self.status['chunk_size'])
+
+    def send_chunk(self, index):
+        with open(self.path, 'rb') as f:
+            f.seek(index * self.status['chunk_size'])
+            data = f.read(self.chunk_length(index))
+        headers = {'X-Chunk-Sha256': hashlib.sha256(data).hexdigest(), 'Content-Type': 'application/octet-stream'}
+        for attempt in range(self.retries + 1):
+            try:
+                result = request_json('PUT', "%s/uploads/%s/%d" % (self.url, self.upload_id, index), data, headers)
+                break
+            except (urllib.error.URLError, OSError):
+                if attempt == self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+        if result.get('result') != 'committed':
+            raise Exception("Chunk %d upload failed : %s" % (index, result.get('message')))
+        with self.lock:
+            self.sent += len(data)
+            if self.progress:
+                self.progress(self.sent, self.size)
+
+    def run(self):
+        """
+        Send missing chunks.
+        :return: upload ID, to give to the build request
+        """
+        self.start()
+        if self.progress:
+            self.progress(self.sent, self.size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.parallel)) as executor:
+            for future in [executor.submit(self.send_chunk, index) for index in self.status['missing']]:
+                future.result()
+        return self.upload_id
+
+    def forget(self):
+        """
+        Remove the saved session : the upload was used by a build request.
+        """
+        try:
+            os.remove(self.state_path())
+        except OSError:
+            pass
+
+
+def wait_build(url, build_url, interval=2.0):
+    """
+    Wait for the end of a build.
+    :return: build status dict
+    """
+    while True:
+        status = request_json('GET', url + build_url)
+        if status.get('status') in ('success', 'error'):
+            return status
+        time.sleep(interval)
+
+
+def print_progress(sent, total):
+    sys.stderr.write("\rUploaded %.1f / %.1f MB (%d%%)" % (sent / 1048576.0, total / 1048576.0, sent * 100 // max(total, 1)))
+    if sent >= total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+def upload_command(argv):
+    parser = argparse.ArgumentParser(prog='jobmanager-builder upload',
+                                     description='Upload a package to a Job Manager Docker Image Builder and build it. '
+                                                 'Interrupted uploads are resumed when the command is run again.')
+    parser.add_argument('package', help='Package file : python file or archive (tar, tar.gz, zip...).')
+    parser.add_argument('-u', '--url', required=True, help='Builder URL, like http://builder:5001')
+    parser.add_argument('-n', '--name', required=True, help='Image name.')
+    parser.add_argument('-i', '--imports', nargs='+', required=True, metavar='MODULE', help='Modules containing jobs.')
+    parser.add_argument('--pip', nargs='+', default=[], metavar='REQUIREMENT', help='Pip requirements.')
+    parser.add_argument('--apt', nargs='+', default=[], metavar='PACKAGE', help='Apt packages.')
+    parser.add_argument('-t', '--tags', nargs='+', default=[], metavar='TAG', help='Image tags.')
+    parser.add_argument('--chunk-size', metavar='MB', type=float, help='Chunk size, in megabytes (default: builder one).')
+    parser.add_argument('--parallel', metavar='CHUNKS', type=int, default=4, help='Chunks sent concurrently.')
+    parser.add_argument('--wait', action='store_true', default=False, help='Wait for the end of the build.')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help='Do not show upload progress.')
+    args = parser.parse_args(argv)
+
+    url = args.url.rstrip('/')
+    upload = ChunkedUpload(url, args.package, chunk_size=int(args.chunk_size * 1024 * 1024) if args.chunk_size else None,
+                           parallel=args.parallel, progress=None if args.quiet else print_progress)
+    try:
+        upload_id = upload.run()
+        result = request_json('POST', "%s/build" % url, {
+            'upload': upload_id,
+            'name': args.name,
+            'imports': ' '.join(args.imports),
+            'pip': ' '.join(args.pip),
+            'apt': ' '.join(args.apt),
+            'tags': ' '.join(args.tags)
+        })
+        if result.get('result') != 'error':
+            upload.forget()
+        if args.wait and result.get('result') == 'queued':
+            result = wait_build(url, result['url'])
+            result = dict(result.pop('result', None) or {}, status=result.get('status'), message=result.get('message'))
+    except Exception as e:
+        result = {'result': "error", 'message': str(e)}
+    print(json.dumps(result, indent=2, sort_keys=True, default=str))
+    return 1 if result.get('result') == 'error' or result.get('status') == 'error' else 0
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Docker build context streaming
+:author: Ronan Delacroix
+"""
+import os
+import re
+import time
+import tarfile
+from io import BytesIO
+
+CHUNK_SIZE = 1024 * 1024
+
+# Patterns use .dockerignore syntax, relative to the package root
+DEFAULT_EXCLUDES = [
+    '**/__pycache__',
+    '**/*.py[cod]',
+    '**/.git',
+    '**/.hg',
+    '**/.svn',
+    '**/.tox',
+    '**/.pytest_cache',
+    '**/.mypy_cache',
+    '**/*.egg-info',
+    '**/.DS_Store',
+    '.idea',
+    '.vscode',
+    'venv',
+    '.venv',
+]
+
+
+def pattern_to_regex(pattern):
+    """
+    Convert a .dockerignore pattern to a regex matching the path and, for directories, everything under it.
+    """
+    pattern = os.path.normpath(pattern).lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            end = pattern.find(']', i)
+            if end < 0:
+                regex += re.escape(pattern[i:])
+                break
+            regex += pattern[i:end + 1]
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile('^' + regex + '(?:/.*)?$')
+
+
+class ExcludeRules:
+    """
+    Build context exclusion rules, with .dockerignore semantics : patterns are relative to the package root,
+    '!' patterns include back previously excluded paths, and the last matching pattern wins.
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            self.patterns.append(pattern)
+            self.rules.append((negate, pattern_to_regex(pattern.lstrip('!'))))
+        self.has_negation = any(negate for negate, regex in self.rules)
+
+    @classmethod
+    def from_folder(cls, folder, extra_patterns=None):
+        """
+        Default rules, then extra patterns, then patterns of the .dockerignore file of folder if any.
+        """
+        patterns = DEFAULT_EXCLUDES + list(extra_patterns or [])
+        dockerignore = os.path.join(folder, '.dockerignore')
+        if os.path.isfile(dockerignore):
+            with open(dockerignore) as f:
+                patterns += f.read().splitlines()
+        return cls(patterns)
+
+    def excluded(self, relpath):
+        result = False
+        for negate, regex in self.rules:
+            if regex.match(relpath):
+                result = not negate
+        return result
+
+    def walk(self, folder):
+        """
+        os.walk of folder, without excluded files. Excluded directories are pruned unless a '!' pattern could
+        include back part of their content.
+        :return: generator of tuples (root, relative root, dirs, files)
+        """
+        for root, dirs, files in os.walk(folder):
+            relroot = os.path.relpath(root, folder)
+            relroot = '' if relroot == '.' else relroot + '/'
+            if not self.has_negation:
+                dirs[:] = [d for d in dirs if not self.excluded(relroot + d)]
+            dirs.sort()
+            files = [f for f in sorted(files) if not self.excluded(relroot + f)]
+            yield root, relroot, dirs, files
+
+
+def tar_stream(entries, stats=None):
+    """
+    Generate an uncompressed tar archive from (tarinfo, file object) entries, chunk by chunk.
+    Used as docker build context, it is sent to the daemon while it is generated, without temporary copy.
+    If a stats dict is given, archive size and file count are updated in it.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(size=0, files=0)
+    for tarinfo, fileobj in entries:
+        header = tarinfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        stats['size'] += len(header)
+        yield header
+        if not tarinfo.isreg():
+            continue
+        stats['files'] += 1
+        remaining = tarinfo.size
+        while remaining:
+            chunk = fileobj.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise IOError("Unexpected end of file while adding %s to build context" % tarinfo.name)
+            remaining -= len(chunk)
+            stats['size'] += len(chunk)
+            yield chunk
+        if tarinfo.size % tarfile.BLOCKSIZE:
+            padding = tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE
+            stats['size'] += padding
+            yield tarfile.NUL * padding
+    stats['size'] += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+def bytes_entry(name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    return tarinfo, BytesIO(data)
+
+
+def folder_entries(folder, arcname, exclude=None):
+    """
+    Tar entries of a folder content, stored under arcname. Paths matching exclude rules are left out.
+    """
+    tar = tarfile.TarFile(fileobj=BytesIO(), mode='w')
+    for root, relroot, dirs, files in (exclude or ExcludeRules([])).walk(folder):
+        for name in [None] + files:
+            path = os.path.join(root, name) if name else root
+            relpath = relroot + name if name else relroot.rstrip('/')
+            if not name and relpath and exclude and exclude.excluded(relpath):
+                continue
+            tarinfo = tar.gettarinfo(path, arcname + '/' + relpath if relpath else arcname)
+            if tarinfo is None:  # sockets, devices...
+                continue
+            if tarinfo.isreg():
+                with open(path, 'rb') as f:
+                    yield tarinfo, f
+            else:
+                yield tarinfo, None
+
+
+def archive_entries(archive_path, prefix, arcname, exclude=None):
+    """
+    Tar entries read from an uploaded tar archive (possibly compressed), in a single streaming pass.
+    Only members under prefix are kept, and they are stored under arcname instead.
+    Paths (relative to prefix) matching exclude rules are left out.
+    """
+    prefix = os.path.normpath(prefix)
+
+    def rename(name):
+        name = os.path.normpath(name)
+        if prefix != '.':
+            if name != prefix and not name.startswith(prefix + '/'):
+                return None
+            name = os.path.relpath(name, prefix)
+        if name == '..' or name.startswith('../') or os.path.isabs(name):
+            return None
+        if name == '.':
+            return arcname
+        if exclude and exclude.excluded(name):
+            return None
+        return arcname + '/' + name
+
+    with tarfile.open(archive_path, mode='r|*') as tar:
+        for member in tar:
+            if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+                continue
+            name = rename(member.name)
+            if not name:
+                continue
+            if member.islnk():
+                member.linkname = rename(member.linkname)
+                if not member.linkname:
+                    continue
+            member.name = name
+            # pax headers have priority over member names when written
+            member.pax_headers.pop('path', None)
+            member.pax_headers.pop('linkpath', None)
+            yield member, tar.extractfile(member) if member.isreg() else None
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Garbage collection of images, build caches and temporary folders of builder hosts
+:author: Ronan Delacroix
+"""
+import os
+import re
+import time
+import glob
+import shutil
+import logging
+import calendar
+import datetime
+import tempfile
+import threading
+import docker
+from jobmanager.common.docker import DockerImage
+from . import lib
+from . import builds
+from . import cache
+from . import buildlog
+from . import metrics
+from . import sources
+from .models import BuildRequest
+
+GC_DISK_BUDGET = None  # bytes of images and build caches kept on this host, least recently used ones are removed above it
+GC_INTERVAL = 600  # seconds between garbage collections, 0 to disable them
+GC_KEEP_RECENT = 7 * 24 * 3600  # seconds during which images of built or reused DockerImage records are never removed
+GC_TEMP_MAX_AGE = 6 * 3600  # seconds after which temporary folders not used by any build are removed
+GC_SOURCE_TREE_MAX_AGE = 30 * 24 * 3600  # seconds after which source trees of images not built or reused are removed, 0 to keep them
+GC_BUILD_LOG_MAX_AGE = 30 * 24 * 3600  # seconds after which stored build logs are removed, 0 to keep them
+GC_DATABASE_INTERVAL = 3600  # seconds between garbage collections of database content, which every node runs
+
+IMAGE_UUID_PATTERN = re.compile(r'^[0-9a-f]{10,64}$')
+
+
+def parse_docker_time(value):
+    """
+    Timestamp of a Docker API date (RFC 3339, UTC), or 0 if it is not set.
+    """
+    try:
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return 0
+
+
+def path_age(path):
+    try:
+        return time.time() - os.lstat(path).st_mtime
+    except OSError:
+        return 0
+
+
+def path_size(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        return cache.folder_size(path)
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def buildkit_cache_links():
+    """
+    BuildKit layer cache links of image repositories, and the exported cache folders they point to.
+    :return: dict link path -> cache folder path
+    """
+    links = {}
+    if lib.BUILDKIT_CACHE_FOLDER and os.path.isdir(lib.BUILDKIT_CACHE_FOLDER):
+        for name in os.listdir(lib.BUILDKIT_CACHE_FOLDER):
+            path = os.path.join(lib.BUILDKIT_CACHE_FOLDER, name)
+            if not name.startswith('.') and os.path.isdir(path):
+                links[path] = os.path.realpath(path)
+    return links
+
+
+def prune_build_cache(client, keep_storage):
+    """
+    Remove least recently used build cache records, until build cache fits in keep_storage bytes.
+    Docker SDKs older than 6.1 have no keep_storage argument : the Docker API is then called directly.
+    """
+    try:
+        return client.api.prune_builds(keep_storage=keep_storage, all=True)
+    except TypeError:
+        url = client.api._url('/build/prune')
+        return client.api._result(client.api._post(url, params={'keep-storage': keep_storage, 'all': 'true'}), True)
+
+
+def is_referenced(image, references):
+    """
+    Check if an image (Docker disk usage entry) is one of the references : tag, or image uuid (short or full id).
+    """
+    tags = set(image.get('RepoTags') or [])
+    image_id = image['Id'].split(':')[-1]
+    for reference in references:
+        if reference in tags or reference + ':latest' in tags:
+            return True
+        if IMAGE_UUID_PATTERN.match(reference) and image_id.startswith(reference):
+            return True
+    return False
+
+
+class GarbageCollector:
+    """
+    Keep the disk usage of the builder host bounded, every GC_INTERVAL seconds :
+    - temporary folders left by interrupted uploads, builds and cache updates are removed after GC_TEMP_MAX_AGE,
+    - temporary tags of pipelined builds which did not finish are removed,
+    - above GC_DISK_BUDGET, least recently used images, build cache records and BuildKit cache folders are removed,
+    - every GC_DATABASE_INTERVAL, source trees of removed images or of images not built or reused within
+      GC_SOURCE_TREE_MAX_AGE are removed from the database, with file contents no source tree references anymore,
+      and logs of builds created more than GC_BUILD_LOG_MAX_AGE ago.
+    Images and folders of running builds, the base image, and images of DockerImage records built or reused within
+    GC_KEEP_RECENT are never removed.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last_report = None
+        self.last_database_collect = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="garbage-collector", daemon=True)
+        self.thread.start()
+        self.logger.info("Garbage collection started, every %d seconds." % GC_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.collect()
+            except Exception:
+                self.logger.exception("Error during garbage collection")
+            self.stopped.wait(GC_INTERVAL)
+
+    def collect(self):
+        """
+        Run a garbage collection.
+        :return: report dict, with reclaimed bytes by kind
+        """
+        start = time.time()
+        images, folders = lib.get_references_in_use()
+        images.add(lib.BASE_IMAGE)
+        folders.update(b.upload_folder for b in BuildRequest.objects(
+            upload_node=builds.NODE_NAME, upload_folder__ne=None, status__nin=builds.FINISHED_STATUSES).only('upload_folder'))
+        folders.update(b.log_file for b in BuildRequest.objects(
+            node=builds.NODE_NAME, log_file__ne=None, status__nin=builds.FINISHED_STATUSES).only('log_file'))
+        reclaimed = {'temp': 0, 'images': 0, 'build_cache': 0, 'buildkit_cache': 0, 'source_trees': 0, 'build_logs': 0}
+        removed = {'temp': 0, 'images': 0, 'build_cache': 0, 'buildkit_cache': 0, 'source_trees': 0, 'build_logs': 0}
+
+        for path in self.orphan_temp_paths(folders):
+            size = path_size(path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if not os.path.lexists(path):
+                reclaimed['temp'] += size
+                removed['temp'] += 1
+
+        client = lib.get_docker_session().client
+        usage = self.disk_usage(client)
+        removed['images'] += self.remove_pipeline_tags(client, usage['df'], images)
+        if GC_DISK_BUDGET is not None and usage['total'] > GC_DISK_BUDGET:
+            for kind, count, size in self.evict(client, usage, images):
+                removed[kind] += count
+                reclaimed[kind] += size
+        if removed['images']:
+            layers_size = usage['layers']
+            usage = self.disk_usage(client)
+            reclaimed['images'] = max(0, layers_size - usage['layers'])
+
+        if time.time() - self.last_database_collect >= GC_DATABASE_INTERVAL:
+            self.last_database_collect = time.time()
+            if GC_SOURCE_TREE_MAX_AGE:
+                removed['source_trees'] = sources.remove_expired_trees(GC_SOURCE_TREE_MAX_AGE)
+                blobs, reclaimed['source_trees'] = sources.remove_unreferenced_blobs()
+                if removed['source_trees'] or blobs:
+                    self.logger.info("Garbage collection removed %d source trees and %d file contents from the database." % (
+                        removed['source_trees'], blobs))
+            if GC_BUILD_LOG_MAX_AGE:
+                removed['build_logs'], reclaimed['build_logs'] = self.remove_build_logs(GC_BUILD_LOG_MAX_AGE)
+
+        report = {
+            'date': datetime.datetime.utcnow(),
+            'duration': time.time() - start,
+            'budget': GC_DISK_BUDGET,
+            'usage': {k: v for k, v in usage.items() if k != 'df'},
+            'removed': removed,
+            'reclaimed': reclaimed,
+            'reclaimed_total': sum(reclaimed.values())
+        }
+        for kind, size in reclaimed.items():
+            if size:
+                metrics.inc('jobmanager_builder_gc_reclaimed_bytes_total', {'kind': kind}, size)
+        metrics.set_gauge('jobmanager_builder_disk_usage_bytes', usage['total'])
+        if report['reclaimed_total'] or any(removed.values()):
+            self.logger.info("Garbage collection reclaimed %.1f MB (%s), disk usage is %.1f MB." % (
+                report['reclaimed_total'] / 1048576.0,
+                ', '.join("%s : %d removed, %.1f MB" % (k, removed[k], reclaimed[k] / 1048576.0) for k in sorted(removed)),
+                usage['total'] / 1048576.0))
+        self.last_report = report
+        return report
+
+    @staticmethod
+    def orphan_temp_paths(folders):
+        """
+        Temporary folders and files older than GC_TEMP_MAX_AGE, which no running build uses : upload and wheel folders,
+        virtual envs and wheels left half created, BuildKit cache exports, build log files not stored in the database.
+        """
+        patterns = [os.path.join(tempfile.gettempdir(), 'jobmanager-upload-*'),
+                    os.path.join(tempfile.gettempdir(), 'jobmanager-wheels-*'),
+                    os.path.join(buildlog.BUILD_LOG_FOLDER, '*.log'),
+                    os.path.join(lib.VENV_CACHE_FOLDER, '*.tmp')]
+        if lib.WHEELHOUSE_FOLDER:
+            patterns.append(os.path.join(lib.WHEELHOUSE_FOLDER, '.*.tmp'))
+        if lib.BUILDKIT_CACHE_FOLDER:
+            patterns += [os.path.join(lib.BUILDKIT_CACHE_FOLDER, '.export-*'), os.path.join(lib.BUILDKIT_CACHE_FOLDER, '.link*')]
+        used = [os.path.realpath(f) for f in folders if f] + list(buildkit_cache_links().values())
+        paths = []
+        for path in sorted(set(p for pattern in patterns for p in glob.glob(pattern))):
+            real_path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+            if any(f == real_path or f.startswith(real_path + os.sep) for f in used):
+                continue
+            if path_age(path) > GC_TEMP_MAX_AGE:
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def remove_build_logs(max_age):
+        """
+        Remove stored logs of builds created more than max_age seconds ago.
+        :return: tuple (count, size) of removed logs
+        """
+        expires = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        removed = 0
+        removed_size = 0
+        for build_request in BuildRequest.objects(created__lt=expires, log__ne=None).only('uuid', 'log'):
+            removed_size += build_request.log.length or 0
+            build_request.log.delete()
+            BuildRequest.objects(uuid=build_request.uuid).update(unset__log=True)
+            removed += 1
+        return removed, removed_size
+
+    @staticmethod
+    def disk_usage(client):
+        """
+        Disk usage of images, build cache and BuildKit cache folders.
+        :return: dict of sizes in bytes, and 'df' : Docker disk usage data
+        """
+        df = client.df()
+        layers = df.get('LayersSize') or 0
+        build_cache = sum(r.get('Size') or 0 for r in df.get('BuildCache') or [] if not r.get('Shared'))
+        buildkit_cache = cache.folder_size(lib.BUILDKIT_CACHE_FOLDER) if lib.BUILDKIT_CACHE_FOLDER else 0
+        return {
+            'layers': layers,
+            'build_cache': build_cache,
+            'buildkit_cache': buildkit_cache,
+            'total': layers + build_cache + buildkit_cache,
+            'df': df
+        }
+
+    def remove_pipeline_tags(self, client, df, images):
+        """
+        Remove temporary tags of pipelined builds older than GC_TEMP_MAX_AGE, which no running build uses.
+        Tags are checked against their tag time, as images built from cached layers can be much older.
+        :return: number of removed tags
+        """
+        removed = 0
+        prefix = lib.PIPELINE_REPOSITORY + ':'
+        for image in df.get('Images') or []:
+            for tag in image.get('RepoTags') or []:
+                if not tag.startswith(prefix) or tag in images:
+                    continue
+                try:
+                    tagged = client.api.inspect_image(tag).get('Metadata', {}).get('LastTagTime')
+                    if time.time() - parse_docker_time(tagged) <= GC_TEMP_MAX_AGE:
+                        continue
+                    client.images.remove(tag)
+                    removed += 1
+                except docker.errors.ImageNotFound:
+                    pass
+                except docker.errors.APIError as e:
+                    self.logger.debug("Temporary tag %s not removed : %s" % (tag, e))
+        return removed
+
+    def image_records(self, df):
+        """
+        DockerImage records of local images.
+        :return: dict image uuid -> last update
+        """
+        uuids = [image['Id'].split(':')[-1][:10] for image in df.get('Images') or []]
+        records = DockerImage.objects(uuid__in=uuids).only('uuid', 'updated')
+        return {r.uuid: r.updated for r in records}
+
+    def evict(self, client, usage, images):
+        """
+        Remove least recently used images, build cache records and BuildKit cache folders, until disk usage fits
+        in GC_DISK_BUDGET. Build cache is pruned by the Docker daemon, keeping the most recently used records.
+        :return: list of tuples (kind, removed count, reclaimed bytes)
+        """
+        df = usage['df']
+        recent = time.time() - GC_KEEP_RECENT
+        records = self.image_records(df)
+        image_uses = lib.get_image_uses()
+        candidates = []
+        for image in df.get('Images') or []:
+            updated = records.get(image['Id'].split(':')[-1][:10])
+            updated = calendar.timegm(updated.utctimetuple()) if updated else 0
+            if updated > recent or image.get('Containers', 0) > 0 or is_referenced(image, images):
+                continue
+            if any(t.startswith(lib.PIPELINE_REPOSITORY + ':') for t in image.get('RepoTags') or []):
+                continue  # temporary tags are removed once old enough, by remove_pipeline_tags
+            last_used = max(image.get('Created') or 0, updated, image_uses.get(image['Id'], 0))
+            size = (image.get('Size') or 0) - max(image.get('SharedSize') or 0, 0)
+            candidates.append((last_used, size, 'images', image['Id']))
+        for record in df.get('BuildCache') or []:
+            if record.get('InUse') or record.get('Shared'):
+                continue
+            last_used = parse_docker_time(record.get('LastUsedAt') or record.get('CreatedAt'))
+            candidates.append((last_used, record.get('Size') or 0, 'build_cache', record.get('ID')))
+        scopes = set(lib.buildkit_cache_key(i) for i in images)
+        for path, folder in buildkit_cache_links().items():
+            if os.path.basename(path) in scopes:
+                continue
+            index = os.path.join(folder, 'index.json')
+            last_used = max(os.path.getmtime(folder), os.path.getmtime(index) if os.path.isfile(index) else 0)
+            candidates.append((last_used, cache.folder_size(folder), 'buildkit_cache', path))
+
+        excess = usage['total'] - GC_DISK_BUDGET
+        selected = []
+        for candidate in sorted(candidates, key=lambda c: c[:2]):
+            if excess <= 0:
+                break
+            selected.append(candidate)
+            excess -= candidate[1]
+
+        results = []
+        removed_images = 0
+        for last_used, size, kind, image_id in (c for c in selected if c[2] == 'images'):
+            try:
+                client.images.remove(image_id, force=True)
+                removed_images += 1
+            except docker.errors.ImageNotFound:
+                pass
+            except docker.errors.APIError as e:
+                self.logger.debug("Image %s not removed : %s" % (image_id, e))  # parent of other images, or in use
+        results.append(('images', removed_images, 0))  # measured afterwards, as images share layers
+
+        cache_records = [c for c in selected if c[2] == 'build_cache']
+        if cache_records:
+            keep_storage = max(0, usage['build_cache'] - sum(c[1] for c in cache_records))
+            try:
+                result = prune_build_cache(client, keep_storage)
+                results.append(('build_cache', len(result.get('CachesDeleted') or []), result.get('SpaceReclaimed') or 0))
+            except docker.errors.APIError as e:
+                self.logger.warning("Build cache not pruned : %s" % e)
+
+        for last_used, size, kind, path in (c for c in selected if c[2] == 'buildkit_cache'):
+            folder = os.path.realpath(path)
+            if os.path.islink(path):
+                os.remove(path)
+            shutil.rmtree(folder, ignore_errors=True)
+            if not os.path.exists(folder):
+                results.append(('buildkit_cache', 1, size))
+        return results
@@ -7,39 +7,303 @@ Python Job Manager Builder API
 :author: Ronan Delacroix
 """
 import os
+import re
 import sys
 import json
+import stat
 import shutil
+import hashlib
 import logging
 import subprocess
 import venv
+import time
+import weakref
+import tempfile
+import itertools
+import contextlib
+import threading
+import concurrent.futures
 import docker
 import jinja2
-from io import BytesIO
+import requests
 import tbx.process
+from . import cache
+from . import context
+from . import checker
+from . import metrics
+from . import package_tester
 
 BASE_IMAGE = "ronhanson/jobmanager-client:latest"
 
+VENV_CACHE_FOLDER = os.path.join(tempfile.gettempdir(), "jobmanager-builder", "venv")
+VENV_CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024  # bytes
+
+IMPORT_CHECKERS = 4  # warm import checker processes kept, one per recently used virtual env
+IMPORT_CHECK_TIMEOUT = 60  # seconds
+
+VALIDATION_MODES = ('host', 'image')
+VALIDATION_MODE = 'host'  # image : imports are tested in a container of the built image instead of a host virtual env
+IMAGE_PACKAGE_FOLDER = "/opt/lib"  # where the package is copied in images
+CONTAINER_START_TIMEOUT = 30  # seconds allowed to start and remove an import check container, on top of the check
+
+WHEELHOUSE_FOLDER = None  # when set, requirements are built once as wheels on the host and installed offline in images
+
+BUILD_ENGINES = ('classic', 'buildkit')
+BUILD_ENGINE = 'classic'  # buildkit : images are built with docker buildx, using pip and apt cache mounts
+BUILDKIT_BUILDER = None  # buildx builder instance, a docker-container one is needed to export layer cache locally
+BUILDKIT_CACHE_FOLDER = None  # when set, BuildKit layer cache is imported from and exported to this folder
+
+PIPELINED_BUILDS = False  # when set, the docker image is built while the package is validated, and tagged once it is valid
+PIPELINE_REPOSITORY = "jobmanager-pipeline"  # temporary tags of images built before the end of validation
+
+DEPENDENCY_IMAGES = False  # when set, apt and pip dependencies are built in an intermediate image reused by code only builds
+DEPENDENCY_IMAGE_REPOSITORY = "jobmanager-dependencies"
+
+PACKAGE_SEARCH_EXCLUDES = ['**/node_modules', '**/site-packages', '**/dist-packages']  # never searched for imports
+PACKAGE_SEARCH_MAX_DEPTH = 8  # folder levels
+
+STATIC_CHECK = True  # parse package sources to detect broken imports and list jobs before installing requirements
+
+CONTEXT_EXCLUDES = []  # extra build context exclusion patterns (.dockerignore syntax), added to context.DEFAULT_EXCLUDES
+
 DOCKER_REGISTRY_URL = None
 DOCKER_REGISTRY_USERNAME = None
 DOCKER_REGISTRY_PASSWORD = None
 #DOCKER_REGISTRY_EMAIL = None
 
+DOCKER_CLIENT_POOL_SIZE = 10
+DOCKER_REGISTRY_LOGIN_TTL = 3600  # seconds
+DOCKER_PUSH_CONCURRENCY = 4
+
+
+def get_registry_credentials():
+    """
+    Get docker registry url, username and password, from settings or environment.
+    """
+    registry_url = DOCKER_REGISTRY_URL or os.environ.get('DOCKER_REGISTRY_URL')
+    registry_username = DOCKER_REGISTRY_USERNAME or os.environ.get('DOCKER_REGISTRY_USERNAME', None)
+    registry_password = DOCKER_REGISTRY_PASSWORD or os.environ.get('DOCKER_REGISTRY_PASSWORD', None)
+    if registry_url:
+        registry_url = registry_url.rstrip('/')
+    if registry_username:
+        registry_username = registry_username.rstrip('/')
+    return registry_url, registry_username, registry_password
+
+
+class DockerSession:
+    """
+    Docker client shared by all builds, using a pool of connections to the Docker API.
+    Registry logins are done once per registry and user, and cached until they expire.
+    Docker SDKs older than 4.3 have no max_pool_size argument : their default pool size is then used.
+    """
+    def __init__(self, pool_size, login_ttl):
+        try:
+            self.client = docker.from_env(max_pool_size=pool_size)
+        except TypeError:
+            logging.warning("Docker SDK %s does not support connection pool size, using its default." % docker.__version__)
+            self.client = docker.from_env()
+        self.login_ttl = login_ttl
+        self.logins = {}
+        self.lock = threading.Lock()
+
+    def check(self):
+        """
+        Test Docker API connection.
+        Might raise ConnectionErrors
+        """
+        self.client.ping()
+        self.client.images.list()
+
+    def login(self, registry, username, password):
+        """
+        Login to registry, unless already logged in.
+        :return: True if a new login was done, False if cached login was used.
+        """
+        key = (registry, username)
+        with self.lock:
+            if self.logins.get(key, 0) > time.time():
+                return False
+            self.client.login(registry=registry, username=username, password=password)  # email=email)
+            self.logins[key] = time.time() + self.login_ttl
+            return True
+
+    def logout(self, registry, username):
+        """
+        Forget cached login, next login call will authenticate again.
+        """
+        with self.lock:
+            self.logins.pop((registry, username), None)
+
+
+_docker_session = None
+_docker_session_lock = threading.Lock()
+
+
+def get_docker_session():
+    """
+    Get the docker session shared by all builds.
+    """
+    global _docker_session
+    with _docker_session_lock:
+        if _docker_session is None:
+            _docker_session = DockerSession(DOCKER_CLIENT_POOL_SIZE, DOCKER_REGISTRY_LOGIN_TTL)
+    return _docker_session
+
 
 def test_docker_api():
     """
-    Dummy function to test Docker API connection.
+    Dummy function to test Docker API connection, done once at startup.
     Might raise ConnectionErrors
     """
-    client = docker.from_env()
-    client.images.list()
+    get_docker_session().check()
+    if BUILD_ENGINE == 'buildkit':
+        test_buildkit()
+
+
+def test_buildkit():
+    """
+    Check docker buildx is available, with the configured builder instance.
+    """
+    get_buildkit_driver()
+
+
+def get_buildkit_driver():
+    """
+    Driver of the configured buildx builder instance : docker, docker-container...
+    """
+    global _buildkit_driver
+    if _buildkit_driver is None:
+        command = ['docker', 'buildx', 'inspect'] + ([BUILDKIT_BUILDER] if BUILDKIT_BUILDER else [])
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = result.stdout.decode('utf-8', errors='replace').strip()
+        if result.returncode:
+            raise Exception("BuildKit is not available (%s) : %s" % (' '.join(command), output))
+        match = re.search(r'^Driver:\s*(\S+)', output, re.MULTILINE)
+        _buildkit_driver = match.group(1) if match else 'docker'
+    return _buildkit_driver
+
+
+def can_use_dependency_images():
+    """
+    Check builds can start from local dependency images : BuildKit builders other than the docker driver one
+    (docker-container...) do not see images of the docker daemon.
+    """
+    return BUILD_ENGINE != 'buildkit' or get_buildkit_driver() == 'docker'
+
+
+def buildkit_cache_key(tag, image_name=None):
+    """
+    Name of the BuildKit layer cache folder of an image : its repository (with registry host), or its full tag for
+    dependency images, which are identified by dependency hash. Temporary tags use the final image name.
+    """
+    repository, _, version = tag.rpartition(':')
+    if not repository or '/' in version:
+        repository, version = tag, ''
+    if repository == DEPENDENCY_IMAGE_REPOSITORY:
+        repository = tag
+    elif repository == PIPELINE_REPOSITORY and image_name:
+        repository = image_name
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', repository)
+
+
+def get_builder_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('jobmanager-builder').version
+    except Exception:
+        return None
+
+
+_venv_cache = None
+_buildkit_driver = None
+_import_checkers = None
+_dependency_image_locks = {}
+_dependency_image_locks_lock = threading.Lock()
+_active_builders = weakref.WeakSet()
+_active_builders_lock = threading.Lock()
+_image_uses = {}  # image id -> time of its last use by a build
+
+
+def get_dependency_image_lock(tag):
+    """
+    Get the lock of a dependency image, so that builds sharing dependencies build it once.
+    """
+    with _dependency_image_locks_lock:
+        return _dependency_image_locks.setdefault(tag, threading.Lock())
+
+
+def touch_image(image):
+    """
+    Record that a build used an image, for least recently used image garbage collection.
+    """
+    _image_uses[image.id] = time.time()
+
+
+def get_image_uses():
+    return dict(_image_uses)
+
+
+def get_references_in_use():
+    """
+    Images and folders used by running builds, that garbage collection must keep.
+    :return: tuple (set of image references, set of folders)
+    """
+    with _active_builders_lock:
+        builders = list(_active_builders)
+    images, folders = set(), set()
+    for builder in builders:
+        builder_images, builder_folders = builder.references()
+        images.update(builder_images)
+        folders.update(builder_folders)
+    return images, folders
+
+
+def update_buildkit_cache(cache_folder, export_folder):
+    """
+    Make cache_folder, a symbolic link, point to a newly exported BuildKit cache folder. The link is replaced
+    atomically, so concurrent builds import either cache. The previous cache folder is removed unless a running
+    build imports it, garbage collection removing it later.
+    """
+    previous = os.path.realpath(cache_folder) if os.path.islink(cache_folder) else None
+    if os.path.isdir(cache_folder) and not os.path.islink(cache_folder):
+        shutil.rmtree(cache_folder, ignore_errors=True)  # cache folder of older versions, renamed in place
+    link = os.path.join(os.path.dirname(export_folder), '.link' + os.path.basename(export_folder))
+    os.symlink(os.path.basename(export_folder), link)
+    try:
+        os.replace(link, cache_folder)
+    except OSError:
+        os.remove(link)
+        raise
+    if previous and previous != os.path.realpath(export_folder) and previous not in get_references_in_use()[1]:
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def get_import_checkers():
+    """
+    Get the import checker servers shared by all builds.
+    """
+    global _import_checkers
+    if _import_checkers is None:
+        _import_checkers = checker.ImportCheckerPool(IMPORT_CHECKERS)
+    return _import_checkers
+
+
+def get_venv_cache():
+    """
+    Get the virtual env cache shared by all builds.
+    """
+    global _venv_cache
+    if _venv_cache is None:
+        _venv_cache = cache.VirtualEnvCache(VENV_CACHE_FOLDER, VENV_CACHE_MAX_SIZE,
+                                            on_evict=get_import_checkers().discard)
+    return _venv_cache
 
 
 class DockerBuilder:
     """
     Docker Builder class is used to create Job Manager Client docker images with jobs included alongside with their requirements.
     """
-    def __init__(self, folder, image_name, tags, imports, requirements, apt_packages, base_image=None, logger=None, on_log_debug=None, on_log_progress=None):
+    def __init__(self, folder, image_name, tags, imports, requirements, apt_packages, base_image=None, logger=None, on_log_debug=None, on_log_progress=None, image_lookup=None, archive=None, dependency_images=None, pipelined=None):
         self.image_uuid = None
         self.image_id = None
         self.image_name = image_name
@@ -57,15 +321,43 @@ class DockerBuilder:
         self.base_image = base_image or BASE_IMAGE
         self.registry_url = DOCKER_REGISTRY_URL
         self.dockerfile_content = None
+        self.dependencies_dockerfile_content = None
+        self.dependency_image = None
+        self.use_dependency_image = DEPENDENCY_IMAGES if dependency_images is None else dependency_images
+        self.wheel_folder = None
+        self.use_wheels = bool(WHEELHOUSE_FOLDER and requirements)
+        self.fingerprint = None
+        self.image_lookup = image_lookup  # callable returning the image record built with a fingerprint, or None
+        self.reused_image = None
+        self.upload_folder = folder
+        self.archive = archive  # uploaded tar archive of folder content, used as build context source
+        self.exclude_rules = None
+        self.context_size = None
+        self.context_files = None
+        self.image_size = None
+        self.timings = {}  # phase name -> seconds
+        self.push_timings = {}  # tag -> seconds
+        self.pipelined = PIPELINED_BUILDS if pipelined is None else pipelined
+        self.speculative_build = None  # future of the image built during validation
+        self.speculative_tag = None
+        self.speculative_lock = threading.Lock()
+        self.speculative_finished = False
+        self.cancelled = threading.Event()
+        self.build_process = None  # running docker buildx process
+        self.buildkit_cache_sources = set()  # BuildKit layer cache folders being imported
 
         if self.on_log_debug:
             assert callable(self.on_log_debug)
         if self.on_log_progress:
             assert callable(self.on_log_progress)
+        if self.image_lookup:
+            assert callable(self.image_lookup)
         if not self.tags:
             self.tags = ['latest']
 
         self.package_root = folder
+        with _active_builders_lock:
+            _active_builders.add(self)
         self.validate(folder)
 
     def log_info(self, msg):
@@ -83,6 +375,22 @@ class DockerBuilder:
             self.on_log_progress(msg)
         self.logger.error(msg)
 
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a build phase : duration is added to timings and to phase metrics, failures are counted by phase.
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            metrics.inc('jobmanager_builder_phase_failures_total', {'phase': name})
+            raise
+        finally:
+            duration = time.time() - start
+            self.timings[name] = self.timings.get(name, 0) + duration
+            metrics.observe('jobmanager_builder_phase_seconds', duration, {'phase': name})
+
     def validate(self, folder):
         """
         Method called by constructor to
@@ -91,16 +399,44 @@ class DockerBuilder:
         venv_folder = None
         try:
             self.log_info("Starting validation.")
-            self.package_root = self.find_package_root(folder)
-            venv_folder = self.create_venv()
-            self.test_import(venv_folder)
+            with self.phase('find_package_root'):
+                self.package_root = self.find_package_root(folder)
+            if STATIC_CHECK:
+                with self.phase('static_check'):
+                    self.static_check()
+            self.exclude_rules = context.ExcludeRules.from_folder(self.package_root, CONTEXT_EXCLUDES)
+            self.log_debug("Build context exclusion patterns : %s" % ' '.join(self.exclude_rules.patterns))
+            with self.phase('dockerfile'):
+                self.create_dockerfile()
+            with self.phase('fingerprint'):
+                self.fingerprint = self.compute_fingerprint()
+            if self.image_lookup:
+                reusable = self.find_reusable_image()
+                metrics.inc('jobmanager_builder_cache_total', {'cache': 'image', 'result': 'hit' if reusable else 'miss'})
+                if reusable:
+                    self.log_info("Validation skipped, identical package already validated.")
+                    return
+            if self.use_wheels:
+                with self.phase('wheels'):
+                    self.create_wheels()
+            if VALIDATION_MODE == 'image':
+                self.log_info("Validation finished, imports will be tested in the built image.")
+                return
+            if self.pipelined:
+                self.start_speculative_build()
+            with self.phase('venv'):
+                venv_folder = self.create_venv()
+            with self.phase('import_test'):
+                self.test_import(venv_folder)
             self.log_info("Validation finished.")
         except Exception as e:
             self.log_error("Error : %s" % str(e))
+            self.cancel_speculative_build()
+            self.clean()
             raise
         finally:
             if venv_folder:
-                shutil.rmtree(venv_folder, ignore_errors=True)
+                get_venv_cache().release(venv_folder)
 
     def build(self):
         """
@@ -109,190 +445,703 @@ class DockerBuilder:
         """
         try:
             self.log_info("Starting build.")
-            self.create_dockerfile()
-            img = self.create_docker_image()
+            if self.reused_image:
+                with self.phase('docker_tag'):
+                    img = self.reuse_docker_image()
+            elif self.speculative_build:
+                with self.phase('pipeline_wait'):
+                    img = self.finish_speculative_build()
+            elif VALIDATION_MODE == 'image':
+                img = self.create_validated_image()
+            else:
+                with self.phase('docker_build'):
+                    img = self.create_docker_image()
             if self.registry_url:
-                self.push_docker_image(img)
+                with self.phase('push'):
+                    self.push_docker_image(img)
+            self.image_size = img.attrs.get('Size')
+            if self.image_size is not None:
+                metrics.set_gauge('jobmanager_builder_image_bytes', self.image_size)
             self.log_info("Build finished.")
             return img
         except Exception as e:
             self.log_error("Error : %s" % str(e))
+            self.cancel_speculative_build()
             raise
+        finally:
+            self.clean()
+
+    def clean(self):
+        """
+        Remove temporary folders created by the build.
+        """
+        if self.wheel_folder:
+            shutil.rmtree(self.wheel_folder, ignore_errors=True)
+            self.wheel_folder = None
+        with _active_builders_lock:
+            _active_builders.discard(self)
+
+    def references(self):
+        """
+        Images and folders used by this build.
+        :return: tuple (set of image references, set of folders)
+        """
+        images = {self.base_image, self.image_name, self.dependency_image, self.speculative_tag}
+        images.update("%s:%s" % (self.image_name, t) for t in self.tags)
+        if self.reused_image:
+            images.add(self.reused_image.uuid)
+        folders = {self.upload_folder, self.package_root, self.wheel_folder} | self.buildkit_cache_sources
+        return images - {None}, folders - {None}
 
     def find_package_root(self, folder):
         """
         Scan folder to get the package root containing all import modules.
-        If no or only part of imported modules are found, raise exception.
+        The tree is walked once (without pruned directories, and down to PACKAGE_SEARCH_MAX_DEPTH) to index every
+        module path, then all imports are resolved against this index.
+        If no or only part of imported modules are found, or if several roots contain them, raise exception.
         """
         self.log_info("Searching for package root folder to import %s" % ', '.join(self.imports))
-        for root, dirs, files in os.walk(folder):
-            found = 0
-            for imp in self.imports:
-                mod_path = imp.strip('./').replace('.', '/')
-                if os.path.isfile(os.path.join(root, mod_path + ".py")) or os.path.isfile(
-                        os.path.join(root, mod_path, "__init__.py")):
-                    found += 1
-            if found == 0:
-                continue
-            elif found != len(self.imports):
-                raise Exception("Found %d imports in %s except we should have found %d" % (found, root, len(self.imports)))
-            else:
-                relpath = os.path.relpath(root, folder)
-                self.log_info("Found package root in %s" % relpath)
-                return root
-        raise Exception("Found no entrypoint corresponding to '%s' in uploaded file." % (', '.join(self.imports)))
+        modules = {}  # module path (a/b) -> set of roots (relative to folder) where it can be imported from
+        rules = context.ExcludeRules(context.DEFAULT_EXCLUDES + PACKAGE_SEARCH_EXCLUDES + CONTEXT_EXCLUDES)
+        for root, relroot, dirs, files in rules.walk(folder):
+            parts = relroot.strip('/').split('/') if relroot else []
+            if len(parts) >= PACKAGE_SEARCH_MAX_DEPTH:
+                dirs[:] = []
+            for name in files:
+                if not name.endswith('.py'):
+                    continue
+                path = parts if name == '__init__.py' else parts + [name[:-3]]
+                # every identifier suffix of the path is a module importable from the folder before it
+                for i in range(len(path) - 1, -1, -1):
+                    if not path[i].isidentifier():
+                        break
+                    modules.setdefault('/'.join(path[i:]), set()).add('/'.join(path[:i]))
+
+        wanted = [imp.strip('./').replace('.', '/') for imp in self.imports]
+        found = [modules.get(mod_path, set()) for mod_path in wanted]
+        roots = set.intersection(*found) if found else set()
+        if not roots:
+            partial = [imp for imp, imp_roots in zip(self.imports, found) if imp_roots]
+            if partial:
+                raise Exception("Found %s but not %s in a same folder of uploaded file." % (
+                    ', '.join(partial), ', '.join(imp for imp in self.imports if imp not in partial)))
+            raise Exception("Found no entrypoint corresponding to '%s' in uploaded file." % (', '.join(self.imports)))
+
+        def depth(root):
+            return len(root.split('/')) if root else 0
+        roots = sorted(roots, key=lambda r: (depth(r), r))
+        shallowest = [r for r in roots if depth(r) == depth(roots[0])]
+        if len(shallowest) > 1:
+            raise Exception("Ambiguous package root, %s found in : %s" % (
+                ', '.join(self.imports), ', '.join(r or '.' for r in shallowest)))
+        if len(roots) > 1:
+            self.log_info("Warning : %s also found in %s, using the top level one." % (
+                ', '.join(self.imports), ', '.join(r or '.' for r in roots[1:])))
+        self.log_info("Found package root in %s" % (roots[0] or '.'))
+        return os.path.join(folder, roots[0]) if roots[0] else folder
+
+    def static_check(self):
+        """
+        Analyse package sources without importing them, to fail before requirements are installed when an
+        entry point is missing or a package module has a syntax error. Unresolved imports are only reported, the
+        import test deciding.
+        """
+        start = time.time()
+        result = package_tester.static_scan(self.imports, self.package_root)
+        self.log_debug("Static analysis of %d modules in %.3fs" % (len(result['modules']), time.time() - start))
+        if result['result'] == "error":
+            raise Exception("Error in package %s :\n%s" % (','.join(self.imports), result['error']))
+        for warning in result['warnings']:
+            self.log_info("Static analysis warning : %s" % warning)
+        self.jobs = result['jobs']
+        self.tasks = result['job_tasks']
+        self.log_info("Static analysis OK - Candidate jobs : %s" % (', '.join(self.jobs) or 'none'))
+        if result['external_imports']:
+            self.log_debug("External modules imported : %s" % ', '.join(result['external_imports']))
+
+    def compute_fingerprint(self):
+        """
+        Compute a deterministic fingerprint of the build inputs : package tree (paths, modes and contents, without
+        excluded files), imports, requirements, apt packages, base image and rendered Dockerfile.
+        Two builds with the same fingerprint produce the same image.
+        """
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            'imports': self.imports,
+            'requirements': cache.normalize_requirements(self.requirements),
+            'apt_packages': sorted(set(self.apt_packages)),
+            'base_image': self.base_image,
+            'base_image_id': self.get_base_image_id(),
+            'dockerfile': self.dockerfile_content
+        }, sort_keys=True).encode('utf-8'))
+
+        for root, relroot, dirs, files in self.exclude_rules.walk(self.package_root):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                h.update(("\n%s %o\n" % (relroot + name, stat.S_IMODE(st.st_mode))).encode('utf-8'))
+                if stat.S_ISLNK(st.st_mode):
+                    h.update(os.readlink(path).encode('utf-8'))
+                    continue
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        h.update(chunk)
+
+        fingerprint = h.hexdigest()
+        self.log_debug("Build fingerprint : %s" % fingerprint)
+        return fingerprint
+
+    def get_base_image_id(self):
+        """
+        Id of the base image if it is present locally, so that a moved base image tag changes the fingerprint.
+        """
+        try:
+            return get_docker_session().client.images.get(self.base_image).id
+        except docker.errors.ImageNotFound:
+            return None
+
+    def find_reusable_image(self):
+        """
+        Look for an image already built with the same fingerprint and still present locally.
+        If found, validation results of that image are reused and no new image will be built.
+        """
+        record = self.image_lookup(self.fingerprint)
+        if not record:
+            return None
+        try:
+            get_docker_session().client.images.get(record.uuid)
+        except docker.errors.ImageNotFound:
+            self.log_info("Image %s has the same fingerprint but is not present anymore, rebuilding." % record.uuid)
+            return None
+        self.log_info("Identical package already built as image %s (%s), reusing it." % (record.uuid, record.name))
+        self.reused_image = record
+        self.jobs = list(record.jobs)
+        self.tasks = list(record.tasks)
+        return record
+
+    def create_wheels(self):
+        """
+        Build wheels of all requirements (and their dependencies) in a build wheel folder.
+        Wheels already present in the shared wheelhouse are reused instead of being downloaded or compiled again.
+        The same wheels are installed in the validation virtual env and in the docker image.
+        """
+        self.log_info("Building wheels of requirements.")
+        self.wheel_folder = tempfile.mkdtemp(prefix="jobmanager-wheels-")
+        res = tbx.process.execute(
+            "{python} -m pip wheel --wheel-dir {wheel_folder} --find-links {wheelhouse} {requirements}".format(
+                python=sys.executable,
+                wheel_folder=self.wheel_folder,
+                wheelhouse=WHEELHOUSE_FOLDER,
+                requirements=' '.join(self.requirements)),
+            logger=self.logger,
+            line_function=self.log_debug,
+            return_output=False
+        )
+        if res:
+            raise Exception("Error while building wheels of requirements %s (pip exited with code %s)" % (self.requirements, res))
+
+        added = cache.add_to_wheelhouse(self.wheel_folder, WHEELHOUSE_FOLDER)
+        self.log_info("Wheels OK. %d new wheel(s) added to wheelhouse." % len(added))
 
     def create_venv(self):
         """
-        Create virtual env and add requirements.
+        Get a virtual env with requirements installed from the virtual env cache.
+        Virtual env is only created on cache miss (i.e. when the requirement set has never been seen).
         """
         self.log_info("Creating Virtual Env.")
-        venv_folder = os.path.join(self.package_root, "venv")
-        if not os.path.isdir(venv_folder):
-            tmp_env = venv.EnvBuilder(system_site_packages=False, symlinks=False, with_pip=True)
-            tmp_env.create(venv_folder)
+        venv_folder, cache_hit = get_venv_cache().acquire(self.requirements, self.install_venv)
+        metrics.inc('jobmanager_builder_cache_total', {'cache': 'venv', 'result': 'hit' if cache_hit else 'miss'})
+        if cache_hit:
+            self.log_info("Virtual env found in cache. Requirements already installed.")
+        else:
+            self.log_info("Virtual env OK. Requirements installed.")
+        return venv_folder
 
-            venv_pip = os.path.join(venv_folder, "bin/pip")
+    def install_venv(self, venv_folder):
+        """
+        Create virtual env in venv_folder and add requirements.
+        """
+        tmp_env = venv.EnvBuilder(system_site_packages=False, symlinks=False, with_pip=True)
+        tmp_env.create(venv_folder)
 
-            self.log_info("Installing pip requirements in virtual env...")
+        # pip is run as a module as the virtual env is moved into the cache afterwards (scripts shebangs are absolute)
+        venv_python = os.path.join(venv_folder, "bin/python")
+
+        find_links = ""
+        if self.wheel_folder:
+            find_links = "--find-links %s " % self.wheel_folder
+
+        self.log_info("Installing pip requirements in virtual env...")
+        with self.phase('pip_install'):
             res = tbx.process.execute(
-                "{pip} install jobmanager-common {requirements}".format(
-                    pip=venv_pip,
+                "{python} -m pip install {find_links}jobmanager-common {requirements}".format(
+                    python=venv_python,
+                    find_links=find_links,
                     requirements=' '.join(self.requirements)),
                 logger=self.logger,
                 line_function=self.log_debug,
                 return_output=False
             )
-            if res:
-                raise Exception("Error while installing requirements %s : %s %s" % (
-                    self.requirements, res.stdout.decode('utf-8'), res.stderr.decode('utf-8')))
-
-        self.log_info("Virtual env OK. Requirements installed.")
-        return venv_folder
+        if res:
+            raise Exception("Error while installing requirements %s (pip exited with code %s)" % (self.requirements, res))
 
     def test_import(self, venv_folder):
         """
-        Test importing the imports/packages.
+        Test importing the imports/packages, with the warm import checker of the virtual env.
         """
         self.log_debug("Testing import of %s " % (','.join(self.imports)))
-        package_tester_source = os.path.join(os.path.dirname(__file__), "package_tester.py")
-        package_tester = os.path.join(self.package_root, "package_tester.py")
-        shutil.copy(package_tester_source, package_tester)
-        venv_python_executable = os.path.join(venv_folder, "bin/python")
-
-        output = tbx.process.execute(
-            "{python} {package_tester} {imports}".format(
-                python=venv_python_executable,
-                package_tester=package_tester,
-                imports=" ".join(self.imports)
-            ),
-            logger=self.logger,
-            env={'PYTHONPATH': self.package_root},
-            return_output=True,
-            timeout=10
-        )
+        start = time.time()
+        result = get_import_checkers().get(venv_folder).check(self.package_root, self.imports, IMPORT_CHECK_TIMEOUT)
+        self.log_debug("Import check done in %.2fs" % (time.time() - start))
+        self.read_import_result(result)
+
+    def test_image_import(self, image):
+        """
+        Test importing the imports/packages with package_tester, in a container of the built image without network,
+        so that they are tested with the Python, requirements and system libraries they will run with.
+        """
+        self.log_debug("Testing import of %s in image" % (','.join(self.imports)))
+        start = time.time()
+        client = get_docker_session().client
+        with open(checker.PACKAGE_TESTER) as f:
+            source = f.read()
+        container = client.containers.run(image.id, entrypoint=['python3', '-c', source],
+                                          command=['--child', str(IMPORT_CHECK_TIMEOUT)] + list(self.imports),
+                                          working_dir=IMAGE_PACKAGE_FOLDER, network_mode='none', detach=True)
+        try:
+            try:
+                status = container.wait(timeout=IMPORT_CHECK_TIMEOUT + CONTAINER_START_TIMEOUT)
+            except requests.exceptions.RequestException:
+                raise Exception("Import of %s in image took more than %d seconds." % (', '.join(self.imports), IMPORT_CHECK_TIMEOUT))
+            output = container.logs(stdout=True, stderr=False).decode('utf-8', errors='replace')
+            errors = container.logs(stdout=False, stderr=True).decode('utf-8', errors='replace')
+        finally:
+            container.remove(force=True)
+        self.log_debug("Import check in image done in %.2fs" % (time.time() - start))
+        lines = [line for line in output.splitlines() if line.strip()]
+        try:
+            result = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            raise Exception("Import check in image failed (exit code %s) :\n%s" % (status.get('StatusCode'), errors.strip()[-2000:]))
+        self.read_import_result(result)
 
-        result = json.loads(output)
+    def read_import_result(self, result):
+        """
+        Raise if a package_tester import check failed, else keep found jobs and tasks.
+        """
         status = result.get('result')
         if status == "error" and result.get('error'):
+            if result.get('traceback'):
+                self.log_debug(result['traceback'])
             raise Exception("Error importing package %s :\n%s" % (','.join(self.imports), result.get('error')))
 
         assert result['result'] == "success"
         self.jobs = result.get('jobs', [])
-        self.tasks = result.get('tasks', [])
+        self.tasks = result.get('job_tasks', [])
         self.log_info(
             "Successful import %s - Job found : %s" % (','.join(self.imports), self.jobs))
 
-        # clean
-        os.remove(package_tester)
-        shutil.rmtree(venv_folder, ignore_errors=True)
-
     def create_dockerfile(self):
 
         self.log_info("Building Dockerfile for %s" % self.image_name)
 
         build_script = os.path.join(self.package_root, 'build.sh')
 
-        template = jinja2.Template("""FROM {{base_image}}
-{% if apt_packages %}
+        # Dependencies are normalized and sorted so that identical sets always produce identical layers
+        # With BuildKit, apt and pip download caches are kept between builds in cache mounts, out of image layers
+        dependencies_template = jinja2.Template("""FROM {{base_image}}
+{% if apt_packages and buildkit %}
+RUN --mount=type=cache,target=/var/cache/apt,sharing=locked \
+    --mount=type=cache,target=/var/lib/apt/lists,sharing=locked \
+    rm -f /etc/apt/apt.conf.d/docker-clean && \
+    apt-get -y update && \
+    apt-get -y --no-install-recommends install {{apt_packages}}
+{% elif apt_packages %}
 RUN apt-get -y update && \
     apt-get -y --no-install-recommends install {{apt_packages}}  && \
     rm -rf /var/lib/apt/lists/*
 {% endif %}
-{% if requirements %}
+{% if requirements and wheels and buildkit %}
+RUN --mount=type=bind,source=wheels,target=/tmp/wheels \
+    pip3 install --no-cache-dir --no-index --find-links /tmp/wheels {{requirements}}
+{% elif requirements and wheels %}
+COPY wheels /tmp/wheels
+RUN pip3 install --no-cache-dir --no-index --find-links /tmp/wheels {{requirements}} && \
+    rm -rf /tmp/wheels
+{% elif requirements and buildkit %}
+RUN --mount=type=cache,target=/root/.cache/pip \
+    pip3 install {{requirements}}
+{% elif requirements %}
 RUN pip3 install --no-cache-dir {{requirements}}
 {% endif %}
-COPY . /opt/lib
+            """.strip(), trim_blocks=True, lstrip_blocks=True)
+        self.dependencies_dockerfile_content = dependencies_template.render(
+            apt_packages=' '.join(sorted(set(self.apt_packages))),
+            requirements=' '.join(cache.normalize_requirements(self.requirements)),
+            base_image=self.base_image,
+            wheels=self.use_wheels,
+            buildkit=BUILD_ENGINE == 'buildkit'
+        ).strip()
+
+        self.dependency_image = None
+        if self.use_dependency_image and not can_use_dependency_images():
+            self.log_info("Dependency images disabled : BuildKit builder %s does not see local images." % BUILDKIT_BUILDER)
+            self.use_dependency_image = False
+        if self.use_dependency_image and (self.apt_packages or self.requirements):
+            self.dependency_image = "%s:%s" % (DEPENDENCY_IMAGE_REPOSITORY, self.get_dependency_hash())
+
+        template = jinja2.Template("""{% if dependency_image %}
+FROM {{dependency_image}}
+{% else %}
+{{dependencies}}
+{% endif %}
+COPY package /opt/lib
 {% if build_script_exists %}
 RUN /opt/lib/build.sh
 {% endif %}
 ENV JOBMANAGER_CLIENT_IMPORTS="{{modules}}"
             """.strip(), trim_blocks=True, lstrip_blocks=True)
         dockerfile_content = template.render(
-            apt_packages=' '.join(self.apt_packages),
+            dependencies=self.dependencies_dockerfile_content,
+            dependency_image=self.dependency_image,
             modules=','.join(self.imports),
-            requirements=' '.join(self.requirements),
-            build_script_exists=os.path.isfile(build_script),
-            base_image=self.base_image
+            build_script_exists=os.path.isfile(build_script)
         )
         self.dockerfile_content = dockerfile_content
         return dockerfile_content
 
-    def create_docker_image(self):
+    def get_dependency_hash(self):
+        """
+        Hash of the dependency layers (base image, apt packages and pip requirements), used to tag dependency images.
+        """
+        h = hashlib.sha256()
+        h.update(self.dependencies_dockerfile_content.encode('utf-8'))
+        h.update(str(self.get_base_image_id()).encode('utf-8'))
+        return h.hexdigest()[:16]
+
+    def create_build_context(self, dockerfile_content, include_package=True, include_wheels=True, stats=None):
+        """
+        Create the docker build context archive : Dockerfile, package root in 'package' folder (without excluded
+        files) and requirement wheels in 'wheels' folder.
+        When the package was uploaded as a tar archive, package files are read directly from it.
+        :return: generator of the tar archive chunks, streamed to the docker daemon
+        """
+        entries = [[context.bytes_entry('Dockerfile', dockerfile_content.encode('utf-8'))]]
+        if include_package and self.archive:
+            prefix = os.path.relpath(self.package_root, self.upload_folder)
+            entries.append(context.archive_entries(self.archive, prefix, 'package', self.exclude_rules))
+        elif include_package:
+            entries.append(context.folder_entries(self.package_root, 'package', self.exclude_rules))
+        if include_wheels and self.wheel_folder:
+            entries.append(context.folder_entries(self.wheel_folder, 'wheels'))
+        return context.tar_stream(itertools.chain(*entries), stats)
+
+    def create_dependency_image(self, client):
+        """
+        Build the dependency image (base image with apt packages and pip requirements installed), unless an image
+        with the same dependency hash already exists. Code only builds then start from it.
+        Concurrent builds with the same dependencies wait for the first one to build it.
+        """
+        with get_dependency_image_lock(self.dependency_image):
+            try:
+                touch_image(client.images.get(self.dependency_image))
+                self.log_info("Dependency image %s found, reusing it." % self.dependency_image)
+                metrics.inc('jobmanager_builder_cache_total', {'cache': 'dependency_image', 'result': 'hit'})
+                return
+            except docker.errors.ImageNotFound:
+                metrics.inc('jobmanager_builder_cache_total', {'cache': 'dependency_image', 'result': 'miss'})
+
+            self.log_info("Building dependency image %s" % self.dependency_image)
+            build_context = self.create_build_context(self.dependencies_dockerfile_content, include_package=False)
+            with self.phase('dependency_image'):
+                self.build_image(client, build_context, self.dependency_image)
+            self.log_info("Dependency image %s - build success." % self.dependency_image)
+
+    @staticmethod
+    def temporary_tag():
+        return "%s:%s" % (PIPELINE_REPOSITORY, hashlib.sha256(os.urandom(16)).hexdigest()[:16])
+
+    def start_speculative_build(self):
+        """
+        Start building the docker image while validation goes on. The image gets a temporary tag in
+        PIPELINE_REPOSITORY, image name and tags are only set by build() once validation succeeded.
+        """
+        self.speculative_tag = self.temporary_tag()
+        self.log_info("Building image %s during validation." % self.image_name)
+
+        def speculative_build():
+            try:
+                with self.phase('docker_build'):
+                    return self.build_docker_image(self.speculative_tag)
+            finally:
+                with self.speculative_lock:
+                    self.speculative_finished = True
+                if self.cancelled.is_set():
+                    self.remove_speculative_image()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipelined-build")
+        self.speculative_build = executor.submit(speculative_build)
+        executor.shutdown(wait=False)
+
+    def finish_speculative_build(self):
+        """
+        Wait for the image built during validation, then set its name and tags.
+        """
+        image = self.speculative_build.result()
+        self.speculative_build = None
+        return self.adopt_image(image)
+
+    def cancel_speculative_build(self):
+        """
+        Stop the image build started during validation, without waiting for it. What it built is removed once it
+        stopped, by the build thread itself if it is still running.
+        """
+        if not self.speculative_build:
+            return
+        with self.speculative_lock:
+            self.cancelled.set()
+            finished = self.speculative_finished
+        self.speculative_build = None
+        if finished:
+            self.remove_speculative_image()
+            return
+        self.log_info("Cancelling build of image %s." % self.image_name)
+        process = self.build_process
+        if process:
+            process.terminate()
+
+    def remove_speculative_image(self):
+        """
+        Remove the temporary tag of the image built during validation, and the image itself if it has no other tag.
+        """
+        try:
+            get_docker_session().client.images.remove(self.speculative_tag)
+        except docker.errors.ImageNotFound:
+            pass
+        except docker.errors.APIError as e:
+            self.log_debug("Unable to remove image %s : %s" % (self.speculative_tag, str(e)))
+
+    def create_validated_image(self):
         """
-        Create Dockerfile
+        Build the docker image with a temporary tag, and test imports in it. The image gets its name and tags if
+        imports succeed, and is removed otherwise.
         """
-        registry_url = DOCKER_REGISTRY_URL or os.environ.get('DOCKER_REGISTRY_URL')
-        registry_username = DOCKER_REGISTRY_USERNAME or os.environ.get('DOCKER_REGISTRY_USERNAME', None)
-        registry_password = DOCKER_REGISTRY_PASSWORD or os.environ.get('DOCKER_REGISTRY_PASSWORD', None)
+        self.speculative_tag = self.temporary_tag()
+        with self.phase('docker_build'):
+            image = self.build_docker_image(self.speculative_tag)
+        try:
+            with self.phase('import_test'):
+                self.test_image_import(image)
+        except Exception:
+            self.remove_speculative_image()
+            raise
+        return self.adopt_image(image)
 
-        dockerfile = BytesIO(self.dockerfile_content.encode('utf-8'))
+    def adopt_image(self, image):
+        """
+        Set image name and tags to an image built with a temporary tag, once validated.
+        """
+        image.tag(self.image_name)
+        self.remove_speculative_image()
+        self.tag_docker_image(image)
+        self.log_info("Image %s - build success." % self.image_name)
+        return image
 
-        client = docker.from_env()
+    def build_docker_image(self, tag):
+        """
+        Build the docker image (and the dependency image it starts from) with the given tag.
+        :return: docker image
+        """
+        registry_url, registry_username, registry_password = get_registry_credentials()
+
+        client = get_docker_session().client
 
         if registry_url and registry_username:
-            self.log_debug("login to registry %s@%s" % (registry_username, registry_url))
-            client.login(registry=registry_url, username=registry_username, password=registry_password)  # email=email)
-            self.log_info("Logged in to registry %s@%s" % (registry_username, registry_url))
+            self.login(registry_url, registry_username, registry_password)
+
+        if self.dependency_image:
+            self.create_dependency_image(client)
 
         self.log_info("Building %s" % self.image_name)
-        images = client.images.build(path=self.package_root, fileobj=dockerfile, tag=self.image_name)
-        image = images[0]
+        stats = {}
+        build_context = self.create_build_context(self.dockerfile_content, include_wheels=not self.dependency_image, stats=stats)
+        image = self.build_image(client, build_context, tag)
+        self.context_size = stats.get('size')
+        self.context_files = stats.get('files')
+        metrics.set_gauge('jobmanager_builder_context_bytes', self.context_size)
+        metrics.set_gauge('jobmanager_builder_context_files', self.context_files)
+        self.log_info("Build context sent to docker : %d files, %.1f MB" % (self.context_files, self.context_size / 1048576.0))
+        return image
+
+    def create_docker_image(self):
+        """
+        Build the docker image, with image name and tags.
+        """
+        image = self.build_docker_image(self.image_name)
+        self.tag_docker_image(image)
+        self.log_info("Image %s - build success." % self.image_name)
+        return image
+
+    def build_image(self, client, build_context, tag):
+        """
+        Build an image from a build context stream, with the configured build engine.
+        :return: docker image
+        """
+        build_context = self.cancellable(build_context)
+        if BUILD_ENGINE == 'buildkit':
+            return self.buildkit_build(client, build_context, tag)
+        return self.classic_build(client, build_context, tag)
+
+    def cancellable(self, chunks):
+        for chunk in chunks:
+            if self.cancelled.is_set():
+                raise Exception("Image build cancelled.")
+            yield chunk
+
+    def classic_build(self, client, build_context, tag):
+        """
+        Build an image with the classic builder, build output being sent to debug logs.
+        When the build is cancelled, the connection is closed, which makes the docker daemon stop the build.
+        Intermediate containers are always removed.
+        :return: docker image
+        """
+        image_id = None
+        stream = client.api.build(fileobj=build_context, custom_context=True, tag=tag, rm=True, forcerm=True, decode=True)
+        try:
+            for event in stream:
+                if self.cancelled.is_set():
+                    raise Exception("Image build cancelled.")
+                if event.get('error'):
+                    raise Exception("Docker build of %s failed : %s" % (tag, event['error']))
+                if event.get('stream', '').strip():
+                    self.log_debug(event['stream'].rstrip())
+                    match = re.search(r'^Successfully built ([0-9a-f]+)$', event['stream'].strip())
+                    if match and not image_id:
+                        image_id = match.group(1)
+                if 'ID' in (event.get('aux') or {}):
+                    image_id = event['aux']['ID']
+        finally:
+            stream.close()
+        if not image_id:
+            raise Exception("Docker build of %s returned no image." % tag)
+        return client.images.get(image_id)
+
+    def buildkit_build(self, client, build_context, tag):
+        """
+        Build an image with BuildKit (docker buildx), the build context being streamed on its standard input.
+        When BUILDKIT_CACHE_FOLDER is set, layer cache of the image repository is imported from it, and exported
+        to a new folder replacing the previous one once the build succeeded. Failing to update the cache does not
+        fail the build.
+        :return: docker image
+        """
+        command = ['docker', 'buildx', 'build', '--progress', 'plain', '--load', '--tag', tag]
+        if BUILDKIT_BUILDER:
+            command += ['--builder', BUILDKIT_BUILDER]
+        cache_folder = export_folder = cache_source = None
+        if BUILDKIT_CACHE_FOLDER:
+            cache_folder = os.path.join(BUILDKIT_CACHE_FOLDER, buildkit_cache_key(tag, self.image_name))
+            cache_source = os.path.realpath(cache_folder)  # resolved once, the link can be replaced meanwhile
+            self.buildkit_cache_sources.add(cache_source)
+            if os.path.isfile(os.path.join(cache_source, 'index.json')):
+                command += ['--cache-from', 'type=local,src=%s' % cache_source]
+            os.makedirs(BUILDKIT_CACHE_FOLDER, exist_ok=True)
+            export_folder = tempfile.mkdtemp(prefix='.export-', dir=BUILDKIT_CACHE_FOLDER)
+            command += ['--cache-to', 'type=local,dest=%s,mode=max' % export_folder]
+        command.append('-')
+
+        self.log_debug("Executing %s" % ' '.join(command))
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.build_process = process
+        if self.cancelled.is_set():
+            process.terminate()
+        errors = []
+
+        def send_context():
+            try:
+                for chunk in build_context:
+                    process.stdin.write(chunk)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        sender = threading.Thread(target=send_context, name="buildkit-context", daemon=True)
+        sender.start()
+        for line in process.stdout:
+            self.log_debug(line.decode('utf-8', errors='replace').rstrip())
+        returncode = process.wait()
+        sender.join()
+        self.build_process = None
+        try:
+            if self.cancelled.is_set():
+                raise Exception("Image build cancelled.")
+            if errors:
+                raise errors[0]
+            if returncode:
+                raise Exception("BuildKit build of %s failed (docker buildx exited with code %d)" % (tag, returncode))
+            if export_folder:
+                self.buildkit_cache_sources.discard(cache_source)
+                try:
+                    update_buildkit_cache(cache_folder, export_folder)
+                    export_folder = None
+                except OSError as e:
+                    self.log_info("BuildKit layer cache of %s not updated : %s" % (tag, e))
+        finally:
+            self.buildkit_cache_sources.discard(cache_source)
+            if export_folder:
+                shutil.rmtree(export_folder, ignore_errors=True)
+        return client.images.get(tag)
+
+    def reuse_docker_image(self):
+        """
+        Apply image name and tags to the already built image with the same fingerprint.
+        """
+        client = get_docker_session().client
+        image = client.images.get(self.reused_image.uuid)
+        self.log_info("Reusing image %s as %s" % (self.reused_image.uuid, self.image_name))
+        image.tag(self.image_name)
+        self.tag_docker_image(image)
+        return image
+
+    def tag_docker_image(self, image):
         for t in self.tags:
             self.log_info("Adding tag %s to %s" % (t, self.image_name))
             image.tag(self.image_name, tag=t)
-        self.log_info("Image %s - build success." % self.image_name)
 
         self.image_uuid = image.short_id[7:]
         self.image_id = str(image.id)[19:]
+        touch_image(image)
 
         image.reload()
         return image
 
+    def login(self, registry_url, registry_username, registry_password):
+        self.log_debug("login to registry %s@%s" % (registry_username, registry_url))
+        if get_docker_session().login(registry_url, registry_username, registry_password):
+            self.log_info("Logged in to registry %s@%s" % (registry_username, registry_url))
+        else:
+            self.log_debug("Already logged in to registry %s@%s" % (registry_username, registry_url))
+
     def push_docker_image(self, image):
         """
         Push docker image to repo
         """
         self.log_debug("Tagging image %s and uploading it to %s" % (self.image_name, self.registry_url))
 
-        client = docker.from_env()
+        client = get_docker_session().client
 
-        registry_url = DOCKER_REGISTRY_URL or os.environ.get('DOCKER_REGISTRY_URL')
-        registry_username = DOCKER_REGISTRY_USERNAME or os.environ.get('DOCKER_REGISTRY_USERNAME', None)
-        registry_password = DOCKER_REGISTRY_PASSWORD or os.environ.get('DOCKER_REGISTRY_PASSWORD', None)
+        registry_url, registry_username, registry_password = get_registry_credentials()
 
         def tag_repo(repo):
             for t in self.tags:
                 self.log_info("Adding registry tag %s:%s" % (repo, t))
                 image.tag(repo, t)
 
-        registry_url = registry_url.rstrip('/')
-
         if registry_username:
-            registry_username = registry_username.rstrip('/')
-            self.log_debug("login to registry %s@%s" % (registry_username, registry_url))
-            client.login(registry=registry_url, username=registry_username, password=registry_password)  # email=email)
-            self.log_info("Logged in to registry %s@%s" % (registry_username, registry_url))
+            self.login(registry_url, registry_username, registry_password)
 
             repo_small_url = "%s/%s" % (registry_username, self.image_name)
             tag_repo(repo_small_url)
@@ -303,10 +1152,59 @@ ENV JOBMANAGER_CLIENT_IMPORTS="{{modules}}"
             repo_full_url = "%s/%s" % (registry_url, self.image_name)
             tag_repo(repo_full_url)
 
-        for t in self.tags:
-            self.log_info("Pushing image %s:%s ..." % (repo_full_url, t))
-            client.images.push(repository=repo_full_url, tag=t)
+        # The short repository name is a local alias only, pushing it would target the default registry (Docker Hub)
+        workers = max(1, min(DOCKER_PUSH_CONCURRENCY, len(self.tags)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.push_tag, client, repo_full_url, t) for t in self.tags]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                get_docker_session().logout(registry_url, registry_username)
+                raise
 
         image.reload()
         self.image_url = [repo_full_url+":"+t for t in self.tags]
         return image
+
+    def push_tag(self, client, repository, tag):
+        """
+        Push one tag of an image, streaming push progress of each layer to progress logs.
+        """
+        self.log_info("Pushing image %s:%s ..." % (repository, tag))
+        layers = {}
+        start = last_report = time.time()
+        for event in client.api.push(repository, tag=tag, stream=True, decode=True):
+            if event.get('error'):
+                raise Exception("Error while pushing %s:%s : %s" % (repository, tag, event['error']))
+            layer_id = event.get('id')
+            status = event.get('status', '')
+            if not layer_id:
+                continue
+
+            layer = layers.setdefault(layer_id, {'status': None, 'current': 0, 'total': 0})
+            detail = event.get('progressDetail') or {}
+            if detail.get('total'):
+                layer['current'] = detail.get('current', 0)
+                layer['total'] = detail['total']
+            if status != layer['status']:
+                layer['status'] = status
+                if status == 'Pushed':
+                    layer['current'] = layer['total']
+                self.log_debug("%s:%s - layer %s : %s" % (repository, tag, layer_id, status))
+
+            if time.time() - last_report > 1.0:
+                last_report = time.time()
+                self.log_info("Pushing %s:%s - %s" % (repository, tag, self.push_summary(layers)))
+
+        self.push_timings[tag] = time.time() - start
+        self.log_info("Pushed image %s:%s - %s" % (repository, tag, self.push_summary(layers)))
+
+    @staticmethod
+    def push_summary(layers):
+        pushed = [l for l in layers.values() if l['status'] == 'Pushed']
+        existing = [l for l in layers.values() if l['status'] == 'Layer already exists']
+        transferred = sum(l['current'] for l in layers.values() if l['status'] != 'Layer already exists')
+        total = sum(l['total'] for l in layers.values() if l['status'] != 'Layer already exists')
+        return "%d/%d layers pushed, %d already existing, %.1f/%.1f MB transferred" % (
+            len(pushed), len(layers) - len(existing), len(existing), transferred / 1048576.0, total / 1048576.0)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Headless builds of a local package, without web server nor database
+:author: Ronan Delacroix
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='jobmanager-builder build',
+                                     description='Build a Job Manager Client image from a local package, without '
+                                                 'web server nor database, and print the result as JSON.')
+    parser.add_argument('package', help='Package folder, python file or archive (tar, tar.gz, zip...).')
+    parser.add_argument('-n', '--name', required=True, help='Image name.')
+    parser.add_argument('-i', '--imports', nargs='+', required=True, metavar='MODULE', help='Modules containing jobs.')
+    parser.add_argument('--pip', nargs='+', default=[], metavar='REQUIREMENT', help='Pip requirements.')
+    parser.add_argument('--apt', nargs='+', default=[], metavar='PACKAGE', help='Apt packages.')
+    parser.add_argument('-t', '--tags', nargs='+', default=[], metavar='TAG', help='Image tags.')
+    parser.add_argument('--base-image', metavar='BASE IMAGE', help='Base Docker image of Job Manager Client.')
+    parser.add_argument('-r', '--registry-url', metavar='REGISTRY URL', help='Registry to push the image to.',
+                        default=os.environ.get('JOBMANAGER_BUILDER_REGISTRY_URL'))
+    parser.add_argument('-ru', '--registry-username', metavar='REGISTRY USERNAME',
+                        default=os.environ.get('JOBMANAGER_BUILDER_REGISTRY_USERNAME'))
+    parser.add_argument('-rp', '--registry-password', metavar='REGISTRY PASSWORD',
+                        default=os.environ.get('JOBMANAGER_BUILDER_REGISTRY_PASSWORD'))
+    parser.add_argument('--validation-mode', choices=('host', 'image'),
+                        help='Test imports in a host virtual env, or in a container of the built image.')
+    parser.add_argument('--pipelined', action='store_true', default=False,
+                        help='Build the Docker image while the package is validated.')
+    parser.add_argument('--build-engine', choices=('classic', 'buildkit'), help='Image build engine.')
+    parser.add_argument('--buildkit-builder', metavar='NAME', help='docker buildx builder instance.')
+    parser.add_argument('--buildkit-cache-folder', metavar='FOLDER', help='BuildKit layer cache folder.')
+    parser.add_argument('--venv-cache-folder', metavar='FOLDER', help='Folder where validation virtual envs are cached.')
+    parser.add_argument('--wheelhouse', metavar='FOLDER', help='Shared wheelhouse folder.')
+    parser.add_argument('--dependency-images', action='store_true', default=False,
+                        help='Build apt and pip dependencies in an intermediate image.')
+    parser.add_argument('--context-exclude', metavar='PATTERN', action='append', default=[],
+                        help='Build context exclusion pattern (.dockerignore syntax). Can be repeated.')
+    parser.add_argument('--no-static-check', action='store_true', default=False,
+                        help='Do not analyse package sources before installing requirements.')
+    parser.add_argument('-v', '--verbosity', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Log verbosity, on standard error.')
+    return parser
+
+
+def configure(args):
+    """
+    Set builder settings from command line arguments, the way the server does.
+    """
+    from . import lib
+    if args.base_image:
+        lib.BASE_IMAGE = args.base_image
+    if args.registry_url:
+        lib.DOCKER_REGISTRY_URL = args.registry_url
+        lib.DOCKER_REGISTRY_USERNAME = args.registry_username
+        lib.DOCKER_REGISTRY_PASSWORD = args.registry_password
+    if args.validation_mode:
+        lib.VALIDATION_MODE = args.validation_mode
+    if args.pipelined:
+        lib.PIPELINED_BUILDS = True
+    if args.build_engine:
+        lib.BUILD_ENGINE = args.build_engine
+    if args.buildkit_builder:
+        lib.BUILDKIT_BUILDER = args.buildkit_builder
+    if args.buildkit_cache_folder:
+        lib.BUILDKIT_CACHE_FOLDER = os.path.abspath(args.buildkit_cache_folder)
+    if args.venv_cache_folder:
+        lib.VENV_CACHE_FOLDER = os.path.abspath(args.venv_cache_folder)
+    if args.wheelhouse:
+        lib.WHEELHOUSE_FOLDER = os.path.abspath(args.wheelhouse)
+    if args.dependency_images:
+        lib.DEPENDENCY_IMAGES = True
+    if args.context_exclude:
+        lib.CONTEXT_EXCLUDES = args.context_exclude
+    if args.no_static_check:
+        lib.STATIC_CHECK = False
+    return lib
+
+
+def receive_package(path):
+    """
+    Extract a package file like an uploaded one.
+    :return: upload receiver
+    """
+    from . import upload
+    receiver = upload.UploadReceiver(os.path.basename(path))
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                receiver.write(chunk)
+        receiver.finish()
+    except Exception:
+        receiver.clean()
+        raise
+    return receiver
+
+
+def build(args, started=None):
+    """
+    Validate and build the image of a local package.
+    :return: result dict
+    """
+    timings = {}
+    start = time.time()
+    lib = configure(args)
+    timings['imports'] = time.time() - start
+    if started:
+        timings['startup'] = time.time() - started
+
+    receiver = None
+    folder, archive = os.path.abspath(args.package), None
+    try:
+        if not os.path.isdir(folder):
+            receiver = receive_package(folder)
+            folder, archive = receiver.package_folder, receiver.archive
+        lib.test_docker_api()
+        builder = lib.DockerBuilder(folder, args.name, args.tags, args.imports, args.pip, args.apt,
+                                    logger=logging.getLogger('jobmanager.builder'), archive=archive)
+        image = builder.build()
+    finally:
+        if receiver:
+            shutil.rmtree(receiver.folder, ignore_errors=True)
+        lib.get_import_checkers().stop()
+    timings.update(builder.timings)
+    timings['total'] = time.time() - (started or start)
+    return {
+        'result': "success",
+        'message': "Success! Image build OK!",
+        'name': builder.image_name,
+        'image_uuid': builder.image_uuid,
+        'image_id': builder.image_id,
+        'url': builder.image_url,
+        'tags': image.tags,
+        'jobs': builder.jobs,
+        'tasks': builder.tasks,
+        'requirements': builder.requirements,
+        'apt_packages': builder.apt_packages,
+        'fingerprint': builder.fingerprint,
+        'context_size': builder.context_size,
+        'context_files': builder.context_files,
+        'image_size': builder.image_size,
+        'push_timings': [{'tag': t, 'seconds': d} for t, d in sorted(builder.push_timings.items())],
+        'timings': timings
+    }
+
+
+def build_command(argv, started=None):
+    """
+    Run the build command. Only the modules needed by DockerBuilder are imported, once arguments are parsed.
+    :param started: process start time, to report startup duration
+    :return: exit code
+    """
+    args = get_parser().parse_args(argv)
+    logging.basicConfig(level=args.verbosity, stream=sys.stderr, format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        result = build(args, started)
+    except Exception as e:
+        logging.debug("Build failed", exc_info=True)
+        result = {'result': "error", 'message': str(e)}
+    print(json.dumps(result, indent=2, sort_keys=True, default=str))
+    return 1 if result['result'] == 'error' else 0
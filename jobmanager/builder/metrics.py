@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Build metrics, in Prometheus text format
+:author: Ronan Delacroix
+"""
+import threading
+
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+METRICS = {
+    'jobmanager_builder_builds_total': ('counter', "Builds processed, by result."),
+    'jobmanager_builder_phase_failures_total': ('counter', "Build failures, by phase."),
+    'jobmanager_builder_cache_total': ('counter', "Build cache lookups, by cache and result (hit or miss)."),
+    'jobmanager_builder_phase_seconds': ('histogram', "Duration of build phases."),
+    'jobmanager_builder_build_seconds': ('histogram', "Duration of whole builds, from start to result."),
+    'jobmanager_builder_queue_wait_seconds': ('histogram', "Time spent by builds in the build queue."),
+    'jobmanager_builder_context_bytes': ('gauge', "Build context size of the last built image."),
+    'jobmanager_builder_context_files': ('gauge', "Build context file count of the last built image."),
+    'jobmanager_builder_image_bytes': ('gauge', "Size of the last built image."),
+    'jobmanager_builder_queued_builds': ('gauge', "Builds waiting in the build queue."),
+    'jobmanager_builder_venv_cache_bytes': ('gauge', "Disk size of the virtual env cache."),
+    'jobmanager_builder_disk_usage_bytes': ('gauge', "Disk usage of images and build caches, at the last garbage collection."),
+    'jobmanager_builder_gc_reclaimed_bytes_total': ('counter', "Disk space reclaimed by garbage collection, by kind."),
+}
+
+
+class Registry:
+    """
+    Thread safe store of counters, gauges and histograms, identified by metric name and labels.
+    Gauges can also be computed when metrics are rendered, with gauge functions.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> value, or [bucket counts, sum, count] for histograms
+        self.gauge_functions = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.values.setdefault(key, [[0] * len(DURATION_BUCKETS), 0.0, 0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def set_function(self, name, function):
+        """
+        Register a gauge computed by function() each time metrics are rendered.
+        """
+        self.gauge_functions[name] = function
+
+    def render(self):
+        """
+        Render all metrics in Prometheus text exposition format.
+        """
+        with self.lock:
+            values = dict((key, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v) for key, v in self.values.items())
+        for name, function in self.gauge_functions.items():
+            try:
+                values[self.key(name, None)] = function()
+            except Exception:
+                continue
+
+        lines = []
+        for name in sorted(set(key[0] for key in values)):
+            kind, help_text = METRICS.get(name, ('untyped', ''))
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (metric, labels), value in sorted(values.items()):
+                if metric != name:
+                    continue
+                if kind != 'histogram':
+                    lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+                    continue
+                buckets, total, count = value
+                for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (('le', format_value(bound)),)), bucket_count))
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(total)))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+set_function = registry.set_function
+render = registry.render
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Database documents
+:author: Ronan Delacroix
+"""
+import mongoengine
+import jobmanager.common
+
+BUILD_STATUSES = ('queued', 'running', 'success', 'error')
+
+BUILD_EVENTS_MAX_SIZE = 64 * 1024 * 1024  # bytes
+
+
+class BuildRequest(jobmanager.common.NamedDocument):
+    """
+    Image build request. Created by the /build endpoint and claimed by build workers of any builder node.
+    The name of a build request is the name of the image to build.
+    Upload folders are local to the upload node, the uploaded file is stored in the database when shared.
+    Build logs are written to a file of the build node, and stored in the database once the build is finished.
+    """
+    meta = {
+        'queryset_class': jobmanager.common.SerializableQuerySet,
+        'indexes': [
+            'uuid',
+            'created',
+            ('status', 'created'),
+            ('status', 'lease_expires'),
+            'batch'
+        ]
+    }
+    status = mongoengine.StringField(default='queued', choices=BUILD_STATUSES)
+    filename = mongoengine.StringField()
+    upload = mongoengine.FileField(collection_name='build_uploads')
+    upload_shared = mongoengine.BooleanField(default=False)
+    upload_node = mongoengine.StringField()
+    upload_folder = mongoengine.StringField()
+    package_folder = mongoengine.StringField()
+    archive = mongoengine.StringField()
+    imports = mongoengine.ListField(field=mongoengine.StringField())
+    requirements = mongoengine.ListField(field=mongoengine.StringField())
+    apt_packages = mongoengine.ListField(field=mongoengine.StringField())
+    tags = mongoengine.ListField(field=mongoengine.StringField())
+    sid = mongoengine.StringField()
+    base_image = mongoengine.StringField()  # delta upload : uuid of the image whose source tree is completed
+    deleted = mongoengine.ListField(field=mongoengine.StringField())  # delta upload : paths removed from the source tree
+    batch = mongoengine.StringField()  # batch of images built from the same upload
+    image_uuid = mongoengine.StringField()
+    message = mongoengine.StringField()
+    result = mongoengine.DictField()
+    log_file = mongoengine.StringField()
+    log = mongoengine.FileField(collection_name='build_logs')
+    node = mongoengine.StringField()  # node processing the build
+    attempts = mongoengine.IntField(default=0)
+    lease_expires = mongoengine.DateTimeField()
+    started = mongoengine.DateTimeField()
+    finished = mongoengine.DateTimeField()
+
+
+class BuildEvent(mongoengine.Document):
+    """
+    Build progress event, relayed to websocket clients by every builder node. Stored in a capped collection.
+    """
+    meta = {
+        'max_size': BUILD_EVENTS_MAX_SIZE
+    }
+    build = mongoengine.StringField()
+    rooms = mongoengine.ListField(field=mongoengine.StringField())
+    event = mongoengine.StringField()
+    data = mongoengine.DictField()
+    node = mongoengine.StringField()
+
+
+class DockerImageInfo(jobmanager.common.BaseDocument):
+    """
+    Builder specific information about a DockerImage, stored alongside it with the same uuid.
+    DockerImage schema is shared with other Job Manager components, so builder fields are kept here.
+    """
+    meta = {
+        'queryset_class': jobmanager.common.SerializableQuerySet,
+        'indexes': [
+            'uuid',
+            'fingerprint'
+        ]
+    }
+    uuid = mongoengine.StringField(required=True, unique=True)
+    fingerprint = mongoengine.StringField()
+    context_size = mongoengine.IntField()
+    context_files = mongoengine.IntField()
+    image_size = mongoengine.IntField()
+    timings = mongoengine.DictField()  # build phase -> seconds
+    push_timings = mongoengine.ListField(field=mongoengine.DictField())  # {'tag': tag, 'seconds': seconds}, tags may contain dots
+    builder_version = mongoengine.StringField()
+
+
+class SourceTree(jobmanager.common.BaseDocument):
+    """
+    Source tree of a built image : manifest of the uploaded package files (path, content hash, size and mode),
+    stored as compressed JSON. File contents are stored once as SourceBlob, whatever the image.
+    """
+    meta = {
+        'indexes': [
+            'uuid'
+        ]
+    }
+    uuid = mongoengine.StringField(required=True, unique=True)
+    files = mongoengine.IntField()
+    size = mongoengine.IntField()
+    manifest = mongoengine.BinaryField()
+
+
+class SourceBlob(mongoengine.Document):
+    """
+    File content of source trees, identified by its sha256 hash. Large files are stored in GridFS instead.
+    Blobs no source tree references anymore are removed by garbage collection, once stored or reused long enough ago.
+    """
+    meta = {
+        'collection': 'source_blobs'
+    }
+    id = mongoengine.StringField(primary_key=True)
+    data = mongoengine.BinaryField()
+    size = mongoengine.IntField()
+    stored = mongoengine.DateTimeField()  # last time a build stored or reused this blob
+
+
+class UploadSession(jobmanager.common.NamedDocument):
+    """
+    Chunked upload of a package : chunks are sent separately, in any order and possibly again, until all are committed.
+    Sessions and their chunks are removed by the database when they expire.
+    """
+    meta = {
+        'queryset_class': jobmanager.common.SerializableQuerySet,
+        'indexes': [
+            'uuid',
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+    filename = mongoengine.StringField()
+    size = mongoengine.IntField()
+    chunk_size = mongoengine.IntField()
+    chunks = mongoengine.IntField()
+    sha256 = mongoengine.StringField()
+    committed = mongoengine.ListField(field=mongoengine.IntField())
+    expires = mongoengine.DateTimeField()
+
+
+class UploadChunk(mongoengine.Document):
+    """
+    Committed chunk of an upload session, identified by session uuid and chunk index.
+    """
+    meta = {
+        'collection': 'upload_chunks',
+        'indexes': [
+            'session',
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+    id = mongoengine.StringField(primary_key=True)
+    session = mongoengine.StringField()
+    index = mongoengine.IntField()
+    data = mongoengine.BinaryField()
+    sha256 = mongoengine.StringField()
+    expires = mongoengine.DateTimeField()
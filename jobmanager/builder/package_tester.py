@@ -6,19 +6,46 @@
 Python Job Manager Docker Builder - Package Tester / Import checker
 :author: Ronan Delacroix
 """
+import os
 import sys
 import re
+import ast
 import json
-from jobmanager.common.job import Job, JobTask
+import time
+import select
+import signal
+import traceback
+
+JOB_BASES = {
+    'jobmanager.common.job.Job': 'jobs',
+    'jobmanager.common.job.JobTask': 'job_tasks',
+}
+
+# functions creating a Job class named by one of their arguments : qualified name -> (argument index, bases)
+JOB_FACTORIES = {
+    'jobmanager.common.job.make_job': (0, ['jobmanager.common.job.Job']),
+}
 
 
 def get_subclasses(klass):
+    """
+    All subclasses of klass, direct or not, each listed once, in discovery order.
+    """
     assert isinstance(klass, type)
-    klasses = klass.__subclasses__()
-    klasses2 = klasses
-    for y in klasses:
-        klasses2 += get_subclasses(y)
-    return list(set(klasses2))
+    seen = set()
+    klasses = []
+    pending = [klass]
+    while pending:
+        for subclass in pending.pop().__subclasses__():
+            if subclass not in seen:
+                seen.add(subclass)
+                klasses.append(subclass)
+                pending.append(subclass)
+    return klasses
+
+
+def qualified_name(klass):
+    return '%s.%s' % (klass.__module__, klass.__qualname__)
 
 
 def load_module(name):
@@ -53,28 +80,438 @@ def load_handler(handler):
     return
 
 
-def main(handlers):
+def find_module_file(root, name):
+    """
+    Get the source file of module name in package root folder, or None.
+    """
+    path = os.path.join(root, *name.split('.'))
+    if os.path.isfile(path + '.py'):
+        return path + '.py'
+    if os.path.isfile(os.path.join(path, '__init__.py')):
+        return os.path.join(path, '__init__.py')
+    return None
+
+
+def dotted_name(node):
+    """
+    Get 'a.b.c' from a Name/Attribute expression, or None.
+    """
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.insert(0, node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.insert(0, node.id)
+    return '.'.join(parts)
+
+
+def string_value(node):
+    value = getattr(node, 'value', getattr(node, 's', None))  # ast.Str before python 3.8
+    if isinstance(node, (ast.Constant, getattr(ast, 'Str', ast.Constant))) and isinstance(value, str):
+        return value
+    return None
+
+
+OPTIONAL_IMPORT_ERRORS = (None, 'ImportError', 'ModuleNotFoundError', 'Exception', 'BaseException')  # None : bare except
+
+
+class ModuleScan:
+    """
+    Static analysis of a single module source : imports, classes, dynamic classes created with type(...)
+    and calls that could create some, without executing anything.
+    """
+    def __init__(self, name, path, is_package):
+        self.name = name
+        self.path = path
+        self.package = name if is_package else name.rpartition('.')[0]
+        self.bindings = {}  # local name -> module name or (module name, attribute)
+        self.imports = []  # tuples (module name, line, names imported from it, optional)
+        self.classes = []  # tuples (class name, base expressions, line)
+        self.factories = []  # tuples (function name, name argument index, base expressions)
+        self.calls = []  # tuples (callee expression, call node)
+        self.warnings = []
+        with open(path, 'rb') as f:
+            self.tree = ast.parse(f.read(), filename=path)
+        self.optional = self.optional_imports()
+        self.defined, self.dynamic = self.module_names()
+        self.scan()
+
+    def optional_imports(self):
+        """
+        Import nodes guarded by a try / except ImportError block, which are allowed to fail.
+        """
+        guarded = set()
+        for node in ast.walk(self.tree):
+            if not isinstance(node, ast.Try):
+                continue
+            caught = []
+            for handler in node.handlers:
+                types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+                caught += [dotted_name(t) if t is not None else None for t in types]
+            if any(c in OPTIONAL_IMPORT_ERRORS for c in caught):
+                for statement in node.body:
+                    guarded.update(id(n) for n in ast.walk(statement) if isinstance(n, (ast.Import, ast.ImportFrom)))
+        return guarded
+
+    def module_names(self):
+        """
+        Names bound at module level, in conditional blocks too, and whether the module may bind others dynamically
+        (star imports, module __getattr__, globals()).
+        :return: tuple (set of names, dynamic)
+        """
+        names = set(name for node in ast.walk(self.tree) if isinstance(node, ast.Global) for name in node.names)
+        dynamic = False
+        statements = list(self.tree.body)
+        while statements:
+            node = statements.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                names.add(node.name)
+                dynamic = dynamic or node.name == '__getattr__'
+                continue
+            if isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    dynamic = dynamic or alias.name == '*'
+                    names.add(alias.asname or alias.name.split('.')[0])
+                continue
+            if isinstance(node, ast.ExceptHandler) and node.name:
+                names.add(node.name)
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, (ast.stmt, ast.ExceptHandler)):
+                    statements.append(child)  # bodies of if, try, with, for... blocks
+                    continue
+                for sub in ast.walk(child):
+                    if isinstance(sub, ast.Name) and isinstance(sub.ctx, ast.Store):
+                        names.add(sub.id)
+                    elif isinstance(sub, ast.Name) and sub.id == 'globals':
+                        dynamic = True
+        return names, dynamic
+
+    def resolve_relative(self, module, level, line):
+        if not level:
+            return module
+        base = self.package.split('.') if self.package else []
+        if level - 1 > len(base):
+            self.warnings.append("%s line %d : relative import beyond top-level package" % (self.path, line))
+            return None
+        base = base[:len(base) - (level - 1)]
+        return '.'.join(base + ([module] if module else []))
+
+    def scan(self):
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    self.imports.append((alias.name, node.lineno, [], id(node) in self.optional))
+                    if alias.asname:
+                        self.bindings[alias.asname] = alias.name
+                    else:
+                        top = alias.name.split('.')[0]
+                        self.bindings[top] = top
+            elif isinstance(node, ast.ImportFrom):
+                module = self.resolve_relative(node.module, node.level, node.lineno)
+                names = [alias.name for alias in node.names if alias.name != '*']
+                self.imports.append((module, node.lineno, names, id(node) in self.optional))
+                for alias in node.names:
+                    if alias.name != '*':
+                        self.bindings[alias.asname or alias.name] = (module, alias.name)
+            elif isinstance(node, ast.ClassDef):
+                self.classes.append((node.name, node.bases, node.lineno))
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                params = [arg.arg for arg in node.args.args]
+                for sub in ast.walk(node):
+                    args = self.type_call_args(sub)
+                    if args and isinstance(args[0], ast.Name) and args[0].id in params:
+                        self.factories.append((node.name, params.index(args[0].id), args[1].elts))
+            elif isinstance(node, ast.Call):
+                args = self.type_call_args(node)
+                if args and string_value(args[0]):
+                    self.classes.append((string_value(args[0]), args[1].elts, node.lineno))
+                elif dotted_name(node.func):
+                    self.calls.append((dotted_name(node.func), node))
+
+    @staticmethod
+    def type_call_args(node):
+        """
+        Arguments of a type(name, bases, dict) call with a literal bases tuple, or None.
+        """
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'type' \
+                and len(node.args) == 3 and isinstance(node.args[1], (ast.Tuple, ast.List)):
+            return node.args
+        return None
+
+
+class StaticScanner:
+    """
+    Import graph walker of a package, starting from handler modules, listing candidate Job and JobTask subclasses.
+    Only modules found in the package root are parsed, other imports are listed as external.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.modules = {}
+        self.external = set()
+        self.errors = []  # syntax errors and missing entry points, failing the check
+        self.warnings = []  # unresolved imports, reported only : they may be dynamic, optional or provided later
+
+    def load(self, name):
+        if name in self.modules:
+            return self.modules[name]
+        path = find_module_file(self.root, name)
+        if not path:
+            return None
+        # importing a submodule runs the __init__ of its parent packages
+        parent = name.rpartition('.')[0]
+        if parent:
+            self.load(parent)
+            if name in self.modules:  # imported by its parent package
+                return self.modules[name]
+        try:
+            scan = ModuleScan(name, path, path.endswith('__init__.py'))
+            self.warnings += [w.replace(path, os.path.relpath(path, self.root)) for w in scan.warnings]
+        except (SyntaxError, ValueError) as e:
+            self.errors.append("Syntax error in %s line %s : %s" % (os.path.relpath(path, self.root), getattr(e, 'lineno', '?'), getattr(e, 'msg', e)))
+            scan = None
+        self.modules[name] = scan
+        if scan:
+            self.follow_imports(scan)
+        return scan
+
+    def in_package(self, name):
+        """
+        Check if the top level module of name is a module or a package of the package root : data folders named
+        like other modules (json/...) are not.
+        """
+        return bool(find_module_file(self.root, name.split('.')[0]))
+
+    def follow_imports(self, scan):
+        for module, line, names, optional in scan.imports:
+            if not module:
+                continue
+            if not self.in_package(module):
+                self.external.add(module.split('.')[0])
+                continue
+            found = self.load(module) or module in self.modules or os.path.isdir(os.path.join(self.root, *module.split('.')))
+            if not found:
+                if not optional:
+                    self.warnings.append("%s line %d : module '%s' not found in package" % (
+                        os.path.relpath(scan.path, self.root), line, module))
+                continue
+            owner = self.modules.get(module)
+            for name in names:
+                submodule = module + '.' + name
+                if self.load(submodule) or submodule in self.modules or os.path.isdir(os.path.join(self.root, *submodule.split('.'))):
+                    continue
+                namespace = module not in self.modules  # folder without __init__.py, it only has submodules
+                if (namespace or (owner and not owner.dynamic and name not in owner.defined)) and not optional:
+                    self.warnings.append("%s line %d : name '%s' not found in module '%s'" % (
+                        os.path.relpath(scan.path, self.root), line, name, module))
+
+    def canonical(self, scan, expression, depth=0):
+        """
+        Fully qualified name of a dotted expression used in module scan, following imports and re-exports.
+        """
+        first, _, rest = expression.partition('.')
+        binding = scan.bindings.get(first)
+        if isinstance(binding, tuple):
+            name = binding[0] + '.' + binding[1]
+        elif binding:
+            name = binding
+        elif any(cls[0] == first for cls in scan.classes) or any(f[0] == first for f in scan.factories):
+            name = scan.name + '.' + first
+        else:
+            return expression
+        name = name + '.' + rest if rest else name
+        # name re-exported by a package module (from .jobs import MyJob in __init__.py)
+        module, _, attr = name.rpartition('.')
+        while module and module not in self.modules:
+            module, _, prefix = module.rpartition('.')
+            attr = prefix + '.' + attr
+        owner = self.modules.get(module)
+        if owner and depth < 10 and attr.split('.')[0] in owner.bindings:
+            return self.canonical(owner, attr, depth + 1)
+        return name
+
+    def scan(self, handlers):
+        for handler in handlers:
+            if not find_module_file(self.root, handler):
+                self.errors.append("Entry point module '%s' not found in package" % handler)
+            else:
+                self.load(handler)
+
+        classes = {}  # qualified name -> (kind, qualified base names)
+        factories = dict(JOB_FACTORIES)
+        for scan in filter(None, self.modules.values()):
+            for name, bases, line in scan.classes:
+                classes[scan.name + '.' + name] = [self.canonical(scan, dotted_name(b) or '') for b in bases]
+            for name, index, bases in scan.factories:
+                factories[scan.name + '.' + name] = (index, [self.canonical(scan, dotted_name(b) or '') for b in bases])
+        for scan in filter(None, self.modules.values()):
+            for callee, call in scan.calls:
+                factory = factories.get(self.canonical(scan, callee))
+                if factory and factory[0] < len(call.args) and string_value(call.args[factory[0]]):
+                    classes[scan.name + '.' + string_value(call.args[factory[0]])] = factory[1]
+
+        kinds = dict(JOB_BASES)
+        changed = True
+        while changed:
+            changed = False
+            for name, bases in classes.items():
+                kind = next((kinds[b] for b in bases if b in kinds), None)
+                if kind and name not in kinds:
+                    kinds[name] = kind
+                    changed = True
+
+        found = {'jobs': [], 'job_tasks': []}
+        for name in sorted(classes):
+            if name in kinds:
+                found[kinds[name]].append(name)
+        return found
+
+
+def static_scan(handlers, root):
+    """
+    Discover Job and JobTask subclasses of handler modules by parsing the package sources, without importing them.
+    Classes created with type(...), directly or through a factory function such as a decorator, are found too.
+    Dynamic code (exec, getattr, conditional imports...) is not evaluated, so results are candidates only.
+    """
+    scanner = StaticScanner(root)
+    found = scanner.scan(handlers)
+    result = {
+        "result": "error" if scanner.errors else "success",
+        "handlers": handlers,
+        "jobs": [name.rpartition('.')[2] for name in found['jobs']],
+        "job_tasks": [name.rpartition('.')[2] for name in found['job_tasks']],
+        "classes": found['jobs'] + found['job_tasks'],
+        "modules": sorted(name for name, scan in scanner.modules.items() if scan),
+        "external_imports": sorted(scanner.external),
+        "warnings": scanner.warnings,
+    }
+    if scanner.errors:
+        result["error"] = '\n'.join(scanner.errors)
+        result["details"] = "ERROR while analysing handler %s" % ('/'.join(handlers))
+    else:
+        result["details"] = "Handlers %s analysed OK - found jobs types : %s" % ('/'.join(handlers), ', '.join(result['jobs']))
+    return result
+
+
+def check_imports(handlers):
+    """
+    Import handler modules and list the Job and JobTask subclasses they define.
+    """
+    from jobmanager.common.job import Job, JobTask
     try:
         for handler in handlers:
             load_module(handler)
-        all_job_sub_classes = [str(c.__name__) for c in get_subclasses(Job)]
-        all_task_sub_classes = [str(c.__name__) for c in get_subclasses(JobTask)]
-        print(json.dumps({
+        jobs = get_subclasses(Job)
+        tasks = get_subclasses(JobTask)
+        all_job_sub_classes = [str(c.__name__) for c in jobs]
+        return {
             "result": "success",
             "handlers": handlers,
             "jobs": all_job_sub_classes,
-            "job_tasks": all_task_sub_classes,
+            "job_tasks": [str(c.__name__) for c in tasks],
+            "classes": [qualified_name(c) for c in jobs + tasks],
             "details": "Handlers %s loaded OK - found jobs types : %s" % ('/'.join(handlers), ', '.join(all_job_sub_classes))
-        }, indent=True))
-        return 0
+        }
     except Exception as e:
-        print(json.dumps({
+        return {
             "result": "error",
             "handlers": handlers,
             "error": str(e),
+            "traceback": traceback.format_exc(),
             "details": "ERROR while loading handler %s" % ('/'.join(handlers))
-        }, indent=True))
-        return 1
+        }
+
+
+def check_in_child(root, handlers, timeout):
+    """
+    Run check_imports in a forked child process, so that user modules never pollute the server interpreter.
+    The child is killed if it does not answer within timeout seconds.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        result = None
+        try:
+            os.close(read_fd)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            os.dup2(devnull, 0)
+            os.dup2(devnull, 1)  # user module output must not corrupt the server protocol
+            os.chdir(root)
+            sys.path.insert(0, root)
+            result = check_imports(handlers)
+            with os.fdopen(write_fd, 'w') as f:
+                json.dump(result, f)
+        finally:
+            os._exit(0 if result else 1)
+
+    os.close(write_fd)
+    data = b''
+    deadline = time.time() + timeout
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                os.kill(pid, signal.SIGKILL)
+                return {
+                    "result": "error",
+                    "handlers": handlers,
+                    "error": "Import of %s took more than %d seconds." % (', '.join(handlers), timeout),
+                    "details": "ERROR while loading handler %s" % ('/'.join(handlers))
+                }
+            chunk = os.read(read_fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    if not data:
+        return {
+            "result": "error",
+            "handlers": handlers,
+            "error": "Import checker process exited unexpectedly.",
+            "details": "ERROR while loading handler %s" % ('/'.join(handlers))
+        }
+    return json.loads(data.decode('utf-8'))
+
+
+def serve():
+    """
+    Import checker server : jobmanager.common is imported once, then each request read on stdin is checked in a
+    forked child. Requests and responses are JSON objects, one per line.
+    Request : {"root": package root folder, "handlers": [module names], "timeout": seconds}
+    """
+    import jobmanager.common.job  # preloaded, inherited by forked children
+    sys.stdout.write(json.dumps({"result": "ready", "pid": os.getpid()}) + '\n')
+    sys.stdout.flush()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            result = check_in_child(request['root'], request['handlers'], request.get('timeout', 60))
+        except Exception as e:
+            result = {"result": "error", "error": "Invalid import check request : %s" % e}
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+    return 0
+
+
+def main(handlers):
+    if handlers and handlers[0] == '--static':
+        result = static_scan(handlers[1:], os.getcwd())
+        print(json.dumps(result, indent=True))
+        return 0 if result['result'] == "success" else 1
+    if handlers and handlers[0] == '--serve':
+        return serve()
+    if handlers and handlers[0] == '--child':
+        # check run in a forked child, its output and the output of user modules kept apart : one JSON result line
+        result = check_in_child(os.getcwd(), handlers[2:], int(handlers[1]))
+        print(json.dumps(result))
+        return 0 if result['result'] == "success" else 1
+    result = check_imports(handlers)
+    print(json.dumps(result, indent=True))
+    return 0 if result['result'] == "success" else 1
 
 
 if __name__ == "__main__":
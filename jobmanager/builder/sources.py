@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Source trees of built images, for delta uploads
+:author: Ronan Delacroix
+"""
+import os
+import json
+import zlib
+import stat
+import hashlib
+import datetime
+import gridfs
+import pymongo.errors
+from bson.binary import Binary
+from jobmanager.common.docker import DockerImage
+from .models import SourceTree, SourceBlob
+from .upload import is_safe_path, is_inside, has_linked_parent
+from .context import ExcludeRules, DEFAULT_EXCLUDES
+
+STORE_SOURCE_TREES = True  # keep source trees of built images so that later builds can upload only changed files
+BLOB_MAX_SIZE = 8 * 1024 * 1024  # bytes, larger files are stored in GridFS
+BATCH_SIZE = 500  # blobs per database query
+GRACE_PERIOD = 3600  # seconds during which new source trees and blobs are never removed, their build may be saving them
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_tree(folder):
+    """
+    Manifest of a folder : one entry per file, with its content hash, size and mode, or its target for symbolic links.
+    Files matching default build context exclusions (__pycache__, .git...) are left out.
+    :return: list of dicts, sorted by path
+    """
+    entries = []
+    for root, relroot, dirs, files in ExcludeRules(DEFAULT_EXCLUDES).walk(folder):
+        for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            relpath = relroot + name
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries.append({'path': relpath, 'link': os.readlink(path)})
+            elif stat.S_ISREG(st.st_mode):
+                entries.append({'path': relpath, 'sha256': file_digest(path), 'size': st.st_size,
+                                'mode': stat.S_IMODE(st.st_mode)})
+    return sorted(entries, key=lambda e: e['path'])
+
+
+def get_large_blobs():
+    return gridfs.GridFS(SourceBlob._get_db(), collection='source_blobs_large')
+
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def store_blobs(folder, entries):
+    """
+    Store the content of files which are not stored yet. Blobs are identified by content hash, so they are shared
+    by all source trees.
+    :return: tuple (count, size) of stored blobs
+    """
+    collection = SourceBlob._get_collection()
+    large_blobs = get_large_blobs()
+    large_files = SourceBlob._get_db()['source_blobs_large.files']
+    files = {}
+    for entry in entries:
+        if 'sha256' in entry:
+            files.setdefault(entry['sha256'], entry)
+
+    now = datetime.datetime.utcnow()
+    missing = []
+    for batch in batches(files):
+        existing = set(d['_id'] for d in collection.find({'_id': {'$in': batch}}, projection=['_id']))
+        existing.update(d['_id'] for d in large_files.find({'_id': {'$in': batch}}, projection=['_id']))
+        missing += [digest for digest in batch if digest not in existing]
+        if existing:  # reused blobs are kept by garbage collection until the manifest referencing them is saved
+            collection.update_many({'_id': {'$in': list(existing)}}, {'$set': {'stored': now}})
+            large_files.update_many({'_id': {'$in': list(existing)}}, {'$set': {'uploadDate': now}})
+
+    stored_size = 0
+    small = [digest for digest in missing if files[digest]['size'] <= BLOB_MAX_SIZE]
+    for batch in batches(small):
+        documents = []
+        for digest in batch:
+            with open(os.path.join(folder, files[digest]['path']), 'rb') as f:
+                documents.append({'_id': digest, 'data': Binary(f.read()), 'size': files[digest]['size'], 'stored': now})
+            stored_size += files[digest]['size']
+        try:
+            collection.insert_many(documents, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise  # duplicates are blobs stored meanwhile by another build
+    for digest in missing:
+        if files[digest]['size'] > BLOB_MAX_SIZE:
+            with open(os.path.join(folder, files[digest]['path']), 'rb') as f:
+                try:
+                    large_blobs.put(f, _id=digest)
+                except gridfs.errors.FileExists:
+                    pass
+            stored_size += files[digest]['size']
+    return len(missing), stored_size
+
+
+def save_tree(image_uuid, folder):
+    """
+    Store the source tree of an image : missing file contents, and its manifest.
+    :return: dict of stats (files, size, stored blob count and size)
+    """
+    entries = scan_tree(folder)
+    stored, stored_size = store_blobs(folder, entries)
+    size = sum(e.get('size', 0) for e in entries)
+    SourceTree.objects(uuid=image_uuid).modify(
+        upsert=True,
+        files=len(entries),
+        size=size,
+        manifest=zlib.compress(json.dumps(entries).encode('utf-8')),
+        updated=datetime.datetime.utcnow()
+    )
+    return {'files': len(entries), 'size': size, 'stored_blobs': stored, 'stored_size': stored_size}
+
+
+def get_manifest(image_uuid):
+    """
+    Manifest of the source tree of an image, or None if it was not stored.
+    """
+    tree = SourceTree.objects(uuid=image_uuid).only('manifest').first()
+    if not tree or not tree.manifest:
+        return None
+    return decode_manifest(tree.manifest)
+
+
+def decode_manifest(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+def remove_expired_trees(max_age):
+    """
+    Remove source trees of removed images, and of images neither built nor reused within max_age seconds.
+    :return: number of removed source trees
+    """
+    now = datetime.datetime.utcnow()
+    expires = now - datetime.timedelta(seconds=max_age)
+    trees = [(t.uuid, t.updated) for t in SourceTree.objects(
+        updated__lt=now - datetime.timedelta(seconds=GRACE_PERIOD)).only('uuid', 'updated')]
+    expired = []
+    for batch in batches(trees):
+        images = dict((i.uuid, i.updated) for i in DockerImage.objects(uuid__in=[t[0] for t in batch]).only('uuid', 'updated'))
+        for image_uuid, updated in batch:
+            if image_uuid not in images or max(updated, images[image_uuid] or updated) < expires:
+                expired.append(image_uuid)
+    for batch in batches(expired):
+        SourceTree.objects(uuid__in=batch).delete()
+    return len(expired)
+
+
+def remove_unreferenced_blobs():
+    """
+    Remove file contents which no source tree references anymore. Blobs stored or reused within GRACE_PERIOD are kept.
+    :return: tuple (count, size) of removed blobs
+    """
+    referenced = set()
+    for tree in SourceTree.objects.only('manifest'):
+        if tree.manifest:
+            referenced.update(e['sha256'] for e in decode_manifest(tree.manifest) if 'sha256' in e)
+    grace = datetime.datetime.utcnow() - datetime.timedelta(seconds=GRACE_PERIOD)
+    collection = SourceBlob._get_collection()
+    unreferenced = []
+    removed_size = 0
+    for blob in collection.find({'$or': [{'stored': {'$lt': grace}}, {'stored': None}]}, projection=['_id', 'size']):
+        if blob['_id'] not in referenced:
+            unreferenced.append(blob['_id'])
+            removed_size += blob.get('size') or 0
+    for batch in batches(unreferenced):
+        collection.delete_many({'_id': {'$in': batch}})
+    large_blobs = get_large_blobs()
+    large_files = SourceBlob._get_db()['source_blobs_large.files']
+    for blob in list(large_files.find({'uploadDate': {'$lt': grace}}, projection=['_id', 'length'])):
+        if blob['_id'] not in referenced:
+            large_blobs.delete(blob['_id'])
+            unreferenced.append(blob['_id'])
+            removed_size += blob.get('length') or 0
+    return len(unreferenced), removed_size
+
+
+def parse_deleted(value):
+    """
+    Parse the deleted paths of a delta upload : a JSON list of paths, relative to the package root.
+    """
+    if not value:
+        return []
+    try:
+        deleted = json.loads(value)
+    except ValueError as e:
+        raise Exception("Invalid deleted paths, JSON list expected : %s" % e)
+    if not isinstance(deleted, list) or not all(isinstance(p, str) for p in deleted):
+        raise Exception("Invalid deleted paths, JSON list of strings expected.")
+    for path in deleted:
+        if not is_safe_path(path):
+            raise Exception("Unsafe deleted path : %s" % path)
+    return [os.path.normpath(p).replace(os.sep, '/') for p in deleted]
+
+
+def apply_delta(image_uuid, folder, deleted):
+    """
+    Complete a delta upload extracted in folder with the source tree of an image : files of the tree are added,
+    unless they were deleted (files or folders) or uploaded again.
+    :return: dict of stats (files added from the tree, files of the tree replaced by uploaded ones, deleted paths)
+    """
+    entries = get_manifest(image_uuid)
+    if entries is None:
+        raise Exception("No source tree stored for image %s, a full upload is needed." % image_uuid)
+    deleted = set(deleted)
+
+    def is_deleted(path):
+        parts = path.split('/')
+        return any('/'.join(parts[:i]) in deleted for i in range(1, len(parts) + 1))
+
+    replaced = 0
+    needed = []
+    for entry in entries:
+        path = os.path.join(folder, entry['path'])
+        if is_deleted(entry['path']):
+            continue
+        if os.path.lexists(path):
+            replaced += 1
+            continue
+        if not is_safe_path(entry['path']) or has_linked_parent(folder, entry['path']):
+            continue  # never written through symbolic links of the upload
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if 'link' in entry:
+            if is_inside(folder, os.path.join(os.path.dirname(path), entry['link'])):
+                os.symlink(entry['link'], path)
+        else:
+            needed.append(entry)
+
+    collection = SourceBlob._get_collection()
+    large_blobs = get_large_blobs()
+    by_digest = {}
+    for entry in needed:
+        by_digest.setdefault(entry['sha256'], []).append(entry)
+    for batch in batches(d for d in by_digest if by_digest[d][0]['size'] <= BLOB_MAX_SIZE):
+        found = set()
+        for blob in collection.find({'_id': {'$in': batch}}):
+            found.add(blob['_id'])
+            for entry in by_digest[blob['_id']]:
+                write_file(os.path.join(folder, entry['path']), [bytes(blob['data'])], entry['mode'])
+        if len(found) != len(batch):
+            raise Exception("Source tree of image %s is incomplete, a full upload is needed." % image_uuid)
+    for digest, digest_entries in by_digest.items():
+        if digest_entries[0]['size'] > BLOB_MAX_SIZE:
+            try:
+                stored = large_blobs.get(digest)
+            except gridfs.errors.NoFile:
+                raise Exception("Source tree of image %s is incomplete, a full upload is needed." % image_uuid)
+            for entry in digest_entries:
+                stored.seek(0)
+                write_file(os.path.join(folder, entry['path']), iter(lambda: stored.read(1024 * 1024), b''), entry['mode'])
+    return {'added': len(needed), 'replaced': replaced, 'deleted': len(deleted)}
+
+
+def write_file(path, chunks, mode):
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.chmod(path, mode)
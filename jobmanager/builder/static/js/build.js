@@ -58,36 +58,36 @@
             $('#builder').hide();
             $('#loading').show();
 
-            axios.post('/build', formData).then(function (response) {
-                $('#result #message').html(response.data.message.replace('\n', '<br/>'));
-                $('#result #details').val(response.data.details);
-                if (response.data.result == "success") {
+            function show_result(data) {
+                $('#result #message').html(data.message.replace('\n', '<br/>'));
+                $('#result #details').val(data.details);
+                if (data.result == "success") {
                     $('#result #image').show();
                     $('#result #jobs').show();
 
                     $('#result i.big').removeClass('fa-exclamation-circle error').addClass('fa-check-circle success');
 
                     // Image
-                    $('#result #image').html(response.data.uuid);
+                    $('#result #image').html(data.uuid);
 
                     // Tags
                     $('#result #tags').html('');
-                    _.each(response.data.tags, function(t) {
+                    _.each(data.tags, function(t) {
                         var tag = $("<div class='tag emboss'/>").html(t);
                         $('#result #tags').append(tag);
                     });
 
                     // Jobs
                     $('#result #jobs').html('<label>This image will be able to execute the following jobs : </label>');
-                    _.each(response.data.jobs, function(j) {
+                    _.each(data.jobs, function(j) {
                         var job = $("<div class='job'/>").html(j);
                         $('#result #jobs').append(job);
                     });
 
                     // Tasks
-                    if (response.data.tasks.length>0) {
+                    if (data.tasks.length>0) {
                         $('#result #tasks').html('<label>And following sub tasks:</label>');
-                        _.each(response.data.tasks, function(j) {
+                        _.each(data.tasks, function(j) {
                             var task = $("<div class='tasks'/>").html(j);
                             $('#result #tasks').append(task);
                         });
@@ -98,15 +98,38 @@
                     $('#result #jobs').hide();
                     $('#result i.big').removeClass('fa-check-circle success').addClass('fa-exclamation-circle error');
                 }
-            }).catch(function(error) {
-                    $('#result #image').hide();
-                    $('#result #jobs').hide();
-                    $('#result #message').html("Critical error during build request");
-                    $('#result i.big').removeClass('fa-check-circle success').addClass('fa-exclamation-circle error');
-            }).finally(function() {
                 $('#loading').hide();
                 $('#result').show();
-            });
+            }
+
+            function show_critical_error() {
+                $('#result #image').hide();
+                $('#result #jobs').hide();
+                $('#result #message').html("Critical error during build request");
+                $('#result i.big').removeClass('fa-check-circle success').addClass('fa-exclamation-circle error');
+                $('#loading').hide();
+                $('#result').show();
+            }
+
+            // Build is queued, poll its status until it is finished
+            function wait_build(url) {
+                axios.get(url).then(function (response) {
+                    if (response.data.status == "success" || response.data.status == "error") {
+                        show_result(response.data.result || response.data);
+                    } else {
+                        setTimeout(function() { wait_build(url); }, 2000);
+                    }
+                }).catch(show_critical_error);
+            }
+
+            axios.post('/build', formData).then(function (response) {
+                if (response.data.result == "queued") {
+                    socket.emit('join build', {build: response.data.build});
+                    wait_build(response.data.url);
+                } else {
+                    show_result(response.data);
+                }
+            }).catch(show_critical_error);
         }
     });
 
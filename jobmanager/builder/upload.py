@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Uploaded package ingestion
+:author: Ronan Delacroix
+"""
+import os
+import queue
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+from werkzeug.utils import secure_filename
+
+UPLOAD_MAX_SIZE = 512 * 1024 * 1024  # bytes received
+UPLOAD_MAX_FILES = 50000
+UPLOAD_MAX_EXTRACTED_SIZE = 2 * 1024 * 1024 * 1024  # bytes
+
+TAR_EXTENSIONS = ['.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+ZIP_EXTENSIONS = ['.zip']
+
+
+class UploadLimitError(Exception):
+    pass
+
+
+def is_tar_archive(filename):
+    return any(filename.endswith(ext) for ext in TAR_EXTENSIONS)
+
+
+def is_zip_archive(filename):
+    return any(filename.endswith(ext) for ext in ZIP_EXTENSIONS)
+
+
+def is_safe_path(name):
+    """
+    Check an archive member path stays inside the extraction folder.
+    """
+    normalized = os.path.normpath(name)
+    return not (os.path.isabs(name) or normalized == '..' or normalized.startswith('..' + os.sep))
+
+
+def is_inside(folder, path):
+    """
+    Check a path, once symbolic links already on disk are resolved, stays inside folder.
+    """
+    folder = os.path.realpath(folder)
+    path = os.path.realpath(path)
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def has_linked_parent(folder, name):
+    """
+    Check if a parent folder of a path relative to folder is a symbolic link, or is reached through one.
+    """
+    parent = os.path.join(os.path.realpath(folder), os.path.dirname(os.path.normpath(name)))
+    return os.path.realpath(parent) != os.path.normpath(parent)
+
+
+class ChunkReader:
+    """
+    Readable file object over chunks of bytes put in a queue. A None chunk marks the end of the stream.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+        self.ended = False
+
+    def read(self, size=-1):
+        while not self.ended and (size < 0 or len(self.buffer) < size):
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.ended = True
+            else:
+                self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        while not self.ended:
+            self.read(64 * 1024)
+
+
+class UploadReceiver:
+    """
+    Writable file object receiving an uploaded package, meant to be used as werkzeug upload stream.
+    The upload is saved in its own temporary folder, and the size limit is enforced while data arrives.
+    Tar archives are extracted by a background thread while they are received, zip archives once complete.
+    File count and extracted size limits are enforced, as well as member paths safety.
+    """
+    def __init__(self, filename):
+        self.filename = secure_filename(filename or '')
+        self.folder = tempfile.mkdtemp(prefix="jobmanager-upload-")
+        self.path = os.path.join(self.folder, self.filename or 'upload')
+        self.package_folder = os.path.join(self.folder, 'package')
+        os.mkdir(self.package_folder)
+        self.file = open(self.path, 'w+b')
+        self.size = 0
+        self.file_count = 0
+        self.extracted_size = 0
+        self.error = None
+        self.chunks = None
+        self.thread = None
+        if is_tar_archive(self.filename):
+            self.chunks = queue.Queue(maxsize=64)
+            self.thread = threading.Thread(target=self.extract_tar_stream, name="upload-extract", daemon=True)
+            self.thread.start()
+
+    @property
+    def archive(self):
+        """
+        Path of the uploaded archive if it can be used directly as docker build context source.
+        """
+        if is_tar_archive(self.filename):
+            return self.path
+        return None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_SIZE:
+            self.stop_extraction()
+            raise UploadLimitError("Upload is bigger than %d MB." % (UPLOAD_MAX_SIZE // (1024 * 1024)))
+        if self.error:
+            raise self.error
+        self.file.write(data)
+        if self.chunks is not None:
+            self.chunks.put(bytes(data))
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def stop_extraction(self):
+        if self.thread:
+            self.chunks.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def finish(self):
+        """
+        Wait for the upload extraction to end.
+        :return: folder containing the extracted package
+        """
+        self.close()
+        self.stop_extraction()
+        if self.error:
+            raise self.error
+        if is_zip_archive(self.filename):
+            self.extract_zip()
+        elif not is_tar_archive(self.filename):
+            shutil.copy(self.path, self.package_folder)
+        return self.package_folder
+
+    def clean(self):
+        self.close()
+        self.stop_extraction()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check_member(self, name, size):
+        if not is_safe_path(name):
+            raise UploadLimitError("Unsafe path in archive : %s" % name)
+        self.file_count += 1
+        if self.file_count > UPLOAD_MAX_FILES:
+            raise UploadLimitError("Archive contains more than %d files." % UPLOAD_MAX_FILES)
+        self.extracted_size += size
+        if self.extracted_size > UPLOAD_MAX_EXTRACTED_SIZE:
+            raise UploadLimitError("Extracted archive is bigger than %d MB." % (UPLOAD_MAX_EXTRACTED_SIZE // (1024 * 1024)))
+
+    def extract_tar_stream(self):
+        reader = ChunkReader(self.chunks)
+        extract_options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        try:
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                for member in tar:
+                    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+                        continue
+                    self.check_member(member.name, member.size)
+                    if has_linked_parent(self.package_folder, member.name):
+                        raise UploadLimitError("Unsafe path through a symbolic link in archive : %s" % member.name)
+                    if member.issym() and not (is_safe_path(os.path.join(os.path.dirname(member.name), member.linkname)) and is_inside(
+                            self.package_folder, os.path.join(self.package_folder, os.path.dirname(member.name), member.linkname))):
+                        raise UploadLimitError("Unsafe symbolic link in archive : %s" % member.name)
+                    if member.islnk() and not (is_safe_path(member.linkname) and is_inside(
+                            self.package_folder, os.path.join(self.package_folder, member.linkname))):
+                        raise UploadLimitError("Unsafe hard link in archive : %s" % member.name)
+                    tar.extract(member, self.package_folder, **extract_options)
+        except Exception as e:
+            self.error = e
+        finally:
+            reader.drain()
+
+    def extract_zip(self):
+        with zipfile.ZipFile(self.path) as archive:
+            for member in archive.infolist():
+                self.check_member(member.filename, member.file_size)
+                archive.extract(member, self.package_folder)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Unit tests using an in-memory database
+:author: Ronan Delacroix
+"""
+import unittest
+import mongoengine
+
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:
+    mongomock = None
+
+
+@unittest.skipIf(mongomock is None, "mongomock is needed for database tests")
+class DatabaseTestCase(unittest.TestCase):
+    """
+    Test case connected to an empty mongomock database, GridFS included.
+    """
+    def setUp(self):
+        mongomock.gridfs.enable_gridfs_integration()
+        mongoengine.connect('jobmanager-builder-test', mongo_client_class=mongomock.MongoClient)
+
+    def tearDown(self):
+        mongoengine.connection.get_connection().drop_database('jobmanager-builder-test')
+        mongoengine.disconnect()
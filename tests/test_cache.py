@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Requirement normalization tests
+:author: Ronan Delacroix
+"""
+import unittest
+from jobmanager.builder.cache import normalize_requirements
+
+
+class NormalizeRequirementsTest(unittest.TestCase):
+
+    def test_project_names_are_normalized(self):
+        self.assertEqual(normalize_requirements(['Django', 'zope.interface', 'ruamel_yaml', 'Foo__Bar']),
+                         ['django', 'foo-bar', 'ruamel-yaml', 'zope-interface'])
+
+    def test_specifiers_are_kept_without_spaces(self):
+        self.assertEqual(normalize_requirements(['Requests >= 2.0, < 3', 'PyYAML[extra]==5.1 ; python_version>"3"']),
+                         ['pyyaml[extra]==5.1;python_version>"3"', 'requests>=2.0,<3'])
+
+    def test_duplicates_and_blanks_are_removed(self):
+        self.assertEqual(normalize_requirements(['requests', ' Requests ', '', '  ', 'arrow']), ['arrow', 'requests'])
+
+    def test_order_does_not_matter(self):
+        self.assertEqual(normalize_requirements(['b', 'a', 'c']), normalize_requirements(['c', 'b', 'a']))
+
+    def test_options_are_kept_first_with_their_values(self):
+        requirements = ['requests', '-i', 'https://pypi.example.com/simple', 'arrow',
+                        '--extra-index-url', 'https://other.example.com', '--pre', '-r', 'requirements.txt']
+        self.assertEqual(normalize_requirements(requirements), [
+            '-i', 'https://pypi.example.com/simple', '--extra-index-url', 'https://other.example.com', '--pre',
+            '-r', 'requirements.txt', 'arrow', 'requests'])
+
+    def test_option_value_is_not_normalized(self):
+        self.assertEqual(normalize_requirements(['--no-binary', 'My_Package', 'My_Package']),
+                         ['--no-binary', 'My_Package', 'my-package'])
+
+    def test_options_with_inline_values(self):
+        self.assertEqual(normalize_requirements(['--index-url=https://pypi.example.com/simple', 'b', 'a']),
+                         ['--index-url=https://pypi.example.com/simple', 'a', 'b'])
+
+    def test_urls_paths_and_files_are_kept(self):
+        requirements = ['git+https://github.com/Org/My_Repo.git#egg=My_Repo', './Local_Package',
+                        'My_Wheel-1.0-py3-none-any.whl', 'Archive-1.0.tar.gz', 'Reqs.txt']
+        self.assertEqual(normalize_requirements(requirements), sorted(requirements))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Image catalog tests
+:author: Ronan Delacroix
+"""
+import datetime
+import unittest
+from bson import ObjectId
+from jobmanager.common.docker import DockerImage
+from jobmanager.builder import catalog
+from jobmanager.builder.catalog import encode_cursor, decode_cursor
+from .database import DatabaseTestCase
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        object_id = ObjectId()
+        for created in (datetime.datetime(2018, 5, 4, 12, 30, 15, 123456), datetime.datetime(2018, 5, 4, 12, 30, 15)):
+            self.assertEqual(decode_cursor(encode_cursor({'created': created, '_id': object_id})), (created, object_id))
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor({'created': datetime.datetime(2018, 5, 4), '_id': ObjectId()})
+        self.assertRegex(cursor, r'^[A-Za-z0-9_=-]+$')
+
+    def test_invalid_cursors(self):
+        for cursor in ('', 'not a cursor', 'bm90IGpzb24=', encode_cursor({'created': datetime.datetime(2018, 5, 4), '_id': 'x' * 24})):
+            with self.assertRaises(ValueError, msg=cursor):
+                decode_cursor(cursor)
+
+
+class ListImagesTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(ListImagesTest, self).setUp()
+        created = datetime.datetime(2018, 5, 4)
+        for i in range(7):
+            DockerImage(name='reports' if i % 2 else 'etl', tags=['v%d' % i], jobs=['Export'] if i < 3 else [],
+                        created=created if i < 4 else created + datetime.timedelta(days=i)).save()
+
+    def test_pages_follow_each_other(self):
+        seen = []
+        images, cursor = catalog.list_images(limit=3)
+        while True:
+            seen += [image['tags'][0] for image in images]
+            if not cursor:
+                break
+            images, cursor = catalog.list_images(cursor=cursor, limit=3)
+        self.assertEqual(len(seen), 7)
+        self.assertEqual(len(set(seen)), 7)  # images created at the same time are not skipped nor repeated
+        self.assertEqual(seen[:3], ['v6', 'v5', 'v4'])
+
+    def test_filters(self):
+        self.assertEqual(len(catalog.list_images(name='rep')[0]), 3)
+        self.assertEqual([i['tags'] for i in catalog.list_images(tag='v2')[0]], [['v2']])
+        self.assertEqual(len(catalog.list_images(job='Export')[0]), 3)
+
+    def test_last_page_has_no_cursor(self):
+        images, cursor = catalog.list_images(limit=7)
+        self.assertEqual(len(images), 7)
+        self.assertIsNone(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Chunked upload tests
+:author: Ronan Delacroix
+"""
+import os
+import hashlib
+import unittest
+from jobmanager.builder import chunked
+from .database import DatabaseTestCase
+
+
+class ChunkedUploadTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(ChunkedUploadTest, self).setUp()
+        self.data = os.urandom(chunked.CHUNK_MIN_SIZE * 2 + 100)
+        self.session = chunked.create_session('jobs.py', len(self.data), chunk_size=chunked.CHUNK_MIN_SIZE,
+                                              sha256=hashlib.sha256(self.data).hexdigest().upper())
+
+    def chunk(self, index):
+        return self.data[index * chunked.CHUNK_MIN_SIZE:(index + 1) * chunked.CHUNK_MIN_SIZE]
+
+    def test_session_chunks(self):
+        self.assertEqual(self.session.chunks, 3)
+        self.assertEqual(chunked.chunk_length(self.session, 2), 100)
+        small = chunked.create_session('jobs.py', 0, chunk_size=1)
+        self.assertEqual((small.chunks, small.chunk_size), (1, chunked.CHUNK_MIN_SIZE))
+
+    def test_invalid_index(self):
+        for index in (-1, 3):
+            with self.assertRaisesRegex(Exception, "Invalid chunk index"):
+                chunked.put_chunk(self.session.uuid, index, self.chunk(0))
+
+    def test_invalid_size(self):
+        with self.assertRaisesRegex(Exception, "Invalid chunk 0 size"):
+            chunked.put_chunk(self.session.uuid, 0, self.chunk(0)[:-1])
+        with self.assertRaisesRegex(Exception, "Invalid chunk 2 size"):
+            chunked.put_chunk(self.session.uuid, 2, self.chunk(0))
+
+    def test_checksum(self):
+        with self.assertRaisesRegex(Exception, "Invalid chunk 0 checksum"):
+            chunked.put_chunk(self.session.uuid, 0, self.chunk(0), sha256=hashlib.sha256(b'other').hexdigest())
+        self.assertEqual(chunked.session_status(chunked.get_session(self.session.uuid))['committed'], [])
+        session = chunked.put_chunk(self.session.uuid, 0, self.chunk(0), sha256=hashlib.sha256(self.chunk(0)).hexdigest().upper())
+        self.assertEqual(session.committed, [0])
+
+    def test_chunks_can_be_sent_again_in_any_order(self):
+        for index in (2, 0, 2):
+            chunked.put_chunk(self.session.uuid, index, self.chunk(index))
+        status = chunked.session_status(chunked.get_session(self.session.uuid))
+        self.assertEqual((status['committed'], status['missing'], status['complete']), ([0, 2], [1], False))
+        with self.assertRaisesRegex(Exception, "1 chunks missing"):
+            chunked.assemble(self.session.uuid)
+
+    def test_assemble(self):
+        for index in range(3):
+            chunked.put_chunk(self.session.uuid, index, self.chunk(index))
+        receiver = chunked.assemble(self.session.uuid)
+        self.addCleanup(receiver.clean)
+        with open(os.path.join(receiver.package_folder, 'jobs.py'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        with self.assertRaisesRegex(Exception, "Unknown or expired upload"):
+            chunked.get_session(self.session.uuid)
+
+    def test_assemble_checks_whole_upload_checksum(self):
+        session = chunked.create_session('jobs.py', len(self.data), chunk_size=chunked.CHUNK_MIN_SIZE,
+                                         sha256=hashlib.sha256(b'other').hexdigest())
+        for index in range(3):
+            chunked.put_chunk(session.uuid, index, self.chunk(index))
+        with self.assertRaisesRegex(Exception, "Invalid upload checksum"):
+            chunked.assemble(session.uuid)
+
+    def test_unknown_session(self):
+        with self.assertRaisesRegex(Exception, "Unknown or expired upload"):
+            chunked.put_chunk('unknown', 0, b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
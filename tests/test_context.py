@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Build context exclusion rules tests
+:author: Ronan Delacroix
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from jobmanager.builder.context import pattern_to_regex, ExcludeRules, DEFAULT_EXCLUDES
+
+
+class PatternToRegexTest(unittest.TestCase):
+
+    def assertMatches(self, pattern, paths, expected=True):
+        regex = pattern_to_regex(pattern)
+        for path in paths:
+            self.assertEqual(bool(regex.match(path)), expected, "%s should %smatch %s" % (pattern, '' if expected else 'not ', path))
+
+    def test_star_stays_in_one_folder(self):
+        self.assertMatches('*.log', ['a.log', 'b.log/inside'])
+        self.assertMatches('*.log', ['logs/a.log', 'a.logs'], expected=False)
+
+    def test_double_star_matches_any_depth(self):
+        self.assertMatches('**/__pycache__', ['__pycache__', 'a/__pycache__', 'a/b/__pycache__/c.pyc'])
+        self.assertMatches('**/__pycache__', ['a/__pycache__x'], expected=False)
+        self.assertMatches('docs/**', ['docs/a', 'docs/a/b.md'])
+
+    def test_question_mark_and_classes(self):
+        self.assertMatches('file?.txt', ['file1.txt', 'fileA.txt'])
+        self.assertMatches('file?.txt', ['file.txt', 'file/1.txt', 'file12.txt'], expected=False)
+        self.assertMatches('*.py[cod]', ['a.pyc', 'a.pyo', 'a.pyd'])
+        self.assertMatches('*.py[cod]', ['a.py', 'a.pyx'], expected=False)
+
+    def test_directories_match_their_content(self):
+        self.assertMatches('venv', ['venv', 'venv/lib/site.py'])
+        self.assertMatches('venv', ['venvs', 'src/venv'], expected=False)
+
+    def test_leading_slash_and_dots_are_normalized(self):
+        self.assertMatches('/build', ['build', 'build/x'])
+        self.assertMatches('./build/', ['build/x'])
+
+    def test_special_characters_are_escaped(self):
+        self.assertMatches('a+b(1).txt', ['a+b(1).txt'])
+        self.assertMatches('a+b(1).txt', ['aab1.txt'], expected=False)
+        self.assertMatches('[abc', ['[abc'])
+
+
+class ExcludeRulesTest(unittest.TestCase):
+
+    def test_default_excludes(self):
+        rules = ExcludeRules(DEFAULT_EXCLUDES)
+        for path in ('__pycache__', 'pkg/__pycache__/mod.cpython-311.pyc', 'pkg/mod.pyc', '.git/config',
+                     'pkg.egg-info/PKG-INFO', 'venv/bin/python', '.idea/workspace.xml'):
+            self.assertTrue(rules.excluded(path), path)
+        for path in ('pkg/mod.py', 'pkg/venv/mod.py', 'gitignore', 'pkg/git/mod.py'):
+            self.assertFalse(rules.excluded(path), path)
+
+    def test_comments_and_blank_lines_are_ignored(self):
+        rules = ExcludeRules(['# *.py', '', '   ', 'data'])
+        self.assertEqual(rules.patterns, ['data'])
+        self.assertFalse(rules.excluded('mod.py'))
+
+    def test_last_matching_pattern_wins(self):
+        rules = ExcludeRules(['*.md', '!README.md'])
+        self.assertTrue(rules.excluded('CHANGES.md'))
+        self.assertFalse(rules.excluded('README.md'))
+        rules = ExcludeRules(['!README.md', '*.md'])
+        self.assertTrue(rules.excluded('README.md'))
+
+    def test_negation_includes_back_files_of_excluded_folders(self):
+        rules = ExcludeRules(['data', '!data/schema.json'])
+        self.assertTrue(rules.has_negation)
+        self.assertTrue(rules.excluded('data/big.csv'))
+        self.assertFalse(rules.excluded('data/schema.json'))
+
+    def test_from_folder_reads_dockerignore(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        with open(os.path.join(folder, '.dockerignore'), 'w') as f:
+            f.write("# local files\nsecrets\n!**/*.pyc\n")
+        rules = ExcludeRules.from_folder(folder, ['*.tmp'])
+        self.assertTrue(rules.excluded('secrets/key'))
+        self.assertTrue(rules.excluded('a.tmp'))
+        self.assertFalse(rules.excluded('pkg/mod.pyc'))  # .dockerignore patterns come last
+        self.assertTrue(rules.excluded('pkg/__pycache__'))
+
+
+class ExcludeRulesWalkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        for path in ('pkg/mod.py', 'pkg/__pycache__/mod.pyc', 'data/big.csv', 'data/schema.json', 'README.md'):
+            path = os.path.join(self.folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def walked(self, rules):
+        return sorted(relroot + name for root, relroot, dirs, files in rules.walk(self.folder) for name in files)
+
+    def test_excluded_folders_are_pruned(self):
+        visited = []
+        for root, relroot, dirs, files in ExcludeRules(DEFAULT_EXCLUDES + ['data']).walk(self.folder):
+            visited.append(relroot)
+        self.assertEqual(sorted(visited), ['', 'pkg/'])
+
+    def test_walk_without_excluded_files(self):
+        self.assertEqual(self.walked(ExcludeRules(DEFAULT_EXCLUDES + ['*.md'])),
+                         ['data/big.csv', 'data/schema.json', 'pkg/mod.py'])
+
+    def test_folders_are_walked_when_content_can_be_included_back(self):
+        self.assertEqual(self.walked(ExcludeRules(DEFAULT_EXCLUDES + ['data', '!data/schema.json'])),
+                         ['README.md', 'data/schema.json', 'pkg/mod.py'])
+
+
+if __name__ == '__main__':
+    unittest.main()
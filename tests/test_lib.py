@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Package root discovery tests
+:author: Ronan Delacroix
+"""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+from jobmanager.builder import lib
+
+
+class FindPackageRootTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def create(self, *paths):
+        for path in paths:
+            path = os.path.join(self.folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def find(self, *imports):
+        builder = lib.DockerBuilder.__new__(lib.DockerBuilder)  # without validation of the upload
+        builder.imports = list(imports)
+        builder.logger = logging.getLogger('test')
+        builder.on_log_debug = None
+        builder.on_log_progress = None
+        root = builder.find_package_root(self.folder)
+        return os.path.relpath(root, self.folder)
+
+    def test_modules_at_top_level(self):
+        self.create('jobs.py', 'tasks/__init__.py')
+        self.assertEqual(self.find('jobs', 'tasks'), '.')
+
+    def test_package_in_sub_folder(self):
+        self.create('project-1.0/src/mypkg/__init__.py', 'project-1.0/src/mypkg/jobs.py', 'project-1.0/setup.py')
+        self.assertEqual(self.find('mypkg.jobs'), os.path.join('project-1.0', 'src'))
+
+    def test_shallowest_root_wins(self):
+        self.create('mypkg/__init__.py', 'mypkg/jobs.py', 'vendor/copy/mypkg/__init__.py', 'vendor/copy/mypkg/jobs.py')
+        self.assertEqual(self.find('mypkg.jobs'), '.')
+
+    def test_all_imports_must_share_a_root(self):
+        self.create('a/jobs.py', 'b/tasks.py', 'c/jobs.py', 'c/tasks.py')
+        self.assertEqual(self.find('jobs', 'tasks'), 'c')
+
+    def test_ambiguous_roots_at_same_depth(self):
+        self.create('one/mypkg/__init__.py', 'one/mypkg/jobs.py', 'two/mypkg/__init__.py', 'two/mypkg/jobs.py')
+        with self.assertRaisesRegex(Exception, "Ambiguous package root.*one, two"):
+            self.find('mypkg.jobs')
+
+    def test_partial_imports(self):
+        self.create('a/jobs.py', 'b/tasks.py')
+        with self.assertRaisesRegex(Exception, "Found jobs, tasks but not"):
+            self.find('jobs', 'tasks', 'missing')
+        with self.assertRaisesRegex(Exception, "Found jobs but not missing"):
+            self.find('jobs', 'missing')
+
+    def test_no_entry_point(self):
+        self.create('jobs.py')
+        with self.assertRaisesRegex(Exception, "Found no entrypoint corresponding to 'missing'"):
+            self.find('missing')
+
+    def test_excluded_folders_are_not_searched(self):
+        self.create('venv/lib/mypkg/__init__.py', 'venv/lib/mypkg/jobs.py', '.git/mypkg/jobs.py')
+        with self.assertRaises(Exception):
+            self.find('mypkg.jobs')
+
+    def test_non_identifier_folders_are_not_packages(self):
+        self.create('my-pkg/jobs.py')
+        self.assertEqual(self.find('jobs'), 'my-pkg')
+        with self.assertRaises(Exception):
+            self.find('my-pkg.jobs')
+
+
+if __name__ == '__main__':
+    unittest.main()
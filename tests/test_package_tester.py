@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Static package analysis tests
+:author: Ronan Delacroix
+"""
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+from jobmanager.builder.package_tester import static_scan
+
+
+class StaticScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def create(self, files):
+        for path, source in files.items():
+            path = os.path.join(self.folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(textwrap.dedent(source))
+
+    def scan(self, *handlers):
+        return static_scan(list(handlers), self.folder)
+
+    def test_job_classes_are_found(self):
+        self.create({
+            'mypkg/__init__.py': "",
+            'mypkg/jobs.py': """
+                from jobmanager.common.job import Job, JobTask
+                from .base import BaseJob
+
+                class Export(BaseJob):
+                    pass
+
+                class Step(JobTask):
+                    pass
+            """,
+            'mypkg/base.py': """
+                import jobmanager.common.job as job
+
+                class BaseJob(job.Job):
+                    pass
+            """,
+        })
+        result = self.scan('mypkg.jobs')
+        self.assertEqual(result['result'], "success")
+        self.assertEqual(sorted(result['jobs']), ['BaseJob', 'Export'])
+        self.assertEqual(result['job_tasks'], ['Step'])
+        self.assertEqual(result['modules'], ['mypkg', 'mypkg.base', 'mypkg.jobs'])
+        self.assertEqual(result['external_imports'], ['jobmanager'])
+        self.assertEqual(result['warnings'], [])
+
+    def test_classes_created_with_type_and_factories(self):
+        self.create({
+            'jobs.py': """
+                from jobmanager.common.job import Job
+
+                def register(name):
+                    return type(name, (Job,), {})
+
+                Dynamic = type('Dynamic', (Job,), {})
+                register('Registered')
+            """,
+        })
+        self.assertEqual(sorted(self.scan('jobs')['jobs']), ['Dynamic', 'Registered'])
+
+    def test_re_exported_base_class(self):
+        self.create({
+            'mypkg/__init__.py': "from .base import Base\n",
+            'mypkg/base.py': "from jobmanager.common.job import Job\nclass Base(Job): pass\n",
+            'jobs.py': "import mypkg\nclass Export(mypkg.Base): pass\n",
+        })
+        self.assertEqual(sorted(self.scan('jobs')['jobs']), ['Base', 'Export'])
+
+    def test_syntax_error_fails(self):
+        self.create({'jobs.py': "import helpers\n", 'helpers.py': "def broken(:\n"})
+        result = self.scan('jobs')
+        self.assertEqual(result['result'], "error")
+        self.assertIn("Syntax error in helpers.py line 1", result['error'])
+
+    def test_missing_entry_point_fails(self):
+        self.create({'jobs.py': ""})
+        result = self.scan('jobs', 'missing.jobs')
+        self.assertEqual(result['result'], "error")
+        self.assertIn("Entry point module 'missing.jobs' not found in package", result['error'])
+
+    def test_unresolved_imports_are_warnings(self):
+        self.create({
+            'mypkg/__init__.py': "VALUE = 1\n",
+            'mypkg/jobs.py': """
+                from mypkg import VALUE, helpers, helpres
+                import mypkg.missing
+                from . import tools
+            """,
+            'mypkg/helpers.py': "",
+        })
+        result = self.scan('mypkg.jobs')
+        self.assertEqual(result['result'], "success")
+        self.assertEqual(result['warnings'], [
+            "mypkg/jobs.py line 2 : name 'helpres' not found in module 'mypkg'",
+            "mypkg/jobs.py line 3 : module 'mypkg.missing' not found in package",
+            "mypkg/jobs.py line 4 : name 'tools' not found in module 'mypkg'",
+        ])
+
+    def test_names_bound_in_blocks_are_defined(self):
+        self.create({
+            'mypkg/__init__.py': """
+                import sys
+                if sys.platform == 'win32':
+                    def helper():
+                        pass
+                else:
+                    helper = None
+                try:
+                    from fast import speedup
+                except ImportError as import_error:
+                    speedup = None
+                with open(__file__) as source:
+                    pass
+                for index, item in enumerate([]):
+                    pass
+            """,
+            'jobs.py': "from mypkg import helper, speedup, import_error, source, index, item, sys\n",
+        })
+        self.assertEqual(self.scan('jobs')['warnings'], [])
+
+    def test_dynamic_modules_are_not_checked(self):
+        self.create({
+            'star/__init__.py': "from os.path import *\n",
+            'lazy/__init__.py': "def __getattr__(name):\n    return name\n",
+            'table/__init__.py': "globals()['generated'] = 1\n",
+            'jobs.py': "from star import join\nfrom lazy import anything\nfrom table import generated\n",
+        })
+        self.assertEqual(self.scan('jobs')['warnings'], [])
+
+    def test_optional_imports_are_not_reported(self):
+        self.create({
+            'mypkg/__init__.py': "",
+            'jobs.py': """
+                try:
+                    from mypkg import accelerated
+                    import mypkg.extension
+                except ImportError:
+                    accelerated = None
+            """,
+        })
+        self.assertEqual(self.scan('jobs')['warnings'], [])
+
+    def test_relative_import_beyond_top_level(self):
+        self.create({'jobs.py': "from .. import nothing\n"})
+        result = self.scan('jobs')
+        self.assertEqual(result['result'], "success")
+        self.assertEqual(result['warnings'], ["jobs.py line 1 : relative import beyond top-level package"])
+
+    def test_data_folder_named_like_a_module_is_external(self):
+        self.create({'json/data.json': "{}", 'jobs.py': "import json\n"})
+        result = self.scan('jobs')
+        self.assertEqual(result['external_imports'], ['json'])
+        self.assertEqual(result['warnings'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
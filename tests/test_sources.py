@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Source trees and delta upload tests
+:author: Ronan Delacroix
+"""
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+from jobmanager.builder import sources
+from jobmanager.builder.sources import parse_deleted, apply_delta, save_tree
+from .database import DatabaseTestCase
+
+
+class ParseDeletedTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(parse_deleted(None), [])
+        self.assertEqual(parse_deleted(''), [])
+        self.assertEqual(parse_deleted('[]'), [])
+
+    def test_paths_are_normalized(self):
+        self.assertEqual(parse_deleted('["pkg/old.py", "./docs/", "pkg//sub/../tool.py"]'), ['pkg/old.py', 'docs', 'pkg/tool.py'])
+
+    def test_invalid_values(self):
+        for value in ('pkg/old.py', '{"path": "a"}', '"a"', '[1, 2]', '[["a"]]'):
+            with self.assertRaisesRegex(Exception, "Invalid deleted paths", msg=value):
+                parse_deleted(value)
+
+    def test_unsafe_paths(self):
+        for value in ('["../outside.py"]', '["/etc/passwd"]', '["pkg/../../outside"]'):
+            with self.assertRaisesRegex(Exception, "Unsafe deleted path", msg=value):
+                parse_deleted(value)
+
+
+class ApplyDeltaTest(DatabaseTestCase):
+
+    def setUp(self):
+        super(ApplyDeltaTest, self).setUp()
+        self.folders = []
+        base = self.folder({
+            'pkg/__init__.py': b'',
+            'pkg/jobs.py': b'from .tools import x\n',
+            'pkg/tools.py': b'x = 1\n',
+            'pkg/data/big.bin': b'\0' * 4096,
+            'docs/index.md': b'# Docs\n',
+            'run.sh': b'#!/bin/sh\n',
+        })
+        os.chmod(os.path.join(base, 'run.sh'), 0o755)
+        os.symlink('tools.py', os.path.join(base, 'pkg', 'alias.py'))
+        os.makedirs(os.path.join(base, 'pkg', '__pycache__'))
+        open(os.path.join(base, 'pkg', '__pycache__', 'jobs.pyc'), 'w').close()
+        blob_max_size = sources.BLOB_MAX_SIZE
+        sources.BLOB_MAX_SIZE = 1024  # big.bin is stored in GridFS
+        self.addCleanup(setattr, sources, 'BLOB_MAX_SIZE', blob_max_size)
+        self.stats = save_tree('base', base)
+
+    def folder(self, files=None):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        for path, data in (files or {}).items():
+            path = os.path.join(folder, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return folder
+
+    def tree(self, folder):
+        return dict((e['path'], e.get('sha256') or '-> ' + e['link']) for e in sources.scan_tree(folder))
+
+    def read(self, folder, path):
+        with open(os.path.join(folder, path), 'rb') as f:
+            return f.read()
+
+    def test_tree_is_stored(self):
+        self.assertEqual(self.stats['files'], 7)  # __pycache__ is excluded
+        self.assertEqual(self.stats['stored_blobs'], 6)  # symbolic links have no content
+        self.assertEqual([e['path'] for e in sources.get_manifest('base')],
+                         ['docs/index.md', 'pkg/__init__.py', 'pkg/alias.py', 'pkg/data/big.bin', 'pkg/jobs.py',
+                          'pkg/tools.py', 'run.sh'])
+        self.assertEqual(save_tree('other', self.folder({'a.py': b'x = 1\n'}))['stored_blobs'], 0)
+
+    def test_delta_is_completed_with_base_tree(self):
+        folder = self.folder({'pkg/tools.py': b'x = 2\n', 'pkg/new.py': b'y = 1\n'})
+        stats = apply_delta('base', folder, parse_deleted('["docs"]'))
+        self.assertEqual(stats, {'added': 4, 'replaced': 1, 'deleted': 1})
+        self.assertEqual(sorted(self.tree(folder)), ['pkg/__init__.py', 'pkg/alias.py', 'pkg/data/big.bin', 'pkg/jobs.py',
+                                                     'pkg/new.py', 'pkg/tools.py', 'run.sh'])
+        self.assertEqual(self.read(folder, 'pkg/tools.py'), b'x = 2\n')
+        self.assertEqual(self.read(folder, 'pkg/alias.py'), b'x = 2\n')
+        self.assertEqual(self.read(folder, 'pkg/data/big.bin'), b'\0' * 4096)
+        self.assertTrue(os.path.islink(os.path.join(folder, 'pkg/alias.py')))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(folder, 'run.sh')).st_mode), 0o755)
+
+    def test_deleted_files_and_folders(self):
+        folder = self.folder()
+        apply_delta('base', folder, ['pkg/tools.py', 'pkg/data', 'doc'])
+        self.assertEqual(sorted(self.tree(folder)), ['docs/index.md', 'pkg/__init__.py', 'pkg/alias.py', 'pkg/jobs.py', 'run.sh'])
+
+    def test_unchanged_delta_gives_same_tree(self):
+        base_tree = dict((e['path'], e.get('sha256') or '-> ' + e['link']) for e in sources.get_manifest('base'))
+        folder = self.folder()
+        apply_delta('base', folder, [])
+        self.assertEqual(self.tree(folder), base_tree)
+
+    def test_files_are_not_written_through_uploaded_links(self):
+        outside = self.folder()
+        folder = self.folder()
+        os.symlink(outside, os.path.join(folder, 'pkg'))
+        os.symlink('pkg', os.path.join(folder, 'docs'))
+        apply_delta('base', folder, [])
+        self.assertEqual(os.listdir(outside), [])
+        self.assertEqual(self.read(folder, 'run.sh'), b'#!/bin/sh\n')
+
+    def test_links_of_manifest_must_stay_inside(self):
+        outside = self.folder()
+        source = self.folder({'pkg/jobs.py': b''})
+        os.symlink(outside, os.path.join(source, 'escape'))
+        os.symlink('../../etc/passwd', os.path.join(source, 'pkg', 'passwd'))
+        save_tree('links', source)
+        folder = self.folder()
+        apply_delta('links', folder, [])
+        self.assertEqual(sorted(self.tree(folder)), ['pkg/jobs.py'])
+
+    def test_missing_tree(self):
+        with self.assertRaisesRegex(Exception, "No source tree stored for image unknown"):
+            apply_delta('unknown', self.folder(), [])
+
+    def test_incomplete_tree(self):
+        sources.SourceBlob.objects.delete()
+        with self.assertRaisesRegex(Exception, "Source tree of image base is incomplete"):
+            apply_delta('base', self.folder(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Job Manager Docker Builder - Upload path safety tests
+:author: Ronan Delacroix
+"""
+import io
+import os
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+from jobmanager.builder import upload
+from jobmanager.builder.upload import is_safe_path, is_inside, has_linked_parent, UploadReceiver, UploadLimitError
+
+
+def tar_archive(members):
+    """
+    Gzipped tar archive of (name, data or None for a folder, symbolic link target, hard link target) tuples.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        for name, content, symlink, hardlink in members:
+            info = tarfile.TarInfo(name)
+            if symlink is not None:
+                info.type, info.linkname = tarfile.SYMTYPE, symlink
+            elif hardlink is not None:
+                info.type, info.linkname = tarfile.LNKTYPE, hardlink
+            elif content is None:
+                info.type = tarfile.DIRTYPE
+            else:
+                info.size = len(content)
+            tar.addfile(info, io.BytesIO(content) if content else None)
+    return data.getvalue()
+
+
+def member(name, content=b''):
+    return name, content, None, None
+
+
+def folder(name):
+    return name, None, None, None
+
+
+def symlink(name, target):
+    return name, None, target, None
+
+
+def hardlink(name, target):
+    return name, None, None, target
+
+
+class PathChecksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outside)
+
+    def test_is_safe_path(self):
+        for name in ('a.py', 'pkg/a.py', './pkg/a.py', 'pkg/../a.py', 'a..b', '..a', 'pkg/..'):
+            self.assertTrue(is_safe_path(name), name)
+        for name in ('/etc/passwd', '..', '../a.py', 'pkg/../../a.py', './../a.py'):
+            self.assertFalse(is_safe_path(name), name)
+
+    def test_is_inside(self):
+        self.assertTrue(is_inside(self.folder, self.folder))
+        self.assertTrue(is_inside(self.folder, os.path.join(self.folder, 'a', 'b')))
+        self.assertFalse(is_inside(self.folder, os.path.join(self.folder, '..')))
+        self.assertFalse(is_inside(self.folder, self.folder + '-other'))
+        self.assertFalse(is_inside(self.folder, self.outside))
+
+    def test_is_inside_resolves_links(self):
+        os.symlink(self.outside, os.path.join(self.folder, 'out'))
+        os.mkdir(os.path.join(self.folder, 'real'))
+        os.symlink('real', os.path.join(self.folder, 'alias'))
+        self.assertFalse(is_inside(self.folder, os.path.join(self.folder, 'out', 'file')))
+        self.assertTrue(is_inside(self.folder, os.path.join(self.folder, 'alias', 'file')))
+
+    def test_has_linked_parent(self):
+        os.makedirs(os.path.join(self.folder, 'pkg', 'sub'))
+        os.symlink(self.outside, os.path.join(self.folder, 'out'))
+        os.symlink('pkg', os.path.join(self.folder, 'inner'))
+        os.symlink('inner', os.path.join(self.folder, 'chain'))
+        self.assertFalse(has_linked_parent(self.folder, 'file.py'))
+        self.assertFalse(has_linked_parent(self.folder, 'pkg/sub/file.py'))
+        self.assertFalse(has_linked_parent(self.folder, 'missing/file.py'))
+        self.assertFalse(has_linked_parent(self.folder, 'out'))  # the link itself, not a parent
+        self.assertTrue(has_linked_parent(self.folder, 'out/file.py'))
+        self.assertTrue(has_linked_parent(self.folder, 'inner/sub/file.py'))  # even pointing inside
+        self.assertTrue(has_linked_parent(self.folder, 'chain/file.py'))
+
+    def test_has_linked_parent_with_linked_upload_folder(self):
+        os.symlink(self.folder, os.path.join(self.outside, 'upload'))
+        self.assertFalse(has_linked_parent(os.path.join(self.outside, 'upload'), 'pkg/file.py'))
+
+
+class UploadReceiverTest(unittest.TestCase):
+
+    def receive(self, filename, data):
+        receiver = UploadReceiver(filename)
+        self.addCleanup(receiver.clean)
+        for i in range(0, len(data), 1000):
+            receiver.write(data[i:i + 1000])
+        receiver.finish()
+        return receiver
+
+    def files(self, receiver):
+        return sorted(os.path.relpath(os.path.join(root, name), receiver.package_folder)
+                      for root, dirs, files in os.walk(receiver.package_folder) for name in files + dirs)
+
+    def test_tar_archive_is_extracted(self):
+        receiver = self.receive('package.tar.gz', tar_archive([
+            folder('pkg'), member('pkg/__init__.py'), member('pkg/jobs.py', b'x = 1\n'),
+            symlink('pkg/alias.py', 'jobs.py'), hardlink('pkg/copy.py', 'pkg/jobs.py')]))
+        self.assertEqual(self.files(receiver), ['pkg', 'pkg/__init__.py', 'pkg/alias.py', 'pkg/copy.py', 'pkg/jobs.py'])
+        with open(os.path.join(receiver.package_folder, 'pkg', 'alias.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'x = 1\n')
+        self.assertEqual(receiver.archive, receiver.path)
+
+    def test_unsafe_tar_members_are_rejected(self):
+        for members in ([member('../evil.py')],
+                        [member('/tmp/evil.py')],
+                        [symlink('out', '/etc')],
+                        [symlink('pkg/out', '../../etc')],
+                        [hardlink('passwd', '/etc/passwd')],
+                        [hardlink('passwd', '../passwd')]):
+            with self.assertRaises(UploadLimitError, msg=members):
+                self.receive('package.tar.gz', tar_archive(members))
+
+    def test_writes_through_symbolic_links_are_rejected(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        for members in ([symlink('inner', '.'), symlink('inner/out', outside), member('out/evil.py')],
+                        [folder('pkg'), symlink('alias', 'pkg'), member('alias/evil.py')]):
+            with self.assertRaises(UploadLimitError, msg=members):
+                self.receive('package.tar.gz', tar_archive(members))
+        self.assertEqual(os.listdir(outside), [])
+
+    def test_file_count_limit(self):
+        limit = upload.UPLOAD_MAX_FILES
+        upload.UPLOAD_MAX_FILES = 2
+        self.addCleanup(setattr, upload, 'UPLOAD_MAX_FILES', limit)
+        with self.assertRaisesRegex(UploadLimitError, "more than 2 files"):
+            self.receive('package.tar.gz', tar_archive([member('a.py'), member('b.py'), member('c.py')]))
+
+    def test_size_limit(self):
+        limit = upload.UPLOAD_MAX_SIZE
+        upload.UPLOAD_MAX_SIZE = 1500
+        self.addCleanup(setattr, upload, 'UPLOAD_MAX_SIZE', limit)
+        with self.assertRaises(UploadLimitError):
+            self.receive('jobs.py', b'#' * 2000)
+
+    def test_unsafe_zip_members_are_rejected(self):
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            archive.writestr('../evil.py', 'x = 1')
+        with self.assertRaisesRegex(UploadLimitError, "Unsafe path"):
+            self.receive('package.zip', data.getvalue())
+
+    def test_single_module_is_copied(self):
+        receiver = self.receive('jobs.py', b'x = 1\n')
+        self.assertEqual(self.files(receiver), ['jobs.py'])
+        self.assertIsNone(receiver.archive)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Offline benchmark suite
+
+Builds synthetic job packages against a stand-in Docker daemon, a local wheel index and mongomock, and reports
+per-phase latency and throughput. Usage (from the repository root) :
+
+    python tools/benchmark run --files 10 1000 --requirements 0 5 --concurrency 1 4
+    python tools/benchmark compare tools/benchmark/results/OLD.json tools/benchmark/results/NEW.json
+    python tools/benchmark startup
+
+:author: Ronan Delacroix
+"""
+import os
+import sys
+import logging
+import argparse
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import runner
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark', description='Job Manager Builder offline benchmark suite.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run benchmark scenarios and save results.')
+    run_parser.add_argument('--modes', nargs='+', default=['builder', 'api'], choices=['builder', 'api'],
+                            help='Drive builds with DockerBuilder directly, and/or through the /build endpoint.')
+    run_parser.add_argument('--files', nargs='+', type=int, default=[10, 1000], help='Package file counts.')
+    run_parser.add_argument('--jobs', nargs='+', type=int, default=[4], help='Job subclass counts.')
+    run_parser.add_argument('--requirements', nargs='+', type=int, default=[0, 5], help='Requirement counts.')
+    run_parser.add_argument('--formats', nargs='+', default=['tar.gz'], choices=runner.packages.FORMATS,
+                            help='Package archive formats.')
+    run_parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4], help='Parallel build counts.')
+    run_parser.add_argument('--builds', type=int, default=8, help='Measured builds per scenario and concurrency.')
+    run_parser.add_argument('--warmup', type=int, default=1, help='Unmeasured builds run first (virtual env cache...).')
+    run_parser.add_argument('--push', action='store_true', default=False, help='Push images to the stand-in registry.')
+    run_parser.add_argument('--wheelhouse', action='store_true', default=False, help='Build with a wheelhouse.')
+    run_parser.add_argument('--dependency-images', action='store_true', default=False, help='Build dependency images.')
+    run_parser.add_argument('--pipelined', action='store_true', default=False, help='Build images during validation.')
+    run_parser.add_argument('--validation-mode', default='host', choices=['host', 'image'],
+                            help='Test imports in a host virtual env, or in a container of the built image.')
+    run_parser.add_argument('--build-latency', type=float, default=0.05, help='Simulated docker build seconds.')
+    run_parser.add_argument('--push-latency', type=float, default=0.05, help='Simulated docker push seconds per tag.')
+    run_parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'),
+                            help='Folder where result files are saved.')
+
+    startup_parser = subparsers.add_parser('startup', help='Measure startup of the build command and of the server.')
+    startup_parser.add_argument('--runs', type=int, default=5, help='Process launches per measure.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='Slowdown percentage reported as regression (exit code 1).')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s %(message)s')
+    if args.command == 'run':
+        if 'api' in args.modes:
+            import jobmanager.builder.api  # monkey patches with eventlet, before any thread is started
+        runner.run(args)
+        return 0
+    if args.command == 'startup':
+        runner.startup(args.runs)
+        return 0
+    if args.command == 'compare':
+        return 1 if runner.compare(args.old, args.new, args.threshold) else 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Benchmark stand-in Docker daemon
+:author: Ronan Delacroix
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import signal
+import struct
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import hashlib
+import tarfile
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BodyReader:
+    """
+    Readable file object over a request body, with or without chunked transfer encoding.
+    """
+    def __init__(self, handler):
+        self.rfile = handler.rfile
+        self.chunked = handler.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        self.remaining = int(handler.headers.get('Content-Length') or 0)
+        self.buffer = b''
+        self.ended = False
+        self.size = 0
+        self.hash = hashlib.sha256()
+
+    def next_chunk(self):
+        if self.chunked:
+            size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''
+            data = self.rfile.read(size)
+            self.rfile.readline()
+            return data
+        data = self.rfile.read(min(self.remaining, 65536)) if self.remaining else b''
+        self.remaining -= len(data)
+        return data
+
+    def read(self, size=-1):
+        while not self.ended and (size < 0 or len(self.buffer) < size):
+            chunk = self.next_chunk()
+            if not chunk:
+                self.ended = True
+                break
+            self.size += len(chunk)
+            self.hash.update(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def drain(self):
+        while not self.ended:
+            self.read(65536)
+        self.buffer = b''
+
+
+class FakeDocker:
+    """
+    In-memory stand-in of the Docker Engine API calls done by the builder : ping, version, image inspect, build,
+    tag, push, login and remove. Build and push durations are simulated with fixed and per-megabyte latencies.
+    Containers run their python command on the host, in the package folder of their image, with the synthetic
+    requirement wheels of the local index (PIP_FIND_LINKS) importable in place of the requirements installed in images.
+    """
+    def __init__(self, build_latency=0.05, build_latency_per_mb=0.01, push_latency=0.05, layers=3):
+        self.build_latency = build_latency
+        self.build_latency_per_mb = build_latency_per_mb
+        self.push_latency = push_latency
+        self.layers = layers
+        self.images = {}  # id -> attrs
+        self.containers = {}  # id -> dict
+        self.roots = tempfile.mkdtemp(prefix='fake-docker-')  # package folder of each image
+        self.lock = threading.Lock()
+        self.stats = {'builds': 0, 'context_bytes': 0, 'context_files': 0, 'pushes': 0, 'containers': 0}
+        self.server = None
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(FakeDockerHandler):
+            docker = fake
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-docker", daemon=True).start()
+        return "tcp://%s:%d" % self.server.server_address
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.roots, ignore_errors=True)
+
+    def find(self, name):
+        name = unquote(name)
+        with self.lock:
+            if name.startswith('sha256:') and name in self.images:
+                return self.images[name]
+            for image in self.images.values():
+                if name in image['RepoTags'] or (name + ':latest') in image['RepoTags']:
+                    return image
+                if len(name) >= 10 and image['Id'][7:].startswith(name):
+                    return image
+        return None
+
+    def add_tag(self, image, repo, tag):
+        repo_tag = "%s:%s" % (repo, tag or 'latest')
+        with self.lock:
+            for other in self.images.values():
+                if repo_tag in other['RepoTags']:
+                    other['RepoTags'].remove(repo_tag)
+            image['RepoTags'].append(repo_tag)
+
+    def build(self, body, tag):
+        files = 0
+        root = tempfile.mkdtemp(dir=self.roots)
+        with tarfile.open(fileobj=body, mode='r|') as tar:
+            for member in tar:
+                if member.isreg():
+                    files += 1
+                if member.name.startswith('package/') and (member.isreg() or member.isdir()):
+                    tar.extract(member, root)
+        body.drain()
+        time.sleep(self.build_latency + self.build_latency_per_mb * body.size / 1048576.0)
+        image_id = "sha256:" + body.hash.hexdigest()
+        if os.path.isdir(os.path.join(self.roots, image_id[7:])):
+            shutil.rmtree(root)
+        else:
+            os.rename(root, os.path.join(self.roots, image_id[7:]))
+        with self.lock:
+            image = self.images.setdefault(image_id, {
+                'Id': image_id, 'RepoTags': [], 'Size': body.size + 50 * 1048576, 'Created': time.time(), 'Config': {}
+            })
+            self.stats['builds'] += 1
+            self.stats['context_bytes'] += body.size
+            self.stats['context_files'] += files
+        if tag:
+            repo, _, tag_name = tag.rpartition(':') if ':' in tag.split('/')[-1] else (tag, None, 'latest')
+            self.add_tag(image, repo, tag_name)
+        return [
+            {'stream': "Step 1/1 : FAKE BUILD (%d files, %d bytes)\n" % (files, body.size)},
+            {'aux': {'ID': image_id}},
+            {'stream': "Successfully built %s\n" % image_id[7:19]},
+        ]
+
+    def remove(self, name, image):
+        """
+        Remove a tag of an image, and the image once it has no tag left (or when removed by ID).
+        """
+        repo_tag = name if ':' in name.split('/')[-1] else name + ':latest'
+        with self.lock:
+            if repo_tag in image['RepoTags']:
+                image['RepoTags'].remove(repo_tag)
+                if image['RepoTags']:
+                    return [{'Untagged': repo_tag}]
+            self.images.pop(image['Id'], None)
+        return [{'Deleted': image['Id']}]
+
+    def create_container(self, config):
+        image = self.find(config['Image'])
+        if not image:
+            return None
+        container_id = hashlib.sha256(os.urandom(16)).hexdigest()
+        with self.lock:
+            self.containers[container_id] = {
+                'Id': container_id, 'Name': '/' + container_id[:12], 'Image': image['Id'],
+                'Config': dict(config, Tty=False), 'State': {'Status': 'created', 'Running': False, 'ExitCode': 0},
+                'HostConfig': dict(config.get('HostConfig') or {}, LogConfig={'Type': 'json-file', 'Config': {}}),
+                'thread': None, 'stdout': b'', 'stderr': b''
+            }
+            self.stats['containers'] += 1
+        return container_id
+
+    def run_container(self, container):
+        config = container['Config']
+        command = (config.get('Entrypoint') or []) + (config.get('Cmd') or [])
+        if command and command[0] in ('python', 'python3'):
+            command[0] = sys.executable
+        package_folder = os.path.join(self.roots, container['Image'][7:], 'package')
+        wheels = glob.glob(os.path.join(os.environ.get('PIP_FIND_LINKS', ''), 'bench_req_*.whl'))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(wheels))
+        try:
+            process = subprocess.run(command, cwd=package_folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            container['stdout'], container['stderr'] = process.stdout, process.stderr
+            container['State'].update(ExitCode=process.returncode)
+        except OSError as e:
+            container['stderr'] = str(e).encode('utf-8')
+            container['State'].update(ExitCode=127)
+        container['State'].update(Status='exited', Running=False)
+
+    def container_logs(self, container, stdout, stderr):
+        """
+        Logs of a container without tty, multiplexed : each frame has a header with its stream and size.
+        """
+        data = b''
+        for stream, wanted, output in ((1, stdout, container['stdout']), (2, stderr, container['stderr'])):
+            if wanted and output:
+                data += struct.pack('>BxxxL', stream, len(output)) + output
+        return data
+
+    def push(self, name, tag):
+        events = [{'status': "The push refers to repository [%s]" % name}]
+        for i in range(self.layers):
+            events.append({'status': 'Preparing', 'id': 'layer%d' % i})
+        time.sleep(self.push_latency)
+        for i in range(self.layers):
+            size = 1048576 * (i + 1)
+            events.append({'status': 'Pushing', 'id': 'layer%d' % i, 'progressDetail': {'current': size, 'total': size}})
+            events.append({'status': 'Pushed', 'id': 'layer%d' % i})
+        events.append({'status': "%s: digest: sha256:%s size: 1234" % (tag, hashlib.sha256((name + tag).encode()).hexdigest())})
+        with self.lock:
+            self.stats['pushes'] += 1
+        return events
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    docker = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, stream=False):
+        if stream:
+            # docker-py only decodes event streams sent with chunked encoding, one event per chunk
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for event in data:
+                chunk = (json.dumps(event) + '\r\n').encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self, name):
+        self.send_json({'message': "No such image: %s" % name}, status=404)
+
+    def route(self, method):
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        body = BodyReader(self)
+
+        if path == '/_bench/stats':
+            with self.docker.lock:
+                self.send_json(self.docker.stats)
+        elif path == '/_ping':
+            body = b'OK'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif path == '/version':
+            self.send_json({'Version': 'fake', 'ApiVersion': '1.41', 'MinAPIVersion': '1.12', 'Os': 'linux'})
+        elif path == '/auth':
+            body.drain()
+            self.send_json({'Status': 'Login Succeeded'})
+        elif path == '/images/json':
+            with self.docker.lock:
+                self.send_json(list(self.docker.images.values()))
+        elif path == '/build' and method == 'POST':
+            self.send_json(self.docker.build(body, query.get('t')), stream=True)
+        elif path.startswith('/containers/'):
+            self.route_container(method, path, query, body)
+        else:
+            match = re.match(r'^/images/(.+?)(/json|/tag|/push)?$', path)
+            if not match:
+                body.drain()
+                self.send_json({'message': "page not found"}, status=404)
+                return
+            name, action = match.group(1), match.group(2)
+            body.drain()
+            image = self.docker.find(name)
+            if action == '/push':
+                if not image and not self.docker.find("%s:%s" % (unquote(name), query.get('tag', 'latest'))):
+                    return self.not_found(name)
+                self.send_json(self.docker.push(unquote(name), query.get('tag', 'latest')), stream=True)
+            elif not image:
+                self.not_found(name)
+            elif action == '/json':
+                self.send_json(image)
+            elif action == '/tag':
+                self.docker.add_tag(image, query.get('repo'), query.get('tag'))
+                self.send_json({}, status=201)
+            elif method == 'DELETE':
+                self.send_json(self.docker.remove(unquote(name), image))
+            else:
+                self.send_json({'message': "page not found"}, status=404)
+
+    def send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def route_container(self, method, path, query, body):
+        if path == '/containers/create':
+            container_id = self.docker.create_container(json.loads(body.read().decode('utf-8') or '{}'))
+            if not container_id:
+                return self.not_found(path)
+            return self.send_json({'Id': container_id, 'Warnings': []}, status=201)
+        body.drain()
+        match = re.match(r'^/containers/([0-9a-f]+)(/json|/start|/wait|/logs)?$', path)
+        container = self.docker.containers.get(match.group(1)) if match else None
+        if not container:
+            return self.send_json({'message': "No such container: %s" % path}, status=404)
+        action = match.group(2)
+        if action == '/json':
+            self.send_json(dict((k, v) for k, v in container.items() if k not in ('thread', 'stdout', 'stderr')))
+        elif action == '/start':
+            container['State'].update(Status='running', Running=True)
+            container['thread'] = threading.Thread(target=self.docker.run_container, args=(container,), daemon=True)
+            container['thread'].start()
+            self.send_empty()
+        elif action == '/wait':
+            if container['thread']:
+                container['thread'].join()
+            self.send_json({'StatusCode': container['State']['ExitCode'], 'Error': None})
+        elif action == '/logs':
+            data = self.docker.container_logs(container, query.get('stdout') in ('1', 'true', 'True'),
+                                              query.get('stderr') in ('1', 'true', 'True'))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif method == 'DELETE':
+            with self.docker.lock:
+                self.docker.containers.pop(container['Id'], None)
+            self.send_empty()
+        else:
+            self.send_json({'message': "page not found"}, status=404)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class FakeDockerProcess:
+    """
+    Stand-in Docker daemon run in its own process, like a real daemon, so that the builder process (possibly
+    monkey patched by eventlet) is not slowed down by it.
+    """
+    def __init__(self, build_latency=0.05, build_latency_per_mb=0.01, push_latency=0.05):
+        self.args = ['--build-latency', str(build_latency), '--build-latency-per-mb', str(build_latency_per_mb),
+                     '--push-latency', str(push_latency)]
+        self.process = None
+        self.url = None
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, __file__] + self.args, stdout=subprocess.PIPE)
+        self.url = self.process.stdout.readline().decode('ascii').strip()
+        if not self.url.startswith('tcp://'):
+            raise Exception("Stand-in Docker daemon failed to start.")
+        return self.url
+
+    @property
+    def stats(self):
+        with urllib.request.urlopen(self.url.replace('tcp://', 'http://') + '/_bench/stats') as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def stop(self):
+        if self.process:
+            self.process.send_signal(signal.SIGINT)  # lets the daemon remove its image folders
+            self.process.wait()
+            self.process = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in Docker daemon for benchmarks.')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--build-latency', type=float, default=0.05)
+    parser.add_argument('--build-latency-per-mb', type=float, default=0.01)
+    parser.add_argument('--push-latency', type=float, default=0.05)
+    args = parser.parse_args()
+    daemon = FakeDocker(build_latency=args.build_latency, build_latency_per_mb=args.build_latency_per_mb,
+                        push_latency=args.push_latency)
+    daemon.server = ThreadingHTTPServer(('127.0.0.1', args.port), type('Handler', (FakeDockerHandler,), {'docker': daemon}))
+    daemon.server.daemon_threads = True
+    print("tcp://%s:%d" % daemon.server.server_address, flush=True)
+    try:
+        daemon.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(daemon.roots, ignore_errors=True)
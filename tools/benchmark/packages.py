@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Benchmark synthetic job packages
+:author: Ronan Delacroix
+"""
+import os
+import tarfile
+import zipfile
+
+FORMATS = ['tar', 'tar.gz', 'zip']
+
+JOBS_HEADER = '''import mongoengine
+from jobmanager.common.job import Job, JobTask, make_job
+%(imports)s
+
+
+class BenchTask(JobTask):
+    pass
+'''
+
+JOB_CLASS = '''
+
+class BenchJob%(index)d(Job):
+    value = mongoengine.IntField(default=%(index)d)
+
+    def process(self):
+        self.log_info("Job %(index)d")
+'''
+
+JOB_FACTORY = '''
+
+@make_job("BenchDecJob%(index)d", value=mongoengine.IntField(default=%(index)d))
+def bench_job_%(index)d(job):
+    job.log_info("Job %(index)d")
+'''
+
+
+def write_package(folder, name, files, jobs, requirements, nonce, file_size=2048):
+    """
+    Write a synthetic job package in folder.
+    :param files: total file count, the job modules included. Other files are helper modules and data files.
+    :param jobs: Job subclass count, one out of four created with the make_job decorator
+    :param requirements: count of bench-req-N requirements imported by the jobs module
+    :param nonce: written in the package so that packages of different builds never share a fingerprint
+    :return: tuple (list of imports, list of requirements)
+    """
+    package = os.path.join(folder, name)
+    os.makedirs(os.path.join(package, 'helpers'))
+    os.makedirs(os.path.join(package, 'data'))
+    reqs = ['bench-req-%d' % i for i in range(requirements)]
+
+    with open(os.path.join(package, '__init__.py'), 'w') as f:
+        f.write("NONCE = %r\n" % nonce)
+    with open(os.path.join(package, 'helpers', '__init__.py'), 'w') as f:
+        f.write('')
+    with open(os.path.join(package, 'jobs.py'), 'w') as f:
+        imports = '\n'.join('import %s' % r.replace('-', '_') for r in reqs)
+        f.write(JOBS_HEADER % {'imports': imports})
+        for i in range(jobs):
+            f.write((JOB_FACTORY if i % 4 == 3 else JOB_CLASS) % {'index': i})
+
+    # 1 module out of 10 filler files, data files for the rest
+    for i in range(max(0, files - 4)):
+        if i % 10 == 0:
+            with open(os.path.join(package, 'helpers', 'helper_%05d.py' % i), 'w') as f:
+                f.write("def helper_%d(value):\n    return value * %d\n" % (i, i))
+                f.write("# %s\n" % ('x' * (file_size // 2)))
+        else:
+            with open(os.path.join(package, 'data', 'data_%05d.txt' % i), 'wb') as f:
+                f.write(os.urandom(file_size // 2).hex().encode('ascii'))
+    return ['%s.jobs' % name], reqs
+
+
+def write_archive(folder, archive_path, fmt):
+    """
+    Archive folder content in the given format (tar, tar.gz or zip).
+    """
+    if fmt in ('tar', 'tar.gz'):
+        with tarfile.open(archive_path, 'w:gz' if fmt == 'tar.gz' else 'w') as tar:
+            for entry in sorted(os.listdir(folder)):
+                tar.add(os.path.join(folder, entry), arcname=entry)
+    elif fmt == 'zip':
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for root, dirs, files in os.walk(folder):
+                for f in sorted(files):
+                    path = os.path.join(root, f)
+                    archive.write(path, os.path.relpath(path, folder))
+    else:
+        raise ValueError("Unknown archive format %s" % fmt)
+    return archive_path
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Benchmark runner
+:author: Ronan Delacroix
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+import datetime
+import platform
+import tempfile
+import itertools
+import subprocess
+import concurrent.futures
+
+import packages
+import wheels
+import fake_docker
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Environment:
+    """
+    Offline build environment : stand-in Docker daemon, local wheel index, mongomock database and temporary
+    builder folders. Builder settings are set here the way bin/jobmanager-builder does.
+    """
+    def __init__(self, work_folder, max_requirements, push=False, wheelhouse=False, dependency_images=False,
+                 pipelined=False, validation_mode='host', build_latency=0.05, push_latency=0.05):
+        self.work_folder = work_folder
+        self.docker = fake_docker.FakeDockerProcess(build_latency=build_latency, push_latency=push_latency)
+        self.max_requirements = max_requirements
+        self.push = push
+        self.wheelhouse = wheelhouse
+        self.dependency_images = dependency_images
+        self.pipelined = pipelined
+        self.validation_mode = validation_mode
+
+    def start(self):
+        import mongoengine
+        import mongomock
+        import mongomock.gridfs
+        from jobmanager.builder import lib, buildlog
+
+        index = wheels.create_index(os.path.join(self.work_folder, 'index'), self.max_requirements)
+        os.environ['PIP_NO_INDEX'] = '1'
+        os.environ['PIP_FIND_LINKS'] = index
+        os.environ['PIP_DISABLE_PIP_VERSION_CHECK'] = '1'
+        os.environ['DOCKER_HOST'] = self.docker.start()
+
+        from jobmanager.builder.models import BuildEvent
+
+        mongomock.gridfs.enable_gridfs_integration()
+        BuildEvent._meta['max_size'] = None  # mongomock has no capped collections
+        mongoengine.connect('jobmanager-benchmark', mongo_client_class=mongomock.MongoClient)
+
+        lib.VENV_CACHE_FOLDER = os.path.join(self.work_folder, 'venv')
+        lib._venv_cache = None
+        lib._docker_session = None
+        lib.DOCKER_REGISTRY_URL = 'localhost:5000' if self.push else None
+        lib.WHEELHOUSE_FOLDER = os.path.join(self.work_folder, 'wheelhouse') if self.wheelhouse else None
+        lib.DEPENDENCY_IMAGES = self.dependency_images
+        lib.PIPELINED_BUILDS = self.pipelined
+        lib.VALIDATION_MODE = self.validation_mode
+        buildlog.BUILD_LOG_FOLDER = os.path.join(self.work_folder, 'logs')
+
+    def stop(self):
+        from jobmanager.builder import lib
+        lib.get_import_checkers().stop()
+        self.docker.stop()
+
+
+def make_upload(work_folder, scenario):
+    """
+    Generate a unique synthetic package for a scenario.
+    :return: tuple (package folder, archive path or None, imports, requirements)
+    """
+    folder = tempfile.mkdtemp(prefix='package-', dir=work_folder)
+    package_folder = os.path.join(folder, 'package')
+    os.mkdir(package_folder)
+    imports, requirements = packages.write_package(package_folder, 'benchpkg', scenario['files'], scenario['jobs'],
+                                                   scenario['requirements'], nonce=uuid.uuid4().hex)
+    archive = packages.write_archive(package_folder, os.path.join(folder, 'package.' + scenario['format']), scenario['format'])
+    return package_folder, archive, imports, requirements
+
+
+def run_builder(work_folder, scenario, index):
+    """
+    Build a synthetic package directly with DockerBuilder.
+    :return: dict of phase durations, with total
+    """
+    from jobmanager.builder import lib
+    package_folder, archive, imports, requirements = make_upload(work_folder, scenario)
+    try:
+        start = time.time()
+        builder = lib.DockerBuilder(package_folder, 'bench-%d' % index, ['latest'], imports, requirements, [],
+                                    logger=logging.getLogger('benchmark.build'),
+                                    archive=archive if not archive.endswith('.zip') else None)
+        builder.build()
+        return dict(builder.timings, total=time.time() - start)
+    finally:
+        shutil.rmtree(os.path.dirname(package_folder), ignore_errors=True)
+
+
+def run_api(work_folder, scenario, index, client):
+    """
+    Upload a synthetic package archive on /build and wait for the build result.
+    :return: dict of phase durations, with upload, queue wait and total
+    """
+    from jobmanager.builder.models import BuildRequest
+    package_folder, archive, imports, requirements = make_upload(work_folder, scenario)
+    try:
+        start = time.time()
+        with open(archive, 'rb') as f:
+            response = client.post('/build', content_type='multipart/form-data', data={
+                'package': (f, os.path.basename(archive)),
+                'name': 'bench-%d' % index,
+                'imports': ' '.join(imports),
+                'pip': ' '.join(requirements),
+                'tags': 'latest'
+            })
+        upload = time.time() - start
+        result = json.loads(response.data.decode('utf-8'))
+        if result.get('result') != 'queued':
+            raise Exception("Build not queued : %s" % result.get('message'))
+        while True:
+            build_request = BuildRequest.objects(uuid=result['build']).only('status', 'result', 'started', 'created').first()
+            if build_request.status in ('success', 'error'):
+                break
+            time.sleep(0.02)
+        if build_request.status == 'error':
+            raise Exception(build_request.result.get('message'))
+        timings = dict(build_request.result.get('timings', {}))
+        timings.update(upload=upload, queue_wait=(build_request.started - build_request.created).total_seconds(),
+                       total=time.time() - start)
+        return timings
+    finally:
+        shutil.rmtree(os.path.dirname(package_folder), ignore_errors=True)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summarize(timings):
+    phases = sorted(set(itertools.chain.from_iterable(timings)))
+    return dict((phase, {
+        'p50': percentile([t[phase] for t in timings if phase in t], 50),
+        'p95': percentile([t[phase] for t in timings if phase in t], 95),
+        'mean': sum(t[phase] for t in timings if phase in t) / len([t for t in timings if phase in t]),
+        'count': len([t for t in timings if phase in t])
+    }) for phase in phases)
+
+
+def run_level(mode, work_folder, scenario, concurrency, builds, warmup):
+    """
+    Run builds of a scenario with concurrency parallel builds.
+    :return: result dict (throughput, errors, phase latencies)
+    """
+    client = None
+    if mode == 'api':
+        from jobmanager.builder import api, builds as build_queues
+        api.build_queue = build_queues.BuildQueue(api.process_build, workers=concurrency, logger=logging.getLogger('benchmark.queue'))
+        api.build_queue.start()
+        client = api.app.test_client()
+
+    def run(index):
+        if mode == 'api':
+            return run_api(work_folder, scenario, index, client)
+        return run_builder(work_folder, scenario, index)
+
+    for i in range(warmup):
+        run(-1 - i)
+
+    timings = []
+    errors = []
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run, i) for i in range(builds)]:
+            try:
+                timings.append(future.result())
+            except Exception as e:
+                errors.append(str(e))
+    wall = time.time() - start
+    if mode == 'api':
+        api.build_queue.stop()
+    return {
+        'mode': mode,
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'builds': builds,
+        'errors': len(errors),
+        'error_messages': sorted(set(errors))[:5],
+        'wall': wall,
+        'throughput': len(timings) / wall if wall else None,
+        'phases': summarize(timings)
+    }
+
+
+STARTUP_COMMANDS = [
+    ('server imports', ['-c', 'import jobmanager.builder.api, mongoengine, configargparse']),
+    ('build command', [os.path.join(REPOSITORY_ROOT, 'bin', 'jobmanager-builder'), 'build', '--help']),
+    ('build imports', ['-c', 'import jobmanager.builder.local, jobmanager.builder.lib']),
+]
+
+
+def startup(runs):
+    """
+    Measure process startup durations : server boot imports, and build command with the modules it imports.
+    :return: dict of label -> stats
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPOSITORY_ROOT, os.environ.get('PYTHONPATH')])))
+    results = {}
+    for label, command in STARTUP_COMMANDS:
+        durations = []
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable] + command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            durations.append(time.time() - start)
+        results[label] = {'p50': percentile(durations, 50), 'p95': percentile(durations, 95), 'count': runs}
+    server = results['server imports']['p50']
+    for label, stats in results.items():
+        print("    %-20s p50 %8.3fs   p95 %8.3fs   %5.1f%% of server imports" % (
+            label, stats['p50'], stats['p95'], stats['p50'] * 100.0 / server))
+    return results
+
+
+def git_info():
+    def git(*args):
+        try:
+            return subprocess.check_output(('git',) + args, cwd=REPOSITORY_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        except Exception:
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {'commit': git('rev-parse', 'HEAD'), 'branch': git('rev-parse', '--abbrev-ref', 'HEAD'), 'dirty': bool(status)}
+
+
+def run(args):
+    scenarios = [dict(zip(('files', 'jobs', 'requirements', 'format'), values))
+                 for values in itertools.product(args.files, args.jobs, args.requirements, args.formats)]
+    work_folder = tempfile.mkdtemp(prefix='jobmanager-benchmark-')
+    environment = Environment(work_folder, max(args.requirements), push=args.push, wheelhouse=args.wheelhouse,
+                              dependency_images=args.dependency_images, pipelined=args.pipelined,
+                              validation_mode=args.validation_mode,
+                              build_latency=args.build_latency, push_latency=args.push_latency)
+    report = dict(git_info(), date=datetime.datetime.utcnow().isoformat(), python=sys.version.split()[0],
+                  platform=platform.platform(), options=vars(args), results=[])
+    try:
+        environment.start()
+        for mode in args.modes:
+            for scenario in scenarios:
+                for concurrency in args.concurrency:
+                    result = run_level(mode, work_folder, scenario, concurrency, args.builds, args.warmup)
+                    report['results'].append(result)
+                    print_result(result)
+        report['docker'] = environment.docker.stats
+    finally:
+        environment.stop()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, "%s-%s.json" % (datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S'),
+                                                     (report['commit'] or 'unknown')[:10]))
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("\nResults saved to %s" % path)
+    return path
+
+
+def scenario_label(result):
+    s = result['scenario']
+    return "%s files=%d jobs=%d reqs=%d %s c=%d" % (result['mode'], s['files'], s['jobs'], s['requirements'],
+                                                    s['format'], result['concurrency'])
+
+
+def print_result(result):
+    print("\n%s : %.2f builds/s, %d errors" % (scenario_label(result), result['throughput'] or 0, result['errors']))
+    for message in result['error_messages']:
+        print("    error : %s" % message)
+    for phase, stats in sorted(result['phases'].items(), key=lambda p: -p[1]['mean']):
+        print("    %-20s p50 %8.3fs   p95 %8.3fs   mean %8.3fs" % (phase, stats['p50'], stats['p95'], stats['mean']))
+
+
+def compare(old_path, new_path, threshold):
+    """
+    Compare two result files : throughput and median phase latencies of matching runs.
+    :return: count of regressions above threshold percent
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print("Comparing %s (%s) with %s (%s)" % (old_path, (old.get('commit') or '?')[:10], new_path, (new.get('commit') or '?')[:10]))
+    old_results = dict((scenario_label(r), r) for r in old['results'])
+    regressions = 0
+    for result in new['results']:
+        label = scenario_label(result)
+        previous = old_results.get(label)
+        if not previous:
+            continue
+        print("\n%s" % label)
+        rows = [('throughput', previous['throughput'], result['throughput'], True)]
+        for phase in sorted(set(previous['phases']) & set(result['phases'])):
+            rows.append((phase, previous['phases'][phase]['p50'], result['phases'][phase]['p50'], False))
+        for name, before, after, higher_is_better in rows:
+            if not before or after is None:
+                continue
+            change = (after - before) * 100.0 / before
+            regression = (-change if higher_is_better else change) > threshold
+            regressions += regression
+            print("    %-20s %10.3f -> %10.3f  %+7.1f%%%s" % (name, before, after, change, '  REGRESSION' if regression else ''))
+    return regressions
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+"""
+(c) 2018 Ronan Delacroix
+Python Job Manager Docker Builder - Benchmark local wheel index
+:author: Ronan Delacroix
+"""
+import os
+import re
+import base64
+import hashlib
+import zipfile
+import importlib.metadata
+
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def record_hash(data):
+    return 'sha256=' + base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b'=').decode('ascii')
+
+
+def write_wheel(folder, name, version, tag, files, metadata):
+    """
+    Write a wheel archive from a {archive path: bytes} dict, adding dist-info WHEEL and RECORD files.
+    :return: wheel path
+    """
+    dist_info = "%s-%s.dist-info" % (normalize(name), version)
+    files = dict(files)
+    files[dist_info + '/METADATA'] = metadata
+    files[dist_info + '/WHEEL'] = ("Wheel-Version: 1.0\nGenerator: jobmanager-builder-benchmark\n"
+                                   "Root-Is-Purelib: %s\nTag: %s\n" % ('true' if tag.endswith('-none-any') else 'false', tag)).encode('utf-8')
+    record = ''.join("%s,%s,%d\n" % (path, record_hash(data), len(data)) for path, data in sorted(files.items()))
+    files[dist_info + '/RECORD'] = (record + dist_info + '/RECORD,,\n').encode('utf-8')
+    path = os.path.join(folder, "%s-%s-%s.whl" % (normalize(name), version, tag))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        for archive_path, data in sorted(files.items()):
+            wheel.writestr(archive_path, data)
+    return path
+
+
+def make_requirement_wheel(folder, name, version='1.0', module_size=1024):
+    """
+    Synthetic pure python requirement : a single module named like the project.
+    """
+    module = normalize(name)
+    source = "VALUE = %r\n" % ('x' * module_size)
+    metadata = "Metadata-Version: 2.1\nName: %s\nVersion: %s\n" % (name, version)
+    return write_wheel(folder, name, version, 'py3-none-any', {module + '.py': source.encode('utf-8')}, metadata.encode('utf-8'))
+
+
+def repack_installed(folder, project, seen=None):
+    """
+    Build wheels of an installed project and of its installed dependencies, from their installed files, so that
+    virtual envs can be created without network access.
+    :return: list of wheel paths
+    """
+    seen = seen if seen is not None else set()
+    key = normalize(project)
+    if key in seen:
+        return []
+    seen.add(key)
+    try:
+        dist = importlib.metadata.distribution(project)
+    except importlib.metadata.PackageNotFoundError:
+        return []
+
+    tag = 'py3-none-any'
+    files = {}
+    for file in dist.files or []:
+        path = str(file)
+        if path.startswith('..') or '__pycache__' in path or '.dist-info/' in path:
+            continue
+        located = dist.locate_file(file)
+        if os.path.isfile(located):
+            with open(located, 'rb') as f:
+                files[path] = f.read()
+    wheel_info = dist.read_text('WHEEL') or ''
+    tags = [t.strip().split('-') for t in re.findall(r'^Tag: (.+)$', wheel_info, re.M)]
+    if tags:
+        # compressed tag set, as in wheel file names : py2.py3-none-any
+        tag = '-'.join('.'.join(sorted(set(t[i] for t in tags), key=[t[i] for t in tags].index)) for i in range(3))
+    wheels = [write_wheel(folder, dist.metadata['Name'], dist.version, tag, files, dist.read_text('METADATA').encode('utf-8'))]
+
+    for requirement in dist.requires or []:
+        if 'extra ==' in requirement:
+            continue
+        match = re.match(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)', requirement)
+        if match:
+            wheels += repack_installed(folder, match.group(1), seen)
+    return wheels
+
+
+def create_index(folder, requirement_count):
+    """
+    Local wheel index with jobmanager-common (and its dependencies) and synthetic requirements bench-req-0..N-1.
+    """
+    os.makedirs(folder, exist_ok=True)
+    wheels = repack_installed(folder, 'jobmanager-common')
+    if not wheels:
+        raise Exception("jobmanager-common is not installed, it is needed to create the benchmark wheel index.")
+    for i in range(requirement_count):
+        make_requirement_wheel(folder, 'bench-req-%d' % i)
+    return folder